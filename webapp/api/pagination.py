@@ -0,0 +1,25 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OptionalCursorPagination(CursorPagination):
+    """
+    Keyset pagination that is only applied when requested by the client
+
+    Existing clients (workers, scheduler and frontend) expect plain lists,
+    so the results are only paginated when the request has a `cursor` or
+    a `page_size` query parameter.
+    """
+
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        query_params = request.query_params
+        if (
+            self.cursor_query_param not in query_params
+            and self.page_size_query_param not in query_params
+        ):
+            return None
+        return super().paginate_queryset(queryset, request, view)
@@ -0,0 +1,61 @@
+from django.db.models import Case, IntegerField, Value, When
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+
+class TypeaheadSearchMixin:
+    """
+    Adds a `search` route returning the first rows whose `typeahead_field`
+    contains the searched text, for the autocomplete inputs of the frontend
+    The view filters (e.g. master_zone) are applied before the search
+
+    ***
+        ?q=<text>
+        Text searched (case insensitive), the rows starting with it come first
+        ?limit=<n>
+        Number of rows returned (default: 20, max: 100)
+    ***
+
+    Returns the total number of matches and the first ones:
+    {"count": 1234, "results": [{"id": ..., "<typeahead_field>": ...}, ...]}
+    """
+
+    typeahead_field = None
+    typeahead_limit = 20
+    typeahead_max_limit = 100
+
+    @action(methods=["get"], detail=False, pagination_class=None)
+    def search(self, request):
+        field = self.typeahead_field
+        try:
+            limit = int(request.query_params.get("limit", self.typeahead_limit))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.typeahead_max_limit:
+            raise ValidationError(
+                {"limit": "Expected a number from 1 to %d" % self.typeahead_max_limit}
+            )
+
+        queryset = self.filter_queryset(self.get_queryset())
+        text = request.query_params.get("q", "").strip()
+        ordering = (field,)
+        if text:
+            # Substring searches use the trigram index of the field
+            queryset = queryset.filter(**{field + "__icontains": text}).annotate(
+                typeahead_rank=Case(
+                    When(**{field + "__istartswith": text}, then=Value(0)),
+                    default=Value(1),
+                    output_field=IntegerField(),
+                )
+            )
+            ordering = ("typeahead_rank", field)
+
+        return Response(
+            {
+                "count": queryset.count(),
+                "results": list(
+                    queryset.order_by(*ordering).values("id", field)[:limit]
+                ),
+            }
+        )
@@ -1,7 +1,9 @@
 import ast
-from functools import reduce
-from django.db.models import F
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 from core.models import (
     MasterZone,
     Environment,
@@ -16,20 +18,52 @@ from core.models import (
     Configuration,
     ConfigurationClass,
     ConfigurationParameter,
+    NodeClassification,
 )
+from core.encryption import sensitive_value_cache
+
+
+class SparseFieldsetMixin:
+    """
+    Allows the client to select the fields returned by a GET request
+    through the `fields` query parameter (e.g. `?fields=id,label`)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None or request.method != "GET":
+            return
+        fields = request.query_params.get("fields")
+        if fields:
+            selected = set(fields.split(","))
+            for field_name in set(self.fields) - selected:
+                self.fields.pop(field_name)
 
 
 class MasterZoneSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = MasterZone
-        fields = ("id", "label", "address", "ca_cert", "signed_cert", "private_key")
+        fields = (
+            "id",
+            "label",
+            "address",
+            "ca_cert",
+            "signed_cert",
+            "private_key",
+            "nodes_count",
+        )
 
     def to_representation(self, instance):
         data = super(MasterZoneSerializer, self).to_representation(instance)
-        data["environments_names"] = list(
-            instance.environments.all().values_list("name", flat=True)
-        )
+        if hasattr(instance, "environments_names"):
+            # Annotated by MasterZoneViewSet queryset
+            data["environments_names"] = instance.environments_names or []
+        else:
+            data["environments_names"] = list(
+                instance.environments.all().values_list("name", flat=True)
+            )
         return data
 
 
@@ -52,7 +86,36 @@ class NodeSerializer(serializers.ModelSerializer):
 
     class Meta(object):
         model = Node
-        fields = ("id", "certname", "master_zone")
+        fields = ("id", "certname", "master_zone", "groups_count")
+
+
+class SyncListSerializer(serializers.ListSerializer):
+    """
+    Inserts all the items with a single query, skipping the existing ones
+    through the unique constraints of the model (ON CONFLICT DO NOTHING)
+    """
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        return model.objects.bulk_create(
+            [model(**item) for item in validated_data], ignore_conflicts=True
+        )
+
+
+class FactSyncSerializer(FactSerializer):
+
+    class Meta(FactSerializer.Meta):
+        # Existing facts are skipped by the insert
+        validators = []
+        list_serializer_class = SyncListSerializer
+
+
+class NodeSyncSerializer(NodeSerializer):
+
+    class Meta(NodeSerializer.Meta):
+        # Existing nodes are skipped by the insert
+        validators = []
+        list_serializer_class = SyncListSerializer
 
 
 class PuppetClassSerializer(serializers.ModelSerializer):
@@ -79,6 +142,55 @@ class ParameterSerializer(serializers.ModelSerializer):
         return values
 
 
+class ClassTreeParameterSerializer(ParameterSerializer):
+
+    class Meta(ParameterSerializer.Meta):
+        fields = ("id", "name", "type", "default", "values")
+
+
+class PuppetClassTreeSerializer(serializers.ModelSerializer):
+    """
+    Class along with its parameters, expects them to be prefetched
+    """
+
+    parameters = ClassTreeParameterSerializer(many=True, read_only=True)
+
+    class Meta(object):
+        model = PuppetClass
+        fields = ("id", "name", "parameters")
+
+
+def _configuration_index(root):
+    """
+    Loads, once per request, the classes of the group environment that are
+    present in the received configuration, along with their parameters
+    Returns {class_name: (puppet_class, {parameter_name: parameter})}
+    """
+    index = root.context.get("configuration_index")
+    if index is None:
+        class_names = {
+            config_class.get("puppet_class")
+            for config_class in root.initial_data.get("classes", [])
+            if isinstance(config_class, dict)
+        }
+        puppet_classes = PuppetClass.objects.filter(
+            environment__group=root.instance.pk,
+            name__in=[name for name in class_names if isinstance(name, str)],
+        )
+        index = {
+            puppet_class.name: (puppet_class, {}) for puppet_class in puppet_classes
+        }
+        classes_by_id = {
+            puppet_class.pk: puppet_class for puppet_class, _ in index.values()
+        }
+        for parameter in Parameter.objects.filter(puppet_class__in=classes_by_id):
+            puppet_class = classes_by_id[parameter.puppet_class_id]
+            parameter.puppet_class = puppet_class
+            index[puppet_class.name][1][parameter.name] = parameter
+        root.context["configuration_index"] = index
+    return index
+
+
 class ConfigurationParameterSlugSerializer(serializers.SlugRelatedField):
 
     def get_queryset(self):
@@ -92,6 +204,21 @@ class ConfigurationParameterSlugSerializer(serializers.SlugRelatedField):
             puppet_class__in=PuppetClass.objects.filter(**query)
         )
 
+    def to_internal_value(self, data):
+        """
+        Resolves the parameter from the preloaded configuration index
+        """
+        puppet_class = self.root.context["puppet_class"]
+        try:
+            _, parameters = _configuration_index(self.root).get(
+                puppet_class, (None, {})
+            )
+            return parameters[data]
+        except KeyError:
+            self.fail("does_not_exist", slug_name=self.slug_field, value=data)
+        except TypeError:
+            self.fail("invalid")
+
 
 class ConfigurationParameterSerializer(serializers.ModelSerializer):
     parameter = ConfigurationParameterSlugSerializer(slug_field="name")
@@ -115,6 +242,18 @@ class ConfigurationClassSlugSerializer(serializers.SlugRelatedField):
         group = self.root.instance.group
         return PuppetClass.objects.filter(environment=group.environment)
 
+    def to_internal_value(self, data):
+        """
+        Resolves the puppet class from the preloaded configuration index
+        """
+        try:
+            puppet_class, _ = _configuration_index(self.root)[data]
+            return puppet_class
+        except KeyError:
+            self.fail("does_not_exist", slug_name=self.slug_field, value=data)
+        except TypeError:
+            self.fail("invalid")
+
 
 class ConfigurationClassSerializer(serializers.ModelSerializer):
     parameters = ConfigurationParameterSerializer(many=True)
@@ -136,35 +275,117 @@ class ConfigurationSerializer(serializers.ModelSerializer):
         model = Configuration
         fields = ("classes",)
 
+    def to_representation(self, instance):
+        # Avoids one query per class and per parameter
+        if "classes" not in getattr(instance, "_prefetched_objects_cache", {}):
+            prefetch_related_objects(
+                [instance], "classes__puppet_class", "classes__parameters__parameter"
+            )
+        return super().to_representation(instance)
+
     def update(self, instance, validated_data):
-        classes = validated_data.pop("classes")
+        """
+        Diffs the received classes and parameters against the existing ones
+        and applies the changes with bulk queries, in a single transaction
+        The classification of the group nodes is only refreshed once
+        """
+        with transaction.atomic(), NodeClassification.deferred_refresh():
+            self._update_classes(instance, validated_data.pop("classes"))
+            # The bulk queries skip the signal receivers
+            NodeClassification.refresh_groups([instance.pk])
+        return instance
 
-        # Create each ConfigurationClass
-        for config_class in classes:
-            params = config_class.pop("parameters")
-            config_class_obj, _ = ConfigurationClass.objects.update_or_create(
-                configuration=instance, puppet_class=config_class["puppet_class"]
+    def _update_classes(self, instance, classes):
+        existing_classes = {
+            config_class.puppet_class_id: config_class
+            for config_class in ConfigurationClass.objects.filter(
+                configuration=instance
+            )
+        }
+        existing_params = {
+            (param.configuration_class_id, param.parameter_id): param
+            for param in ConfigurationParameter.objects.filter(
+                configuration_class__configuration=instance
             )
-            # Create each ConfigurationParameter
-            for param in params:
-                ConfigurationParameter.objects.update_or_create(
-                    configuration_class=config_class_obj,
-                    parameter=param["parameter"],
-                    defaults={"raw_value": param["get_raw_value"]},
+        }
+
+        # Create the new ConfigurationClass
+        new_classes = {}
+        for config_class in classes:
+            puppet_class = config_class["puppet_class"]
+            if puppet_class.pk not in existing_classes:
+                new_classes[puppet_class.pk] = ConfigurationClass(
+                    configuration=instance, puppet_class=puppet_class
                 )
-            # Remove ConfigurationParameter that are not used anymore
-            ConfigurationParameter.objects.filter(
-                configuration_class=config_class_obj
-            ).exclude(
-                parameter__name__in=(param["parameter"] for param in params)
-            ).delete()
+        ConfigurationClass.objects.bulk_create(new_classes.values())
+        config_classes = {**existing_classes, **new_classes}
 
-        # Remove ConfigurationClass that are not used anymore
-        ConfigurationClass.objects.filter(configuration=instance).exclude(
-            puppet_class__in=(pp_class["puppet_class"] for pp_class in classes)
-        ).delete()
+        # Diff the ConfigurationParameter
+        params_to_create = {}
+        params_to_update = {}
+        for config_class in classes:
+            config_class_obj = config_classes[config_class["puppet_class"].pk]
+            for param in config_class["parameters"]:
+                key = (config_class_obj.pk, param["parameter"].pk)
+                param_obj = existing_params.get(key)
+                if param_obj is None:
+                    param_obj = ConfigurationParameter(
+                        configuration_class=config_class_obj
+                    )
+                    params_to_create[key] = param_obj
+                else:
+                    params_to_update[key] = param_obj
+                # Avoids fetching the parameter again
+                param_obj.parameter = param["parameter"]
+                param_obj.raw_value = param["get_raw_value"]
+
+        # Cast all the values before writing the parameters
+        for key, param_obj in {**params_to_create, **params_to_update}.items():
+            try:
+                param_obj.prepare_value()
+            except (ValueError, SyntaxError, TypeError, DjangoValidationError):
+                raise serializers.ValidationError(
+                    {
+                        "classes": 'Invalid value "%s" for parameter "%s"'
+                        % (param_obj.raw_value, param_obj.parameter.name)
+                    }
+                )
 
-        return instance
+        ConfigurationParameter.objects.bulk_create(params_to_create.values())
+        ConfigurationParameter.objects.bulk_update(
+            params_to_update.values(),
+            (
+                "raw_value",
+                "string_value",
+                "integer_value",
+                "float_value",
+                "boolean_value",
+                "sensitive_value",
+                "value",
+            ),
+        )
+        # bulk_update skips the post_save signal
+        for param_obj in params_to_update.values():
+            sensitive_value_cache.invalidate(param_obj.pk)
+
+        # Remove ConfigurationClass and ConfigurationParameter
+        # that are not used anymore
+        received_classes = {config_class["puppet_class"].pk for config_class in classes}
+        ConfigurationClass.objects.filter(
+            pk__in=[
+                config_class.pk
+                for puppet_class_id, config_class in existing_classes.items()
+                if puppet_class_id not in received_classes
+            ]
+        ).delete()
+        received_params = set(params_to_create) | set(params_to_update)
+        ConfigurationParameter.objects.filter(
+            pk__in=[
+                param.pk
+                for key, param in existing_params.items()
+                if key not in received_params
+            ]
+        ).delete()
 
 
 class RuleFactSlugSerializer(serializers.SlugRelatedField):
@@ -240,8 +461,43 @@ class VariableSerializer(serializers.ModelSerializer):
         fields = ("data",)
 
 
+class GroupNodeListSerializer(serializers.ManyRelatedField):
+
+    def to_internal_value(self, data):
+        """
+        Resolves all the certnames with a single query,
+        instead of one query per certname
+        """
+        if isinstance(data, str) or not hasattr(data, "__iter__"):
+            self.fail("not_a_list", input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail("empty")
+
+        slug_field = self.child_relation.slug_field
+        certnames = set(data)
+        nodes = list(
+            self.child_relation.get_queryset().filter(
+                **{slug_field + "__in": certnames}
+            )
+        )
+        missing = certnames - {getattr(node, slug_field) for node in nodes}
+        if missing:
+            self.child_relation.fail(
+                "does_not_exist", slug_name=slug_field, value=sorted(missing)[0]
+            )
+        return nodes
+
+
 class GroupNodeSerializer(serializers.SlugRelatedField):
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {"child_relation": cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return GroupNodeListSerializer(**list_kwargs)
+
     def get_queryset(self):
         """
         Returns nodes from the same master_zone of the group
@@ -252,9 +508,10 @@ class GroupNodeSerializer(serializers.SlugRelatedField):
         return queryset
 
 
-class GroupSerializer(serializers.ModelSerializer):
+class GroupSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    # Declared fields ignore extra_kwargs, so write_only is set here
     matching_nodes = GroupNodeSerializer(
-        required=False, many=True, slug_field="certname"
+        required=False, many=True, slug_field="certname", write_only=True
     )
     id = serializers.CharField(read_only=True)
     tags_list = serializers.ListField(required=False)
@@ -269,11 +526,10 @@ class GroupSerializer(serializers.ModelSerializer):
             "environment",
             "description",
             "tags_list",
+            "priority",
+            "nodes_count",
         )
-        extra_kwargs = {
-            "matching_nodes": {"write_only": True},
-            "environment": {"required": False},
-        }
+        extra_kwargs = {"environment": {"required": False}}
 
     def create(self, validated_data):
         tags_list = validated_data.pop("tags_list", "")
@@ -311,39 +567,57 @@ class NodeClassifierSerializer(serializers.ModelSerializer):
             'class_name2': []
         }
         """
-        classes = {}
-        values = node.group_set.annotate(
-            class_name=F("configuration__class__puppet_class__name"),
-            param_name=F("configuration__class__parameter__parameter__name"),
-            param_value=F("configuration__class__parameter__raw_value"),
-            param_pk=F("configuration__class__parameter__pk"),
-        ).values("class_name", "param_name", "param_value", "param_pk")
-
-        for value in values:
-            if value["class_name"] and value["class_name"] not in classes:
-                classes[value["class_name"]] = None
-            if value["param_name"]:
-                if value["param_value"] is not None:
-                    if classes[value["class_name"]] is None:
-                        classes[value["class_name"]] = {}
-                    param_value = ConfigurationParameter.objects.get(
-                        pk=value["param_pk"]
-                    ).get_value()
-                    classes[value["class_name"]][value["param_name"]] = param_value
-
+        classification = self._classification(node)
         # Returns None for nodes withou classification settings
-        return classes or None
+        if classification is None or not classification.classes:
+            return None
+
+        classes = classification.classes
+        sensitive_parameters = classification.sensitive_parameters
+        if sensitive_parameters:
+            # Sensitive values are only stored encrypted
+            config_params = ConfigurationParameter.objects.filter(
+                pk__in=[
+                    param_id
+                    for params in sensitive_parameters.values()
+                    for param_id in params.values()
+                ]
+            ).select_related("parameter")
+            values = {
+                str(config_param.pk): config_param.get_value()
+                for config_param in config_params
+            }
+            for class_name, params in sensitive_parameters.items():
+                for param_name, param_id in params.items():
+                    classes[class_name][param_name] = values.get(param_id)
+        return classes
+
+    def _classification(self, node):
+        try:
+            return node.classification
+        except NodeClassification.DoesNotExist:
+            return None
 
     def get_parameters(self, node):
         """
-        Returns list of hash values from Variable related to the node's group
+        Returns the variables of the node's groups, merged by group precedence
         """
-        variables = node.group_set.filter(variable__data__isnull=False).values_list(
-            "variable__data", flat=True
-        )
+        classification = self._classification(node)
         # Returns None for nodes withou classification settings
-        return reduce(lambda x, y: {**x, **y}, variables, {}) or None
+        return (classification and classification.parameters) or None
 
     def get_environment(self, node):
-        groups = node.group_set.all()
-        return str(groups.first().environment) if groups else None
+        """
+        Returns the environment of the node's group with the highest precedence
+        """
+        classification = self._classification(node)
+        return classification and classification.environment
+
+
+class NodeConflictsSerializer(serializers.ModelSerializer):
+    certname = serializers.CharField(source="node.certname")
+    master_zone = serializers.CharField(source="node.master_zone_id")
+
+    class Meta(object):
+        model = NodeClassification
+        fields = ("certname", "master_zone", "environment", "conflicts")
@@ -0,0 +1,60 @@
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def _ndjson_lines(rows, encoder):
+    for row in rows:
+        yield encoder.encode(row) + "\n"
+
+
+def _json_array(rows, encoder):
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + encoder.encode(row)
+        separator = ","
+    yield "]"
+
+
+STREAM_FORMATS = {
+    "ndjson": ("application/x-ndjson", _ndjson_lines),
+    "json": ("application/json", _json_array),
+}
+
+
+class StreamingListMixin:
+    """
+    Streams the list results when requested through the `stream` query
+    parameter, iterating over the queryset in chunks so the memory used
+    does not grow with the number of rows
+
+    ***
+        ?stream=ndjson
+        One JSON object per line (application/x-ndjson)
+        ?stream=json
+        A single JSON array
+    ***
+    """
+
+    stream_chunk_size = 2000
+
+    def list(self, request, *args, **kwargs):
+        stream = request.query_params.get("stream")
+        if stream is None:
+            return super().list(request, *args, **kwargs)
+        if stream not in STREAM_FORMATS:
+            raise ValidationError(
+                {"stream": "Expected one of: %s" % ", ".join(sorted(STREAM_FORMATS))}
+            )
+
+        content_type, generator = STREAM_FORMATS[stream]
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer()
+        rows = (
+            serializer.to_representation(obj)
+            for obj in queryset.iterator(chunk_size=self.stream_chunk_size)
+        )
+        return StreamingHttpResponse(
+            generator(rows, JSONEncoder()), content_type=content_type
+        )
@@ -1,3 +1,5 @@
+import json
+import uuid
 from os import remove
 from shutil import copyfile
 from unittest.mock import patch
@@ -5,6 +7,9 @@ from unittest.mock import patch
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.core.files import File
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 
 from core import models
@@ -22,6 +27,9 @@ def ordered(obj):
     return obj
 
 
+# The user logs are written by each request, the test transactions are not
+# visible to the background writer
+@override_settings(USERLOG_BATCH_SIZE=1, USERLOG_FLUSH_INTERVAL=0)
 class BaseAPITestCase(APITestCase):
 
     def setUp(self):
@@ -124,6 +132,92 @@ class ConfigurationTests(BaseAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(ordered(response.json()), ordered(expected_json))
 
+    @override_settings(REFERENCE_CACHE_ENABLED=True)
+    def test_fetch_configuration_tree(self):
+        """
+        A get request should return the environment classes with their
+        parameters and the group configuration, caching the classes
+        """
+        profile_tomcat = models.PuppetClass.objects.create(
+            name="profile::tomcat", environment=self.environment
+        )
+        tomcat_version = models.Parameter.objects.create(
+            name="version", puppet_class=profile_tomcat, value_default="9"
+        )
+        tomcat_user = models.Parameter.objects.create(
+            name="user", puppet_class=profile_tomcat
+        )
+        models.PuppetClass.objects.create(
+            name="profile::base", environment=self.environment
+        )
+        tomcat_config = models.ConfigurationClass.objects.create(
+            puppet_class=profile_tomcat, configuration=self.group.configuration
+        )
+        models.ConfigurationParameter.objects.create(
+            configuration_class=tomcat_config, parameter=tomcat_user, raw_value="tomcat"
+        )
+
+        url = f"/api/configuration/{self.group.id}/tree/"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        base_class = {"name": "profile::base", "parameters": []}
+        base_class["id"] = str(models.PuppetClass.objects.get(name="profile::base").id)
+        self.assertEqual(
+            response.json(),
+            {
+                "environment": str(self.environment.id),
+                "classes": [
+                    base_class,
+                    {
+                        "id": str(profile_tomcat.id),
+                        "name": "profile::tomcat",
+                        "parameters": [
+                            {
+                                "id": str(tomcat_user.id),
+                                "name": "user",
+                                "type": "String",
+                                "default": "",
+                                "values": "",
+                            },
+                            {
+                                "id": str(tomcat_version.id),
+                                "name": "version",
+                                "type": "String",
+                                "default": "9",
+                                "values": "",
+                            },
+                        ],
+                    },
+                ],
+                "configuration": [
+                    {
+                        "puppet_class": "profile::tomcat",
+                        "parameters": [
+                            {
+                                "value": "tomcat",
+                                "raw_value": "tomcat",
+                                "parameter": "user",
+                            }
+                        ],
+                    }
+                ],
+            },
+        )
+
+        # The environment classes are cached until they change
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, format="json")
+        environment_filter = '"core_puppetclass"."environment_id" ='
+        self.assertFalse(
+            [query for query in queries if environment_filter in query["sql"]]
+        )
+        tomcat_version.delete()
+        response = self.client.get(url, format="json")
+        self.assertEqual(
+            [param["name"] for param in response.json()["classes"][1]["parameters"]],
+            ["user"],
+        )
+
     def test_basic_register_configuration(self):
         """
         A put request to the endpoint should update
@@ -610,6 +704,9 @@ class ConfigurationTests(BaseAPITestCase):
         tomcat_bool = models.Parameter.objects.create(
             name="bool", value_type="Boolean", puppet_class=profile_tomcat
         )
+        tomcat_bool_false = models.Parameter.objects.create(
+            name="bool_false", value_type="Boolean", puppet_class=profile_tomcat
+        )
         tomcat_config = models.ConfigurationClass.objects.create(
             puppet_class=profile_tomcat, configuration=self.group.configuration
         )
@@ -617,7 +714,9 @@ class ConfigurationTests(BaseAPITestCase):
             configuration_class=tomcat_config, parameter=tomcat_bool, raw_value="True"
         )
         models.ConfigurationParameter.objects.create(
-            configuration_class=tomcat_config, parameter=tomcat_bool, raw_value="False"
+            configuration_class=tomcat_config,
+            parameter=tomcat_bool_false,
+            raw_value="False",
         )
         expected_json = {
             "classes": [
@@ -632,7 +731,7 @@ class ConfigurationTests(BaseAPITestCase):
                         {
                             "value": False,
                             "raw_value": "False",
-                            "parameter": tomcat_bool.name,
+                            "parameter": tomcat_bool_false.name,
                         },
                     ],
                 }
@@ -768,6 +867,12 @@ class ConfigurationTests(BaseAPITestCase):
             values="Boolean",
             puppet_class=profile_tomcat,
         )
+        tomcat_bool_false = models.Parameter.objects.create(
+            name="optional_bool_false",
+            value_type="Optional",
+            values="Boolean",
+            puppet_class=profile_tomcat,
+        )
         tomcat_config = models.ConfigurationClass.objects.create(
             puppet_class=profile_tomcat, configuration=self.group.configuration
         )
@@ -775,7 +880,9 @@ class ConfigurationTests(BaseAPITestCase):
             configuration_class=tomcat_config, parameter=tomcat_bool, raw_value="True"
         )
         models.ConfigurationParameter.objects.create(
-            configuration_class=tomcat_config, parameter=tomcat_bool, raw_value="False"
+            configuration_class=tomcat_config,
+            parameter=tomcat_bool_false,
+            raw_value="False",
         )
         expected_json = {
             "classes": [
@@ -790,7 +897,7 @@ class ConfigurationTests(BaseAPITestCase):
                         {
                             "value": False,
                             "raw_value": "False",
-                            "parameter": tomcat_bool.name,
+                            "parameter": tomcat_bool_false.name,
                         },
                     ],
                 }
@@ -1015,6 +1122,264 @@ class ConfigurationTests(BaseAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(ordered(response.json()), ordered(expected_json))
 
+    def test_update_configuration_diff(self):
+        """
+        A put request should update, create and remove classes and
+        parameters, including sensitive and typed values
+        """
+        profile_tomcat = models.PuppetClass.objects.create(
+            name="profile::tomcat", environment=self.environment
+        )
+        tomcat_user = models.Parameter.objects.create(
+            name="user", puppet_class=profile_tomcat
+        )
+        tomcat_port = models.Parameter.objects.create(
+            name="port", value_type="Integer", puppet_class=profile_tomcat
+        )
+        tomcat_password = models.Parameter.objects.create(
+            name="sensitive_password", puppet_class=profile_tomcat
+        )
+        tomcat_old = models.Parameter.objects.create(
+            name="old", puppet_class=profile_tomcat
+        )
+        profile_apache = models.PuppetClass.objects.create(
+            name="profile::apache", environment=self.environment
+        )
+        profile_linux = models.PuppetClass.objects.create(
+            name="profile::base::linux", environment=self.environment
+        )
+        linux_packages = models.Parameter.objects.create(
+            name="packages", value_type="Array", puppet_class=profile_linux
+        )
+        tomcat_config = models.ConfigurationClass.objects.create(
+            puppet_class=profile_tomcat, configuration=self.group.configuration
+        )
+        models.ConfigurationClass.objects.create(
+            puppet_class=profile_apache, configuration=self.group.configuration
+        )
+        for param, raw_value in (
+            (tomcat_user, "tomcat"),
+            (tomcat_password, "secret"),
+            (tomcat_old, "old"),
+        ):
+            models.ConfigurationParameter.objects.create(
+                configuration_class=tomcat_config, parameter=param, raw_value=raw_value
+            )
+
+        payload = {
+            "classes": [
+                {
+                    "puppet_class": profile_tomcat.name,
+                    "parameters": [
+                        {"raw_value": "tomcat8", "parameter": tomcat_user.name},
+                        {"raw_value": "8080", "parameter": tomcat_port.name},
+                        {"raw_value": "newsecret", "parameter": tomcat_password.name},
+                    ],
+                },
+                {
+                    "puppet_class": profile_linux.name,
+                    "parameters": [
+                        {"raw_value": "['vim', 'git']", "parameter": "packages"}
+                    ],
+                },
+            ]
+        }
+        url = "/api/configuration/" + str(self.group.id) + "/"
+        response = self.client.put(url, data=payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        expected_json = {
+            "classes": [
+                {
+                    "puppet_class": profile_tomcat.name,
+                    "parameters": [
+                        {
+                            "value": "tomcat8",
+                            "raw_value": "tomcat8",
+                            "parameter": tomcat_user.name,
+                        },
+                        {"value": 8080, "raw_value": "8080", "parameter": "port"},
+                        {
+                            "value": "newsecret",
+                            "raw_value": "newsecret",
+                            "parameter": tomcat_password.name,
+                        },
+                    ],
+                },
+                {
+                    "puppet_class": profile_linux.name,
+                    "parameters": [
+                        {
+                            "value": ["vim", "git"],
+                            "raw_value": "['vim', 'git']",
+                            "parameter": linux_packages.name,
+                        }
+                    ],
+                },
+            ]
+        }
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(ordered(response.json()), ordered(expected_json))
+        password = models.ConfigurationParameter.objects.get(parameter=tomcat_password)
+        self.assertEqual(password.raw_value, "[Sensitive]")
+        self.assertFalse(
+            models.ConfigurationClass.objects.filter(
+                puppet_class=profile_apache
+            ).exists()
+        )
+
+    def test_update_configuration_invalid_value(self):
+        """
+        A put request with a value that can't be cast should not
+        change the configuration
+        """
+        profile_tomcat = models.PuppetClass.objects.create(
+            name="profile::tomcat", environment=self.environment
+        )
+        tomcat_user = models.Parameter.objects.create(
+            name="user", puppet_class=profile_tomcat
+        )
+        tomcat_port = models.Parameter.objects.create(
+            name="port", value_type="Integer", puppet_class=profile_tomcat
+        )
+        profile_apache = models.PuppetClass.objects.create(
+            name="profile::apache", environment=self.environment
+        )
+        payload = {
+            "classes": [
+                {
+                    "puppet_class": profile_tomcat.name,
+                    "parameters": [
+                        {"raw_value": "tomcat", "parameter": tomcat_user.name},
+                        {"raw_value": "eighty", "parameter": tomcat_port.name},
+                    ],
+                },
+                {"puppet_class": profile_apache.name, "parameters": []},
+            ]
+        }
+        url = "/api/configuration/" + str(self.group.id) + "/"
+        response = self.client.put(url, data=payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(models.ConfigurationClass.objects.count(), 0)
+        self.assertEqual(models.ConfigurationParameter.objects.count(), 0)
+
+    def test_update_configuration_non_json_value(self):
+        """
+        A put request with a value that JSON can not store unchanged should
+        fail without changing the configuration
+        """
+        profile_tomcat = models.PuppetClass.objects.create(
+            name="profile::tomcat", environment=self.environment
+        )
+        tomcat_ports = models.Parameter.objects.create(
+            name="ports", value_type="Array", puppet_class=profile_tomcat
+        )
+        tomcat_users = models.Parameter.objects.create(
+            name="users", value_type="Hash", puppet_class=profile_tomcat
+        )
+        url = "/api/configuration/" + str(self.group.id) + "/"
+        for parameter, raw_value in (
+            (tomcat_ports, "{80, 443}"),
+            (tomcat_ports, "[b'80']"),
+            (tomcat_ports, "[1j]"),
+            (tomcat_ports, "[1e999]"),
+            (tomcat_users, "{1: 'tomcat'}"),
+            (tomcat_users, "{[1]: 'tomcat'}"),
+        ):
+            payload = {
+                "classes": [
+                    {
+                        "puppet_class": profile_tomcat.name,
+                        "parameters": [
+                            {"raw_value": raw_value, "parameter": parameter.name}
+                        ],
+                    }
+                ]
+            }
+            response = self.client.put(url, data=payload, format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(raw_value, response.json()["classes"])
+        self.assertEqual(models.ConfigurationParameter.objects.count(), 0)
+
+    def _put_configuration_num_queries(self, total_classes, total_params):
+        """
+        Creates the classes and parameters in a new environment and
+        returns how many queries a put request configuring them all costs
+        """
+        environment = models.Environment.objects.create(
+            name=f"env_{total_classes}_{total_params}", master_zone=self.master_zone
+        )
+        group = models.Group.objects.create(
+            label="grupo02",
+            description="Pack my box with five dozen liquor jugs",
+            master_zone=self.master_zone,
+            environment=environment,
+        )
+        payload = {"classes": []}
+        for i in range(total_classes):
+            puppet_class = models.PuppetClass.objects.create(
+                name=f"profile::class{i}", environment=environment
+            )
+            parameters = []
+            for j in range(total_params):
+                models.Parameter.objects.create(
+                    name=f"param{j}", value_type="Integer", puppet_class=puppet_class
+                )
+                parameters.append({"raw_value": str(j), "parameter": f"param{j}"})
+            payload["classes"].append(
+                {"puppet_class": puppet_class.name, "parameters": parameters}
+            )
+        url = "/api/configuration/" + str(group.id) + "/"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(url, data=payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()["classes"]), total_classes)
+        self.assertEqual(
+            models.ConfigurationParameter.objects.filter(
+                configuration_class__configuration=group.configuration
+            ).count(),
+            total_classes * total_params,
+        )
+        return len(queries)
+
+    def test_register_configuration_num_queries(self):
+        """
+        The number of queries of a put request should not depend
+        on the number of classes and parameters
+        """
+        self.assertEqual(
+            self._put_configuration_num_queries(1, 1),
+            self._put_configuration_num_queries(20, 10),
+        )
+
+    def test_register_configuration_unknown_parameter(self):
+        """
+        A put request with a parameter from another class should fail
+        """
+        profile_tomcat = models.PuppetClass.objects.create(
+            name="profile::tomcat", environment=self.environment
+        )
+        profile_apache = models.PuppetClass.objects.create(
+            name="profile::apache", environment=self.environment
+        )
+        models.Parameter.objects.create(name="user", puppet_class=profile_apache)
+        payload = {
+            "classes": [
+                {
+                    "puppet_class": profile_tomcat.name,
+                    "parameters": [{"raw_value": "tomcat", "parameter": "user"}],
+                },
+                {"puppet_class": "profile::unknown", "parameters": []},
+            ]
+        }
+        url = "/api/configuration/" + str(self.group.id) + "/"
+        response = self.client.put(url, data=payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()["classes"]
+        self.assertIn("parameter", errors[0]["parameters"][0])
+        self.assertIn("puppet_class", errors[1])
+
 
 class RulesTests(BaseAPITestCase):
     """
@@ -1345,6 +1710,132 @@ class PuppetClassesTests(BaseAPITestCase):
         )
 
 
+class UsageTests(BaseAPITestCase):
+    """
+    Tests to the /classes/<id>/usage and /parameters/<id>/usage endpoints
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        self.classes = {}
+        for name in ("production", "staging"):
+            environment = models.Environment.objects.create(
+                name=name, master_zone=self.master_zone
+            )
+            puppet_class = models.PuppetClass.objects.create(
+                name="profile::tomcat", environment=environment
+            )
+            for param_name in ("port", "user"):
+                models.Parameter.objects.create(
+                    name=param_name, puppet_class=puppet_class
+                )
+            self.classes[name] = puppet_class
+
+        self._configure("grupo01", "production", {"user": "tomcat"}, nodes=2)
+        self._configure("grupo02", "production", {"user": "root"}, priority=1)
+        self._configure("grupo03", "production", {"port": "8080"})
+        self._configure("grupo04", "staging", {"user": "www"}, nodes=1)
+
+    def _configure(self, label, environment_name, values, nodes=0, priority=0):
+        puppet_class = self.classes[environment_name]
+        group = models.Group.objects.create(
+            label=label,
+            description=label,
+            priority=priority,
+            master_zone=self.master_zone,
+            environment=puppet_class.environment,
+        )
+        group.matching_nodes.set(
+            models.Node.objects.create(
+                certname="%s-%d.acme" % (label, i), master_zone=self.master_zone
+            )
+            for i in range(nodes)
+        )
+        config_class = models.ConfigurationClass.objects.create(
+            puppet_class=puppet_class, configuration=group.configuration
+        )
+        for name, raw_value in values.items():
+            models.ConfigurationParameter.objects.create(
+                configuration_class=config_class,
+                parameter=puppet_class.parameters.get(name=name),
+                raw_value=raw_value,
+            )
+
+    def test_class_usage(self):
+        """
+        A get request should list the groups configuring the class, with
+        their values and number of nodes
+        """
+        url = "/api/classes/%s/usage/" % self.classes["production"].id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        usage = response.json()
+        self.assertEqual(usage["count"], 3)
+        self.assertEqual(
+            [
+                (group["label"], group["nodes"], group["parameters"])
+                for group in usage["groups"]
+            ],
+            [
+                ("grupo01", 2, {"user": "tomcat"}),
+                ("grupo03", 0, {"port": "8080"}),
+                ("grupo02", 0, {"user": "root"}),
+            ],
+        )
+
+        with self.assertNumQueries(5):
+            response = self.client.get(url, {"environments": "all"})
+        self.assertEqual(
+            [
+                (group["environment"], group["label"])
+                for group in response.json()["groups"]
+            ],
+            [
+                ("production", "grupo01"),
+                ("production", "grupo03"),
+                ("production", "grupo02"),
+                ("staging", "grupo04"),
+            ],
+        )
+
+    def test_parameter_usage(self):
+        """
+        A get request should list the groups overriding the parameter
+        """
+        parameter = self.classes["production"].parameters.get(name="user")
+        url = "/api/parameters/%s/usage/" % parameter.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        usage = response.json()
+        self.assertEqual(usage["puppet_class"], "profile::tomcat")
+        self.assertEqual(usage["environment"], "production")
+        self.assertEqual(usage["count"], 2)
+        self.assertEqual(
+            usage["groups"][0],
+            {
+                "id": str(models.Group.objects.get(label="grupo01").id),
+                "label": "grupo01",
+                "priority": 0,
+                "environment": "production",
+                "nodes": 2,
+                "raw_value": "tomcat",
+            },
+        )
+
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {"environments": "all"})
+        self.assertEqual(
+            [
+                (group["label"], group["raw_value"], group["nodes"])
+                for group in response.json()["groups"]
+            ],
+            [("grupo01", "tomcat", 2), ("grupo02", "root", 0), ("grupo04", "www", 1)],
+        )
+
+
 class GroupsTests(BaseAPITestCase):
     """
     Tests to the /groups endpoint
@@ -1397,14 +1888,123 @@ class GroupsTests(BaseAPITestCase):
         master_zone.nodes.create(certname="888.empresa")
         payload = {"matching_nodes": ["555.contoso"]}
         url = "/api/groups/" + str(group.id) + "/"
-        response = self.client.patch(url, data=payload, format="json")
+        with patch(
+            "core.models.compile_classifications", wraps=models.compile_classifications
+        ) as compile_classifications:
+            response = self.client.patch(url, data=payload, format="json")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(compile_classifications.call_count, 1)
 
         group.refresh_from_db()
         nodes = group.matching_nodes.values_list("certname", flat=True)
         self.assertEqual(len(nodes), 1)
         self.assertEqual(nodes[0], "555.contoso")
 
+    def test_update_matching_nodes_nonexistent_node(self):
+        """
+        A matching_nodes update with an unknown certname should fail
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        group = models.Group.objects.create(
+            label="grupo01",
+            description="Pack my box with five dozen liquor jugs",
+            master_zone=master_zone,
+            environment=environment,
+        )
+        master_zone.nodes.create(certname="1234.acme")
+        payload = {"matching_nodes": ["1234.acme", "555.contoso"]}
+        url = "/api/groups/" + str(group.id) + "/"
+        response = self.client.patch(url, data=payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("555.contoso", response.json()["matching_nodes"][0])
+        self.assertEqual(group.matching_nodes.count(), 0)
+
+    def _create_groups(self, total):
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        for i in range(total):
+            group = models.Group.objects.create(
+                label=f"group{i:02}",
+                description="Pack my box with five dozen liquor jugs",
+                master_zone=master_zone,
+                environment=environment,
+            )
+            group.tags.set("tag1", f"tag{i}")
+
+    def test_group_list_num_queries(self):
+        """
+        Listing the groups should cost a constant number of queries
+        """
+        self._create_groups(30)
+        url = "/api/groups/"
+        # Session, user, groups and tags queries
+        with self.assertNumQueries(4):
+            response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 30)
+        for group in response.json():
+            self.assertIn("tag1", group["tags_list"])
+            self.assertNotIn("matching_nodes", group)
+
+    def test_group_list_sparse_fields(self):
+        """
+        The fields query parameter should restrict the returned fields
+        and avoid fetching the tags when they are not requested
+        """
+        self._create_groups(3)
+        url = "/api/groups/?fields=id,label"
+        with self.assertNumQueries(3):
+            response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for group in response.json():
+            self.assertEqual(set(group), {"id", "label"})
+
+    def test_group_list_search(self):
+        """
+        The search and tags query parameters should filter the groups, the
+        search ranking them by relevance
+        """
+        self._create_groups(12)
+        models.Group.objects.filter(label="group03").update(description="Tag11 users")
+        models.Group.refresh_search(models.Group.objects.values_list("pk", flat=True))
+        url = "/api/groups/?fields=label&search=tag11"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [group["label"] for group in response.json()], ["group11", "group03"]
+        )
+
+        url = "/api/groups/?fields=label&tags=tag2,tag10"
+        response = self.client.get(url, format="json")
+        self.assertEqual(
+            sorted(group["label"] for group in response.json()), ["group02", "group10"]
+        )
+
+    def test_group_list_cursor_pagination(self):
+        """
+        The groups should be paginated when a page_size is requested
+        """
+        self._create_groups(25)
+        url = "/api/groups/?page_size=10"
+        labels = []
+        while url:
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response_json = response.json()
+            self.assertLessEqual(len(response_json["results"]), 10)
+            labels.extend(group["label"] for group in response_json["results"])
+            url = response_json["next"]
+        self.assertEqual(sorted(labels), [f"group{i:02}" for i in range(25)])
+
 
 class NodesTests(BaseAPITestCase):
     """
@@ -1428,6 +2028,138 @@ class NodesTests(BaseAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         # Assert nodes created
         self.assertEqual(models.Node.objects.count(), 3)
+        response = self.client.get("/api/master_zones/%s/" % master_zone.id)
+        self.assertEqual(response.json()["nodes_count"], 3)
+
+    def _create_nodes(self, total):
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        other_master_zone = models.MasterZone.objects.create(
+            label="Shredder", address="http://10.10.10.11"
+        )
+        models.Node.objects.create(certname="other.acme", master_zone=other_master_zone)
+        for i in range(total):
+            models.Node.objects.create(certname=f"{i:03}.acme", master_zone=master_zone)
+        return master_zone
+
+    def test_node_list_cursor_pagination(self):
+        """
+        The nodes should be paginated when a page_size is requested
+        """
+        master_zone = self._create_nodes(25)
+        url = f"/api/nodes/?master_zone={master_zone.id}&page_size=10"
+        certnames = []
+        while url:
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response_json = response.json()
+            self.assertLessEqual(len(response_json["results"]), 10)
+            certnames.extend(node["certname"] for node in response_json["results"])
+            url = response_json["next"]
+        self.assertEqual(sorted(certnames), [f"{i:03}.acme" for i in range(25)])
+
+    def test_node_list_without_pagination(self):
+        """
+        Without pagination parameters the nodes should be a plain list
+        """
+        master_zone = self._create_nodes(5)
+        url = f"/api/nodes/?master_zone={master_zone.id}"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 5)
+
+    def test_node_list_stream_ndjson(self):
+        """
+        The nodes should be streamed as one JSON object per line
+        """
+        master_zone = self._create_nodes(5)
+        url = f"/api/nodes/?master_zone={master_zone.id}&stream=ndjson"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        content = b"".join(response.streaming_content).decode()
+        nodes = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            sorted(node["certname"] for node in nodes),
+            [f"{i:03}.acme" for i in range(5)],
+        )
+        self.assertEqual(nodes[0]["master_zone"], str(master_zone.id))
+
+    def test_node_list_stream_json(self):
+        """
+        The nodes should be streamed as a single JSON array
+        """
+        master_zone = self._create_nodes(5)
+        url = f"/api/nodes/?master_zone={master_zone.id}&stream=json"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        nodes = json.loads(b"".join(response.streaming_content).decode())
+        self.assertEqual(
+            sorted(node["certname"] for node in nodes),
+            [f"{i:03}.acme" for i in range(5)],
+        )
+
+    def test_node_list_stream_empty(self):
+        """
+        Streaming an empty list should produce a valid JSON array
+        """
+        url = "/api/nodes/?stream=json"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), [])
+
+    def test_node_list_stream_invalid_format(self):
+        """
+        An unknown stream format should return a bad request
+        """
+        url = "/api/nodes/?stream=xml"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_node_search(self):
+        """
+        Should return the first nodes containing the text, prefixes first
+        """
+        master_zone = self._create_nodes(25)
+        models.Node.objects.create(certname="acme.010", master_zone=master_zone)
+        url = f"/api/nodes/search/?master_zone={master_zone.id}&q=ACME.0&limit=3"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response_json = response.json()
+        self.assertEqual(response_json["count"], 1)
+        self.assertEqual(
+            [node["certname"] for node in response_json["results"]], ["acme.010"]
+        )
+
+        url = f"/api/nodes/search/?master_zone={master_zone.id}&q=01&limit=3"
+        response_json = self.client.get(url, format="json").json()
+        self.assertEqual(response_json["count"], 12)
+        self.assertEqual(
+            [node["certname"] for node in response_json["results"]],
+            ["010.acme", "011.acme", "012.acme"],
+        )
+        self.assertEqual(set(response_json["results"][0]), {"id", "certname"})
+
+    def test_node_search_without_text(self):
+        """
+        Without a text should return the first nodes of the master zone
+        """
+        master_zone = self._create_nodes(25)
+        url = f"/api/nodes/search/?master_zone={master_zone.id}"
+        response_json = self.client.get(url, format="json").json()
+        self.assertEqual(response_json["count"], 25)
+        self.assertEqual(len(response_json["results"]), 20)
+        self.assertEqual(response_json["results"][0]["certname"], "000.acme")
+
+    def test_node_search_invalid_parameters(self):
+        """
+        Invalid limits and master zones should return a bad request
+        """
+        for params in ("limit=0", "limit=1000", "limit=all", "master_zone=1"):
+            response = self.client.get(f"/api/nodes/search/?{params}", format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
     def test_node_sync_update(self):
         """
@@ -1744,6 +2476,164 @@ class NodesTests(BaseAPITestCase):
         )
         self.assertEqual(response.content.decode("utf-8"), expected_yaml)
 
+    def _create_conflicting_groups(self):
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        node = models.Node.objects.create(certname="1234.acme", master_zone=master_zone)
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        profile_tomcat = models.PuppetClass.objects.create(
+            name="profile::tomcat", environment=environment
+        )
+        tomcat_user = models.Parameter.objects.create(
+            name="user", puppet_class=profile_tomcat
+        )
+        tomcat_password = models.Parameter.objects.create(
+            name="sensitive_password", puppet_class=profile_tomcat
+        )
+        groups = []
+        for label in ("grupo01", "grupo02"):
+            group = models.Group.objects.create(
+                label=label,
+                description=label,
+                master_zone=master_zone,
+                environment=environment,
+            )
+            group.matching_nodes.set([node])
+            tomcat_config = models.ConfigurationClass.objects.create(
+                puppet_class=profile_tomcat, configuration=group.configuration
+            )
+            models.ConfigurationParameter.objects.create(
+                configuration_class=tomcat_config,
+                parameter=tomcat_user,
+                raw_value="user_" + label,
+            )
+            models.ConfigurationParameter.objects.create(
+                configuration_class=tomcat_config,
+                parameter=tomcat_password,
+                raw_value="password_" + label,
+            )
+            groups.append(group)
+        return node, groups
+
+    def test_node_classifier_class_priority(self):
+        """
+        The class parameters of the higher priority group should prevail,
+        sensitive values are never stored decrypted
+        """
+        node, groups = self._create_conflicting_groups()
+        url = "/api/nodes/node_classifier/?certname=%s&master_id=%s" % (
+            node.certname,
+            node.master_zone_id,
+        )
+        response = self.client.get(url)
+        expected_yaml = (
+            "classes:\n"
+            "  profile::tomcat:\n"
+            "    sensitive_password: password_grupo02\n"
+            "    user: user_grupo02\n"
+            "environment: production\n"
+            "parameters:\n"
+        )
+        self.assertEqual(response.content.decode("utf-8"), expected_yaml)
+
+        groups[0].priority = 1
+        groups[0].save()
+        response = self.client.get(url)
+        self.assertEqual(
+            response.content.decode("utf-8"), expected_yaml.replace("02", "01")
+        )
+        classification = models.NodeClassification.objects.get(node=node)
+        self.assertIsNone(
+            classification.classes["profile::tomcat"]["sensitive_password"]
+        )
+
+    def test_node_conflicts(self):
+        """
+        A get request should list the parameters set by more than one group
+        """
+        node, groups = self._create_conflicting_groups()
+        groups[1].priority = -1
+        groups[1].save()
+        response = self.client.get(
+            "/api/nodes/conflicts/?master_zone=" + str(node.master_zone_id)
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 1)
+        conflicts = response.json()[0]
+        self.assertEqual(conflicts["certname"], node.certname)
+        self.assertEqual(
+            [
+                (conflict["parameter"], conflict["winner"])
+                for conflict in conflicts["conflicts"]
+            ],
+            [("sensitive_password", "grupo01"), ("user", "grupo01")],
+        )
+        self.assertEqual(
+            [group["value"] for group in conflicts["conflicts"][0]["groups"]],
+            ["[Sensitive]", "[Sensitive]"],
+        )
+        self.assertEqual(
+            conflicts["conflicts"][1]["groups"][1],
+            {
+                "id": str(groups[0].id),
+                "label": "grupo01",
+                "priority": 0,
+                "value": "user_grupo01",
+            },
+        )
+
+        response = self.client.get("/api/nodes/conflicts/?certname=other")
+        self.assertEqual(response.json(), [])
+        response = self.client.get("/api/nodes/conflicts/?master_zone=wrong")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_node_explain(self):
+        """
+        A get request should explain which group sets each parameter of the
+        node, in a constant number of queries
+        """
+        node, groups = self._create_conflicting_groups()
+        groups[1].priority = -1
+        groups[1].save()
+        url = "/api/nodes/%s/explain/" % node.id
+        # Session, user, node, memberships and configurations
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        explanation = response.json()
+        self.assertEqual(explanation["certname"], node.certname)
+        self.assertEqual(
+            [group["label"] for group in explanation["groups"]], ["grupo02", "grupo01"]
+        )
+        self.assertEqual(explanation["environment"]["value"], "production")
+        parameters = explanation["classes"]["profile::tomcat"]["parameters"]
+        self.assertEqual(
+            parameters["user"],
+            {
+                "value": "user_grupo01",
+                "winner": {"id": str(groups[0].id), "label": "grupo01"},
+                "sources": [
+                    {
+                        "id": str(groups[1].id),
+                        "label": "grupo02",
+                        "value": "user_grupo02",
+                    },
+                    {
+                        "id": str(groups[0].id),
+                        "label": "grupo01",
+                        "value": "user_grupo01",
+                    },
+                ],
+            },
+        )
+        self.assertEqual(parameters["sensitive_password"]["value"], "[Sensitive]")
+
+        response = self.client.get("/api/nodes/%s/explain/" % uuid.uuid4())
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_empty_node(self):
         """
         A request of classification data to a node without classification
@@ -1789,6 +2679,39 @@ class NodesTests(BaseAPITestCase):
         expected_json = {"error": "Invalid certname or master_id parameters"}
         self.assertEqual(response.json(), expected_json)
 
+    def test_node_classifier_cache_headers(self):
+        """
+        The classification of known nodes should be cacheable by a shared
+        cache, tagged with the node key, without extra queries
+        """
+        node = self._create_conflicting_groups()[0]
+        url = "/api/nodes/node_classifier/?certname=%s&master_id=%s" % (
+            node.certname,
+            node.master_zone_id,
+        )
+        response = self.client.get(url)
+        self.assertIn("no-cache", response["Cache-Control"])
+        self.assertNotIn("Surrogate-Key", response)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+
+        with self.settings(CLASSIFIER_CACHE_MAX_AGE=300):
+            with self.assertNumQueries(len(queries)):
+                response = self.client.get(url)
+            self.assertEqual(
+                set(response["Cache-Control"].split(", ")),
+                {"public", "max-age=0", "s-maxage=300"},
+            )
+            self.assertIn("Authorization", response["Vary"])
+            self.assertEqual(response["Surrogate-Key"], "node-%s" % node.id)
+
+            response = self.client.get(
+                "/api/nodes/node_classifier/?certname=unknown&master_id=%s"
+                % node.master_zone_id
+            )
+            self.assertIn("no-cache", response["Cache-Control"])
+            self.assertNotIn("Surrogate-Key", response)
+
     def test_node_classifier_wrong_node(self):
         """
         Assert error message when endpoint called with non-existing node
@@ -1841,6 +2764,59 @@ class NodesTests(BaseAPITestCase):
         serializer = NodeClassifierSerializer(node)
         self.assertEqual(serializer.data["environment"], None)
 
+    def test_node_classifier_group_priority(self):
+        """
+        The environment and variables of the higher priority group should prevail
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        node = models.Node.objects.create(certname="1234.acme", master_zone=master_zone)
+        groups = []
+        for name in ("production", "staging"):
+            environment = models.Environment.objects.create(
+                name=name, master_zone=master_zone
+            )
+            group = models.Group.objects.create(
+                label="group_" + name,
+                description=name,
+                master_zone=master_zone,
+                environment=environment,
+            )
+            group.matching_nodes.set([node])
+            group.variable.data = {"stage": name, name: "yes"}
+            group.variable.save()
+            groups.append(group)
+
+        url = "/api/nodes/node_classifier/?certname=%s&master_id=%s" % (
+            node.certname,
+            master_zone.id,
+        )
+        # Same priority, the groups are merged by label
+        response = self.client.get(url)
+        expected_yaml = (
+            "classes:\n"
+            "environment: staging\n"
+            "parameters:\n"
+            "  production: 'yes'\n"
+            "  stage: staging\n"
+            "  staging: 'yes'\n"
+        )
+        self.assertEqual(response.content.decode("utf-8"), expected_yaml)
+
+        groups[0].priority = 10
+        groups[0].save()
+        response = self.client.get(url)
+        expected_yaml = (
+            "classes:\n"
+            "environment: production\n"
+            "parameters:\n"
+            "  production: 'yes'\n"
+            "  stage: production\n"
+            "  staging: 'yes'\n"
+        )
+        self.assertEqual(response.content.decode("utf-8"), expected_yaml)
+
 
 class FactTests(BaseAPITestCase):
     """
@@ -1886,6 +2862,29 @@ class FactTests(BaseAPITestCase):
         # Assert facts created
         self.assertEqual(models.Fact.objects.count(), 3)
 
+    def test_fact_search(self):
+        """
+        Should return the facts containing the text, prefixes first
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        for name in ("os", "kernel", "operatingsystem", "trusted.hostname"):
+            models.Fact.objects.create(name=name, master_zone=master_zone)
+        url = f"/api/facts/search/?master_zone={master_zone.id}&q=os"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "count": 2,
+                "results": [
+                    {"id": str(models.Fact.objects.get(name=name).id), "name": name}
+                    for name in ("os", "trusted.hostname")
+                ],
+            },
+        )
+
 
 class MasterZoneTests(BaseAPITestCase):
     """
@@ -1954,6 +2953,52 @@ class MasterZoneTests(BaseAPITestCase):
         remove(master_zone.signed_cert.path)
         remove(master_zone.private_key.path)
 
+    def test_master_list_environments_names(self):
+        """
+        A GET request to the masters endpoint should return the
+        environments names of each master
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="Splinter", address="http://10.10.10.10"
+        )
+        models.MasterZone.objects.create(label="Shredder", address="10.10.10.11")
+        for name in ("production", "homol"):
+            models.Environment.objects.create(name=name, master_zone=master_zone)
+        url = "/api/master_zones/"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        environments_names = {
+            master["label"]: sorted(master["environments_names"])
+            for master in response.json()
+        }
+        self.assertDictEqual(
+            environments_names, {"Splinter": ["homol", "production"], "Shredder": []}
+        )
+
+    def test_master_list_num_queries(self):
+        """
+        Listing the masters should cost a constant number of queries,
+        regardless of the number of masters and environments
+        """
+        for i in range(100):
+            master_zone = models.MasterZone.objects.create(
+                label=f"Master {i}", address=f"10.10.10.{i}"
+            )
+            models.Environment.objects.create(
+                name="production", master_zone=master_zone
+            )
+            models.Environment.objects.create(name="homol", master_zone=master_zone)
+        url = "/api/master_zones/"
+        # Session, user and master zones queries
+        with self.assertNumQueries(3):
+            response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 100)
+        for master in response.json():
+            self.assertEqual(
+                sorted(master["environments_names"]), ["homol", "production"]
+            )
+
     def test_register_master(self):
         """
         A POST request to the masters endpoint should register
@@ -1,4 +1,7 @@
 import faktory
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import transaction
+from django.db.models import Prefetch, Q
 from django.http import JsonResponse
 from django.core.exceptions import ValidationError
 from rest_framework import status, viewsets
@@ -6,6 +9,8 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework_yaml.renderers import YAMLRenderer
 from rest_framework_yaml.encoders import SafeDumper
+from core import cache as reference_cache
+from core import http_cache
 from core.models import (
     MasterZone,
     Environment,
@@ -15,24 +20,75 @@ from core.models import (
     Parameter,
     Group,
     Configuration,
+    ConfigurationClass,
+    ConfigurationParameter,
     Rule,
     Variable,
+    NodeClassification,
 )
+from api.pagination import OptionalCursorPagination
+from api.search import TypeaheadSearchMixin
+from api.streaming import StreamingListMixin
 from api.serializers import (
     EnvironmentSerializer,
     MasterZoneSerializer,
     FactSerializer,
+    FactSyncSerializer,
     NodeSerializer,
+    NodeSyncSerializer,
     PuppetClassSerializer,
+    PuppetClassTreeSerializer,
     ParameterSerializer,
     ConfigurationSerializer,
     RuleSerializer,
     VariableSerializer,
     GroupSerializer,
     NodeClassifierSerializer,
+    NodeConflictsSerializer,
 )
 
 
+def usage_rows(queryset, configuration_field, environment_field, *fields):
+    """
+    Returns the given fields of the queryset rows followed by the id, label,
+    priority, environment and number of nodes of the group they belong to,
+    ordered by environment and Group.PRECEDENCE
+    """
+    group_field = configuration_field + "__group"
+    return queryset.order_by(
+        environment_field,
+        *("%s__%s" % (group_field, field) for field in Group.PRECEDENCE)
+    ).values_list(
+        *fields,
+        configuration_field,
+        group_field + "__label",
+        group_field + "__priority",
+        environment_field,
+        group_field + "__nodes_count"
+    )
+
+
+def usage_group(group_id, label, priority, environment, nodes):
+    """
+    Group of a usage_rows row, as listed by the usage endpoints
+    """
+    return {
+        "id": group_id,
+        "label": label,
+        "priority": priority,
+        "environment": environment,
+        "nodes": nodes,
+    }
+
+
+def all_environments(request):
+    """
+    Whether the usage of a class or parameter is asked for every environment
+    of its master zone (?environments=all), instead of its own environment
+    """
+    return request.query_params.get("environments") == "all"
+
+
 def represent_none(self, _):
     return self.represent_scalar("tag:yaml.org,2002:null", "")
 
@@ -40,14 +96,20 @@ def represent_none(self, _):
 SafeDumper.add_representer(type(None), represent_none)
 
 
-class EnvironmentViewSet(viewsets.ModelViewSet):
+class EnvironmentViewSet(StreamingListMixin, viewsets.ModelViewSet):
     queryset = Environment.objects.all()
     serializer_class = EnvironmentSerializer
-    pagination_class = None
+    pagination_class = OptionalCursorPagination
 
 
 class MasterZoneViewSet(viewsets.ModelViewSet):
-    queryset = MasterZone.objects.all()
+    # Aggregate the environments names in the same query as the master zones,
+    # avoiding one extra query per master zone when listing
+    queryset = MasterZone.objects.annotate(
+        environments_names=ArrayAgg(
+            "environment__name", filter=Q(environment__isnull=False)
+        )
+    )
     serializer_class = MasterZoneSerializer
     pagination_class = None
 
@@ -94,26 +156,30 @@ class MasterZoneViewSet(viewsets.ModelViewSet):
         except MasterZone.DoesNotExist:
             return Response({"failure": "Master Zone does not exist"})
 
-        for name in data["environments"]:
-            env, _ = Environment.objects.get_or_create(
-                name=name, master_zone=master_zone
-            )
+        # Skips the existing environments (ON CONFLICT DO NOTHING)
+        Environment.objects.bulk_create(
+            [
+                Environment(name=name, master_zone=master_zone)
+                for name in data["environments"]
+            ],
+            ignore_conflicts=True,
+        )
+        # bulk_create sends no signals
+        reference_cache.invalidate_on_commit(reference_cache.ENVIRONMENTS)
 
         return Response({"status": "ok"})
 
 
-class FactViewSet(viewsets.ModelViewSet):
+class FactViewSet(TypeaheadSearchMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = Fact.objects.all()
     serializer_class = FactSerializer
-    pagination_class = None
+    pagination_class = OptionalCursorPagination
     filter_fields = ("master_zone",)
+    typeahead_field = "name"
 
-    @action(methods=["post"], detail=False)
+    @action(methods=["post"], detail=False, serializer_class=FactSyncSerializer)
     def sync(self, request):
-        data = [
-            fact for fact in request.data if not Fact.objects.filter(**fact).exists()
-        ]
-        serializer = self.get_serializer(data=data, many=True)
+        serializer = self.get_serializer(data=request.data, many=True)
         if serializer.is_valid():
             serializer.save()
             return Response({"status": "ok"})
@@ -121,20 +187,22 @@ class FactViewSet(viewsets.ModelViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class NodeViewSet(viewsets.ModelViewSet):
+class NodeViewSet(TypeaheadSearchMixin, StreamingListMixin, viewsets.ModelViewSet):
     queryset = Node.objects.all()
     serializer_class = NodeSerializer
-    pagination_class = None
+    pagination_class = OptionalCursorPagination
     filter_fields = ("master_zone",)
+    typeahead_field = "certname"
 
-    @action(methods=["post"], detail=False)
+    @action(methods=["post"], detail=False, serializer_class=NodeSyncSerializer)
     def sync(self, request):
-        data = [
-            node for node in request.data if not Node.objects.filter(**node).exists()
-        ]
-        serializer = self.get_serializer(data=data, many=True)
+        serializer = self.get_serializer(data=request.data, many=True)
         if serializer.is_valid():
             serializer.save()
+            # bulk_create sends no signals
+            MasterZone.refresh_counters(
+                {node["master_zone"].pk for node in serializer.validated_data}
+            )
             return Response({"status": "ok"})
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -150,7 +218,9 @@ class NodeViewSet(viewsets.ModelViewSet):
         master_id = request.query_params.get("master_id", "")
         error_message = ""
         try:
-            node = Node.objects.get(certname=certname, master_zone__id=master_id)
+            node = Node.objects.select_related("classification").get(
+                certname=certname, master_zone__id=master_id
+            )
         except Node.DoesNotExist:
             # Instantiate a dummy node to produce an empty answer
             node = Node()
@@ -166,56 +236,225 @@ class NodeViewSet(viewsets.ModelViewSet):
         response = Response(serializer.data, content_type="text/yaml")
         cd = 'attachment; filename="%s_classifier.yml"' % node.certname
         response["Content-Disposition"] = cd
-        return response
+        return http_cache.classifier_headers(response, node)
+
+    @action(methods=["get"], detail=True)
+    def explain(self, request, pk=None):
+        """
+        Explains the classification of the node: the environment, variables,
+        classes and parameters set by each of its groups, and which group
+        prevails for each one (the last of the sources)
+        Sensitive values are shown as "[Sensitive]"
+        """
+        node = self.get_object()
+        return Response(
+            {
+                "id": node.pk,
+                "certname": node.certname,
+                "master_zone": node.master_zone_id,
+                **NodeClassification.explain(node),
+            }
+        )
+
+    @action(methods=["get"], detail=False, serializer_class=NodeConflictsSerializer)
+    def conflicts(self, request):
+        """
+        Lists the nodes with parameters set with different values by more
+        than one of their groups, and which group prevails for each one
+
+        ***
+            ?master_zone=<id>
+            Only nodes of the master zone
+            ?certname=<certname>
+            Only the given node
+        ***
+        """
+        queryset = (
+            NodeClassification.objects.filter(conflicts__isnull=False)
+            .select_related("node")
+            .order_by("node__certname")
+        )
+        master_zone = request.query_params.get("master_zone")
+        if master_zone:
+            queryset = queryset.filter(node__master_zone_id=master_zone)
+        certname = request.query_params.get("certname")
+        if certname:
+            queryset = queryset.filter(node__certname=certname)
+        try:
+            serializer = self.get_serializer(queryset, many=True)
+            return Response(serializer.data)
+        except ValidationError:
+            return JsonResponse(
+                {"error": "Invalid master_zone parameter"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
 
-class PuppetClassViewSet(viewsets.ReadOnlyModelViewSet):
+class PuppetClassViewSet(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     queryset = PuppetClass.objects.all()
     serializer_class = PuppetClassSerializer
-    pagination_class = None
+    pagination_class = OptionalCursorPagination
     filter_fields = ("environment",)
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "usage":
+            queryset = queryset.select_related("environment")
+        return queryset
+
+    @action(methods=["get"], detail=True)
+    def usage(self, request, pk=None):
+        """
+        Lists the groups configuring the class, with the raw values they set
+        for its parameters and their number of matching nodes
+
+        ***
+            ?environments=all
+            Also the classes with the same name in the other environments
+            of the master zone
+        ***
+        """
+        puppet_class = self.get_object()
+        if all_environments(request):
+            classes = PuppetClass.objects.filter(
+                name=puppet_class.name,
+                environment__master_zone_id=puppet_class.environment.master_zone_id,
+            )
+        else:
+            classes = PuppetClass.objects.filter(pk=puppet_class.pk)
+
+        groups = {}
+        for config_class_id, *fields in usage_rows(
+            ConfigurationClass.objects.filter(puppet_class__in=classes),
+            "configuration",
+            "puppet_class__environment__name",
+            "pk",
+        ):
+            groups[config_class_id] = dict(usage_group(*fields), parameters={})
+        for config_class_id, name, raw_value in (
+            ConfigurationParameter.objects.filter(configuration_class_id__in=groups)
+            .order_by("parameter__name")
+            .values_list("configuration_class_id", "parameter__name", "raw_value")
+        ):
+            groups[config_class_id]["parameters"][name] = raw_value
+        groups = list(groups.values())
+
+        return Response(
+            {
+                "id": puppet_class.pk,
+                "name": puppet_class.name,
+                "environment": puppet_class.environment.name,
+                "count": len(groups),
+                "groups": groups,
+            }
+        )
+
     @action(methods=["post"], detail=False)
     def sync(self, request):
-        for class_def in request.data:
-            environment, _ = Environment.objects.get_or_create(
-                name=class_def["environment"], master_zone_id=class_def["master"]
-            )
-            ppclass, _ = PuppetClass.objects.get_or_create(
-                name=class_def["name"], environment=environment
+        # The inserts skip the existing rows (ON CONFLICT DO NOTHING)
+        with transaction.atomic(), NodeClassification.deferred_refresh():
+            Environment.objects.bulk_create(
+                [
+                    Environment(
+                        name=class_def["environment"],
+                        master_zone_id=class_def["master"],
+                    )
+                    for class_def in request.data
+                ],
+                ignore_conflicts=True,
             )
-            param_names = [param["name"] for param in class_def["params"]]
-            for param in class_def["params"]:
-                Parameter.objects.get_or_create(
-                    name=param["name"],
-                    puppet_class=ppclass,
-                    defaults={
-                        "value_type": param["type"],
-                        "value_default": param.get("default_source", ""),
+            # bulk_create sends no signals
+            reference_cache.invalidate_on_commit(reference_cache.ENVIRONMENTS)
+            environments = {
+                (str(env.master_zone_id), env.name): env
+                for env in Environment.objects.filter(
+                    master_zone_id__in={
+                        class_def["master"] for class_def in request.data
                     },
+                    name__in={class_def["environment"] for class_def in request.data},
                 )
-            Parameter.objects.filter(puppet_class=ppclass).exclude(
-                name__in=param_names
-            ).delete()
-        if any(request.data):
-            env_names = (class_def["environment"] for class_def in request.data)
-            master_zone = request.data[0]["master"]
-            for env_name in env_names:
-                class_names = (
-                    class_def["name"]
+            }
+
+            def environment_of(class_def):
+                return environments[
+                    (str(class_def["master"]), class_def["environment"])
+                ]
+
+            PuppetClass.objects.bulk_create(
+                [
+                    PuppetClass(
+                        name=class_def["name"], environment=environment_of(class_def)
+                    )
                     for class_def in request.data
-                    if class_def["environment"] == env_name
+                ],
+                ignore_conflicts=True,
+            )
+            ppclasses = {
+                (ppclass.environment_id, ppclass.name): ppclass
+                for ppclass in PuppetClass.objects.filter(
+                    environment__in=environments.values(),
+                    name__in={class_def["name"] for class_def in request.data},
                 )
-                environment = Environment.objects.get(
-                    name=env_name, master_zone_id=master_zone
+            }
+
+            def ppclass_of(class_def):
+                return ppclasses[(environment_of(class_def).pk, class_def["name"])]
+
+            params = [
+                Parameter(
+                    name=param["name"],
+                    puppet_class=ppclass_of(class_def),
+                    value_type=param["type"],
+                    value_default=param.get("default_source", ""),
                 )
-                PuppetClass.objects.filter(environment=environment).exclude(
-                    name__in=class_names
-                ).delete()
+                for class_def in request.data
+                for param in class_def["params"]
+            ]
+            for param in params:
+                param.parse_value_type()
+            Parameter.objects.bulk_create(params, ignore_conflicts=True)
+            # Remove the parameters that are not in the classes anymore
+            param_names = {
+                (ppclass_of(class_def).pk, param["name"])
+                for class_def in request.data
+                for param in class_def["params"]
+            }
+            Parameter.objects.filter(
+                pk__in=[
+                    pk
+                    for pk, ppclass_id, name in Parameter.objects.filter(
+                        puppet_class__in=ppclasses.values()
+                    ).values_list("pk", "puppet_class_id", "name")
+                    if (ppclass_id, name) not in param_names
+                ]
+            ).delete()
+
+            # The bulk queries skip the signal receivers
+            reference_cache.invalidate_on_commit(
+                *(
+                    reference_cache.puppet_classes(env.pk)
+                    for env in environments.values()
+                )
+            )
+
+            # Remove the classes that are not in the environments anymore
+            class_names = {
+                (environment_of(class_def).pk, class_def["name"])
+                for class_def in request.data
+            }
+            PuppetClass.objects.filter(
+                pk__in=[
+                    pk
+                    for pk, environment_id, name in PuppetClass.objects.filter(
+                        environment__in=environments.values()
+                    ).values_list("pk", "environment_id", "name")
+                    if (environment_id, name) not in class_names
+                ]
+            ).delete()
         return Response({"status": "ok"})
 
 
-class ParameterViewSet(viewsets.ReadOnlyModelViewSet):
+class ParameterViewSet(StreamingListMixin, viewsets.ReadOnlyModelViewSet):
     """
     Additional endpoint
 
@@ -223,13 +462,68 @@ class ParameterViewSet(viewsets.ReadOnlyModelViewSet):
         /types
         Parameter possible types, followed by a boolean value
         that indicates if the type needs a 'values' field or not
+        /<id>/usage
+        Groups overriding the parameter default value
     ***
     """
     queryset = Parameter.objects.all()
     serializer_class = ParameterSerializer
-    pagination_class = None
+    pagination_class = OptionalCursorPagination
     filter_fields = ("puppet_class",)
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "usage":
+            queryset = queryset.select_related("puppet_class__environment")
+        return queryset
+
+    @action(methods=["get"], detail=True)
+    def usage(self, request, pk=None):
+        """
+        Lists the groups overriding the default value of the parameter, with
+        the raw value each one sets and its number of matching nodes
+
+        ***
+            ?environments=all
+            Also the parameters of the classes with the same name in the
+            other environments of the master zone
+        ***
+        """
+        parameter = self.get_object()
+        puppet_class = parameter.puppet_class
+        if all_environments(request):
+            parameters = Parameter.objects.filter(
+                name=parameter.name,
+                puppet_class__name=puppet_class.name,
+                puppet_class__environment__master_zone_id=(
+                    puppet_class.environment.master_zone_id
+                ),
+            )
+        else:
+            parameters = Parameter.objects.filter(pk=parameter.pk)
+
+        groups = [
+            dict(usage_group(*fields), raw_value=raw_value)
+            for raw_value, *fields in usage_rows(
+                ConfigurationParameter.objects.filter(parameter__in=parameters),
+                "configuration_class__configuration",
+                "parameter__puppet_class__environment__name",
+                "raw_value",
+            )
+        ]
+
+        return Response(
+            {
+                "id": parameter.pk,
+                "name": parameter.name,
+                "puppet_class": puppet_class.name,
+                "environment": puppet_class.environment.name,
+                "default": parameter.value_default,
+                "count": len(groups),
+                "groups": groups,
+            }
+        )
+
     @action(methods=["get"], url_path="types", detail=False)
     def types(self, request):
         types = dict((t, False) for _, t in Parameter.CORE_DATA_TYPES)
@@ -242,6 +536,40 @@ class ConfigurationViewSet(viewsets.ModelViewSet):
     serializer_class = ConfigurationSerializer
     pagination_class = None
 
+    @action(methods=["get"], detail=True)
+    def tree(self, request, pk=None):
+        """
+        Returns, in a single response, the classes of the group environment
+        with their parameters and the classes configured in the group
+
+        The environment classes are cached until the next change of its
+        classes or parameters (e.g. by a sync)
+        """
+        configuration = self.get_object()
+        environment_id = configuration.group.environment_id
+
+        def environment_classes():
+            queryset = (
+                PuppetClass.objects.filter(environment_id=environment_id)
+                .order_by("name")
+                .prefetch_related(
+                    Prefetch("parameters", queryset=Parameter.objects.order_by("name"))
+                )
+            )
+            return list(PuppetClassTreeSerializer(queryset, many=True).data)
+
+        return Response(
+            {
+                "environment": environment_id,
+                "classes": reference_cache.get_or_set(
+                    reference_cache.puppet_classes(environment_id),
+                    "tree",
+                    environment_classes,
+                ),
+                "configuration": self.get_serializer(configuration).data["classes"],
+            }
+        )
+
 
 class RuleViewSet(viewsets.ModelViewSet):
     queryset = Rule.objects.all()
@@ -274,6 +602,48 @@ class VariableViewSet(viewsets.ModelViewSet):
 
 
 class GroupViewSet(viewsets.ModelViewSet):
+    """
+    Optional query parameters
+
+    ***
+        fields
+        Comma separated list of the fields to be returned
+        cursor, page_size
+        Paginate the results using cursor (keyset) pagination
+        search
+        Groups with the words in their label, tags or description, ranked
+        by relevance (the cursor pagination keeps its own ordering)
+        tags
+        Comma separated list of tags, groups with any of them
+    ***
+    """
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
-    pagination_class = None
+    pagination_class = OptionalCursorPagination
+
+    def get_queryset(self):
+        """
+        Prefetch the tags, unless omitted by `fields`
+        The matching nodes are write only, so they are never prefetched
+        """
+        queryset = super().get_queryset()
+        fields = self.request.query_params.get("fields")
+        if fields and self.request.method == "GET":
+            selected = set(fields.split(","))
+        else:
+            selected = {"tags_list"}
+        if "tags_list" in selected:
+            queryset = queryset.prefetch_related("tags")
+        if self.action == "list":
+            tags = self.request.query_params.get("tags")
+            if tags:
+                queryset = queryset.filter(tag_names__overlap=tags.split(","))
+            search = self.request.query_params.get("search")
+            if search:
+                queryset = Group.search(queryset, search)
+        return queryset
+
+    def perform_update(self, serializer):
+        # The group and its new matching nodes refresh each node only once
+        with NodeClassification.deferred_refresh():
+            serializer.save()
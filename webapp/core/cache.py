@@ -0,0 +1,78 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+# Namespaces of the cached reference data, each one invalidated as a whole
+MASTER_ZONES = "master_zones"
+ENVIRONMENTS = "environments"
+TAGS = "tags"
+
+
+def puppet_classes(environment_id):
+    """
+    Namespace of the classes and parameters of an environment, invalidated
+    when they are synced
+    """
+    return "puppet_classes:%s" % environment_id
+
+
+def _version_key(namespace):
+    return "reference-version:%s" % namespace
+
+
+def _new_version():
+    # Time based, so a version lost by the cache backend is never reused
+    return int(time.time() * 1000)
+
+
+def get_version(namespace):
+    """
+    Returns the current version of the keys of the namespace
+    """
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key, _new_version())
+    return version
+
+
+def get_or_set(namespace, key, default, timeout=None):
+    """
+    Returns the cached value of the key in the namespace, computing it with the
+    default callable when missing or invalidated
+    Always computed when the cache backend is not shared by the processes
+    """
+    if not settings.REFERENCE_CACHE_ENABLED:
+        return default()
+    return cache.get_or_set(
+        "reference:%s:%s" % (namespace, key),
+        default,
+        settings.REFERENCE_CACHE_TIMEOUT if timeout is None else timeout,
+        version=get_version(namespace),
+    )
+
+
+def invalidate(*namespaces):
+    """
+    Invalidates all the keys of the namespaces by bumping their version
+    """
+    if not settings.REFERENCE_CACHE_ENABLED:
+        return
+    for namespace in namespaces:
+        key = _version_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
+
+
+def invalidate_on_commit(*namespaces):
+    """
+    Invalidates the namespaces now and again after the current transaction
+    commits, since values computed meanwhile may be read from the old data
+    """
+    invalidate(*namespaces)
+    transaction.on_commit(lambda: invalidate(*namespaces))
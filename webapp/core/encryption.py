@@ -0,0 +1,102 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.encoding import force_text
+
+from fernet_fields import EncryptedTextField
+
+
+class EncryptedToken(bytes):
+    """
+    Fernet token read from the database, not decrypted yet
+    """
+
+
+class LazyEncryptedTextField(EncryptedTextField):
+    """
+    EncryptedTextField that leaves the decryption to the model
+
+    Values loaded from the database are kept as EncryptedToken, so the model
+    can decrypt them through the DecryptedValueCache, which needs the row id
+    Note that values() and values_list() return the EncryptedToken
+    """
+
+    def from_db_value(self, value, expression, connection, *args):
+        if value is not None:
+            return EncryptedToken(value)
+
+    def decrypt(self, token):
+        decrypt_counter.increment()
+        return self.to_python(force_text(self.fernet.decrypt(bytes(token))))
+
+
+class DecryptCounter(threading.local):
+    """
+    Number of decryptions done by the current thread, reset on each request
+    by core.middleware.DecryptMetricsMiddleware
+    """
+
+    calls = 0
+
+    def increment(self):
+        self.calls += 1
+
+    def reset(self):
+        self.calls = 0
+
+
+decrypt_counter = DecryptCounter()
+
+
+class DecryptedValueCache:
+    """
+    In-process LRU cache of decrypted values, never persisted
+
+    Entries are keyed by (row id, ciphertext hash), so a row whose ciphertext
+    changed misses the cache even if it was not invalidated. At most
+    SENSITIVE_VALUE_CACHE_SIZE entries are kept, for at most
+    SENSITIVE_VALUE_CACHE_TTL seconds (0 disables the cache)
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_decrypt(self, row_id, token, field):
+        ttl = settings.SENSITIVE_VALUE_CACHE_TTL
+        max_size = settings.SENSITIVE_VALUE_CACHE_SIZE
+        if ttl <= 0 or max_size <= 0:
+            return field.decrypt(token)
+
+        digest = hashlib.sha256(token).digest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(row_id)
+            if entry is not None and entry[0] == digest and entry[2] > now:
+                self._entries.move_to_end(row_id)
+                return entry[1]
+
+        value = field.decrypt(token)
+        with self._lock:
+            self._entries[row_id] = (digest, value, now + ttl)
+            self._entries.move_to_end(row_id)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, row_id):
+        with self._lock:
+            self._entries.pop(row_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+sensitive_value_cache = DecryptedValueCache()
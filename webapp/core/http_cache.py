@@ -0,0 +1,72 @@
+import logging
+import urllib.request
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.cache import (
+    add_never_cache_headers,
+    patch_cache_control,
+    patch_vary_headers,
+)
+
+logger = logging.getLogger(__name__)
+
+# Keys sent by each purge request, keeping its header short
+PURGE_BATCH_SIZE = 100
+
+
+def node_key(node_id):
+    return "node-%s" % node_id
+
+
+def classifier_headers(response, node):
+    """
+    Lets a shared HTTP cache keep the classification of a known node for
+    CLASSIFIER_CACHE_MAX_AGE seconds, tagged with the surrogate key of the
+    node, which is purged whenever its classification changes
+    The agents themselves always revalidate, and the entries are only
+    served to requests with the same credentials
+    """
+    if not settings.CLASSIFIER_CACHE_MAX_AGE or node._state.adding:
+        # Unknown nodes have no key to be purged by, once they are synced
+        add_never_cache_headers(response)
+        return response
+
+    patch_cache_control(
+        response, public=True, max_age=0, s_maxage=settings.CLASSIFIER_CACHE_MAX_AGE
+    )
+    patch_vary_headers(response, ("Authorization",))
+    response[settings.SURROGATE_KEY_HEADER] = node_key(node.pk)
+    return response
+
+
+def purge(keys):
+    """
+    Purges the responses tagged with the surrogate keys from the shared HTTP
+    cache at CACHE_PURGE_URL, once the current transaction commits
+    """
+    keys = sorted(set(keys))
+    if not settings.CACHE_PURGE_URL or not keys:
+        return
+    transaction.on_commit(lambda: send_purges(keys))
+
+
+def send_purges(keys):
+    """
+    Sends the purge requests, a failed purge leaves the responses cached
+    until they expire
+    """
+    for start in range(0, len(keys), PURGE_BATCH_SIZE):
+        end = start + PURGE_BATCH_SIZE
+        batch = keys[start:end]
+        request = urllib.request.Request(
+            settings.CACHE_PURGE_URL,
+            method=settings.CACHE_PURGE_METHOD,
+            headers={settings.SURROGATE_KEY_HEADER: " ".join(batch)},
+        )
+        try:
+            urllib.request.urlopen(
+                request, timeout=settings.CACHE_PURGE_TIMEOUT
+            ).close()
+        except (OSError, ValueError) as error:
+            logger.warning("Purge of %d cache keys failed: %s", len(batch), error)
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import UserLog
+
+
+class Command(BaseCommand):
+    help = "Removes the user logs older than USERLOG_RETENTION_DAYS"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.USERLOG_RETENTION_DAYS,
+            help="Retention period in days (0 keeps all the logs)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="How many logs are removed per DELETE statement",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] <= 0:
+            self.stdout.write("Retention disabled, no logs removed")
+            return
+        deleted = UserLog.purge(options["days"], batch_size=options["batch_size"])
+        self.stdout.write("Removed %d logs" % deleted)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Group, MasterZone, Node
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the nodes of the groups and master zones and the groups of the nodes"
+    )
+
+    def handle(self, *args, **options):
+        fixed = (
+            Group.refresh_counters(),
+            Node.refresh_counters(),
+            MasterZone.refresh_counters(),
+        )
+        self.stdout.write(
+            "Fixed the counters of %d groups, %d nodes and %d master zones" % fixed
+        )
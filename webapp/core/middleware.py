@@ -1,7 +1,21 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import connection, connections, transaction
+from django.utils import timezone
 from django.utils.deprecation import MiddlewareMixin
+from core.encryption import decrypt_counter
 from core.models import UserLog
+from core.routers import replica_state
 from django.conf import settings
 
+logger = logging.getLogger(__name__)
+
 
 def get_client_ip(request):
     """
@@ -19,6 +33,97 @@ def get_client_ip(request):
     return ip
 
 
+class UserLogBuffer:
+    """
+    In-process buffer of user activity logs
+    The logs are written with a single bulk_create when USERLOG_BATCH_SIZE
+    logs are pending, or by a background thread every USERLOG_FLUSH_INTERVAL
+    seconds. Pending logs are also written when the process exits (see the
+    worker_exit hook of gunicorn.conf.py)
+    Logs that could not be written are kept for the next flush, up to
+    max_pending_batches batches
+    """
+
+    max_pending_batches = 100
+
+    def __init__(self):
+        self._logs = []
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def __len__(self):
+        return len(self._logs)
+
+    def append(self, log):
+        with self._lock:
+            self._logs.append(log)
+            pending = len(self._logs)
+
+        if pending >= settings.USERLOG_BATCH_SIZE:
+            self.try_flush()
+        else:
+            self._start_flusher()
+
+    def flush(self):
+        """
+        Writes the pending logs, they are put back in the buffer if the write
+        fails and the error is raised
+        """
+        with self._lock:
+            logs, self._logs = self._logs, []
+        if not logs:
+            return
+        try:
+            # A savepoint, so a failure doesn't break the caller transaction
+            with transaction.atomic():
+                UserLog.objects.bulk_create(logs)
+        except Exception:
+            with self._lock:
+                self._logs[:0] = logs
+                excess = len(self._logs) - (
+                    self.max_pending_batches * settings.USERLOG_BATCH_SIZE
+                )
+                if excess > 0:
+                    del self._logs[:excess]
+            if excess > 0:
+                logger.error("Dropped %d user logs that could not be written", excess)
+            raise
+
+    def try_flush(self):
+        """
+        Writes the pending logs, only logging the errors
+        Used by the requests and the background thread, which must not fail
+        because of the user logs
+        """
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not write the user logs")
+
+    def _start_flusher(self):
+        if settings.USERLOG_FLUSH_INTERVAL <= 0:
+            return
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(
+                    target=self._run_flusher, name="userlog-flusher", daemon=True
+                )
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(settings.USERLOG_FLUSH_INTERVAL)
+            try:
+                self.try_flush()
+            finally:
+                # The thread is not a request, so Django won't close its connection
+                connection.close()
+
+
+user_log_buffer = UserLogBuffer()
+atexit.register(user_log_buffer.try_flush)
+
+
 class UserLogMiddleware(MiddlewareMixin):
     """
     Middleware generates user activity logs
@@ -35,11 +140,100 @@ class UserLogMiddleware(MiddlewareMixin):
         else:
             user = None
 
-        UserLog.objects.create(
-            user=user,
-            request_path=request.path,
-            request_method=request.method,
-            response_code=response.status_code,
-            ip_address=get_client_ip(request),
+        user_log_buffer.append(
+            UserLog(
+                user=user,
+                request_path=request.path,
+                request_method=request.method,
+                response_code=response.status_code,
+                datetime=timezone.now(),
+                ip_address=get_client_ip(request),
+            )
         )
         return response
+
+
+class DecryptMetricsMiddleware(MiddlewareMixin):
+    """
+    Middleware counts the sensitive values decrypted by each request
+    The count is logged, and returned in the X-Decrypt-Calls header in DEBUG
+    """
+
+    def process_request(self, request):
+        decrypt_counter.reset()
+
+    def process_response(self, request, response):
+        calls = decrypt_counter.calls
+        if settings.DEBUG:
+            response["X-Decrypt-Calls"] = str(calls)
+        if calls:
+            logger.debug(
+                "%s %s decrypted %d values", request.method, request.path, calls
+            )
+        return response
+
+
+class DatabaseHealthCheckMiddleware(MiddlewareMixin):
+    """
+    Middleware checks the persistent database connections before each request
+    Broken connections (e.g. after a database or pooler restart) are closed,
+    so the request opens a new one instead of failing
+    Only enabled by DB_CONN_HEALTH_CHECKS, since it costs a round trip
+    """
+
+    def __init__(self, get_response=None):
+        if not settings.DB_CONN_HEALTH_CHECKS:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+
+    def process_request(self, request):
+        for conn in connections.all():
+            if conn.connection is not None and not conn.is_usable():
+                logger.warning("Closing unusable database connection %s", conn.alias)
+                conn.close()
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    """
+    Middleware allows the reads of read-only requests to go to the replicas
+    Clients are kept on the default database for REPLICA_STICKY_SECONDS
+    after their own writes, so they read what they have just written
+    Clients are identified by their credentials or by their session user
+    The writes are tracked in the cache, so it must be shared by all the
+    processes for a client to read its writes from any of them
+    """
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response=None):
+        if settings.REPLICA_DATABASES and not settings.CACHE_SHARED:
+            raise ImproperlyConfigured(
+                "The read replicas need a cache backend shared by all the "
+                "processes (CACHE_BACKEND and CACHE_LOCATION)"
+            )
+        super().__init__(get_response)
+
+    def _client_key(self, request):
+        authorization = request.META.get("HTTP_AUTHORIZATION")
+        if authorization:
+            digest = hashlib.sha256(authorization.encode()).hexdigest()
+            return "replica-sticky:auth:" + digest
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            return "replica-sticky:user:%s" % user.pk
+        return None
+
+    def process_request(self, request):
+        replica_state.use_replicas = False
+        if not settings.REPLICA_DATABASES or request.method not in self.SAFE_METHODS:
+            return
+        key = self._client_key(request)
+        replica_state.use_replicas = key is None or cache.get(key) is None
+
+    def process_response(self, request, response):
+        replica_state.use_replicas = False
+        if settings.REPLICA_DATABASES and request.method not in self.SAFE_METHODS:
+            key = self._client_key(request)
+            if key is not None:
+                cache.set(key, True, settings.REPLICA_STICKY_SECONDS)
+        return response
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userlog',
+            name='datetime',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
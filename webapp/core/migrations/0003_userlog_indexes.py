@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_userlog_datetime_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userlog',
+            index=models.Index(fields=['-datetime', '-id'], name='userlog_datetime_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userlog',
+            index=models.Index(fields=['user', '-datetime'], name='userlog_user_datetime_idx'),
+        ),
+    ]
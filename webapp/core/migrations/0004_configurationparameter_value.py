@@ -0,0 +1,81 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:08
+
+import ast
+import json
+import logging
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+
+def decode_value(parameter, config_param):
+    """
+    Returns the decoded value of a non sensitive ConfigurationParameter
+    Frozen copy of core.models.decode_value, as it was when this migration
+    was written
+    """
+    typed_values = {
+        "Boolean": config_param.boolean_value,
+        "Float": config_param.float_value,
+        "Integer": config_param.integer_value,
+        "String": config_param.string_value,
+    }
+    value = typed_values.get(parameter.value_type)
+    if value is None:
+        if parameter.value_type in ("Hash", "Array"):
+            value = ast.literal_eval(config_param.raw_value)
+        elif parameter.value_type == "Optional":
+            value = typed_values.get(parameter.values, config_param.raw_value)
+        else:
+            value = config_param.raw_value
+    return value
+
+
+def backfill_value(apps, schema_editor):
+    """
+    Stores the decoded value of the existing non sensitive parameters
+    Malformed legacy values, and the ones JSON can not store unchanged, are
+    left null
+    """
+    ConfigurationParameter = apps.get_model("core", "ConfigurationParameter")
+    queryset = ConfigurationParameter.objects.filter(
+        sensitive_value__isnull=True
+    ).select_related("parameter")
+
+    batch = []
+    for config_param in queryset.iterator(chunk_size=1000):
+        try:
+            value = decode_value(config_param.parameter, config_param)
+            if json.loads(json.dumps(value, allow_nan=False)) != value:
+                raise ValueError("Not stored unchanged as JSON")
+        except (ValueError, SyntaxError, TypeError):
+            logger.warning(
+                "Could not decode the value of ConfigurationParameter %s: %r",
+                config_param.pk,
+                config_param.raw_value,
+            )
+            continue
+        config_param.value = value
+        batch.append(config_param)
+        if len(batch) == 1000:
+            ConfigurationParameter.objects.bulk_update(batch, ["value"])
+            batch = []
+    ConfigurationParameter.objects.bulk_update(batch, ["value"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_userlog_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configurationparameter',
+            name='value',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_value, migrations.RunPython.noop),
+    ]
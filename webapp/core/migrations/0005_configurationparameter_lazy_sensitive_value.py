@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:12
+
+import core.encryption
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("core", "0004_configurationparameter_value")]
+
+    operations = [
+        migrations.AlterField(
+            model_name="configurationparameter",
+            name="sensitive_value",
+            field=core.encryption.LazyEncryptedTextField(blank=True, null=True),
+        )
+    ]
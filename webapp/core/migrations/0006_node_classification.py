@@ -0,0 +1,55 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:14
+
+import django.contrib.postgres.fields.hstore
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_classification(apps, schema_editor):
+    """
+    Merges the environment and variables of the groups of the existing nodes
+    Same as NodeClassification.refresh, against the historical models
+    """
+    Group = apps.get_model("core", "Group")
+    NodeClassification = apps.get_model("core", "NodeClassification")
+    memberships = Group.matching_nodes.through.objects.order_by(
+        "node_id", "group__priority", "group__label", "group_id"
+    ).values_list("node_id", "group__environment__name", "group__variable__data")
+
+    classifications = {}
+    for node_id, environment, data in memberships.iterator(chunk_size=2000):
+        if node_id not in classifications:
+            classifications[node_id] = NodeClassification(
+                node_id=node_id, parameters={}
+            )
+        classification = classifications[node_id]
+        classification.environment = environment
+        if data:
+            classification.parameters.update(data)
+    NodeClassification.objects.bulk_create(
+        classifications.values(), batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_configurationparameter_lazy_sensitive_value'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeClassification',
+            fields=[
+                ('node', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='classification', serialize=False, to='core.Node')),
+                ('environment', models.CharField(max_length=255, null=True)),
+                ('parameters', django.contrib.postgres.fields.hstore.HStoreField(null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='priority',
+            field=models.IntegerField(default=0, help_text='When a node is in several groups, the settings of higher priority groups prevail'),
+        ),
+        migrations.RunPython(backfill_classification, migrations.RunPython.noop),
+    ]
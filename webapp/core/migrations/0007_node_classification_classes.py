@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:17
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+from core.migrations._classification import compile_classes
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_node_classification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nodeclassification',
+            name='classes',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='nodeclassification',
+            name='conflicts',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='nodeclassification',
+            name='sensitive_parameters',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+        migrations.RunPython(compile_classes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import migrations
+from django.db.models import Count
+
+from core.migrations._classification import compile_classes
+
+
+def merge_duplicates(model, fields, references):
+    """
+    Keeps the first row (by id) of each set of rows with the same fields,
+    moving the references to the removed rows to the kept one
+    Returns whether any row was removed
+    """
+    duplicates = (
+        model.objects.values(*fields)
+        .annotate(count=Count("pk"), ids=ArrayAgg("pk", ordering="pk"))
+        .filter(count__gt=1)
+    )
+    merged = False
+    for duplicate in duplicates:
+        keep, *others = duplicate["ids"]
+        for ref_model, ref_field in references:
+            ref_model.objects.filter(**{ref_field + "__in": others}).update(
+                **{ref_field: keep}
+            )
+        model.objects.filter(pk__in=others).delete()
+        merged = True
+    return merged
+
+
+def merge_all_duplicates(apps, schema_editor):
+    """
+    Removes the duplicated rows that would break the unique constraints added
+    by the next migration, from the parent tables to the child ones
+    """
+    Group = apps.get_model("core", "Group")
+    Environment = apps.get_model("core", "Environment")
+    PuppetClass = apps.get_model("core", "PuppetClass")
+    Parameter = apps.get_model("core", "Parameter")
+    ConfigurationClass = apps.get_model("core", "ConfigurationClass")
+    ConfigurationParameter = apps.get_model("core", "ConfigurationParameter")
+
+    merged = [
+        merge_duplicates(
+            Environment,
+            ("name", "master_zone"),
+            ((Group, "environment"), (PuppetClass, "environment")),
+        ),
+        merge_duplicates(
+            PuppetClass,
+            ("name", "environment"),
+            ((Parameter, "puppet_class"), (ConfigurationClass, "puppet_class")),
+        ),
+        merge_duplicates(
+            Parameter,
+            ("name", "puppet_class"),
+            ((ConfigurationParameter, "parameter"),),
+        ),
+        merge_duplicates(
+            ConfigurationClass,
+            ("configuration", "puppet_class"),
+            ((ConfigurationParameter, "configuration_class"),),
+        ),
+        merge_duplicates(
+            ConfigurationParameter, ("configuration_class", "parameter"), ()
+        ),
+    ]
+    if any(merged):
+        # The removed parameters may be referenced by the node classifications
+        compile_classes(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("core", "0007_node_classification_classes")]
+
+    operations = [migrations.RunPython(merge_all_duplicates, migrations.RunPython.noop)]
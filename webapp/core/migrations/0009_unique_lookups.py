@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_merge_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='configurationclass',
+            unique_together={('configuration', 'puppet_class')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='configurationparameter',
+            unique_together={('configuration_class', 'parameter')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='environment',
+            unique_together={('name', 'master_zone')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='parameter',
+            unique_together={('name', 'puppet_class')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='puppetclass',
+            unique_together={('name', 'environment')},
+        ),
+    ]
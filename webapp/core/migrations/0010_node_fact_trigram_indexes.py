@@ -0,0 +1,25 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Django filters icontains/istartswith with UPPER(column) LIKE UPPER(text), so
+# the trigram indexes are on UPPER(column), which the model Meta can not declare
+TRIGRAM_INDEXES = (
+    ("core_node_certname_trgm", "core_node", "certname"),
+    ("core_fact_name_trgm", "core_fact", "name"),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_unique_lookups'),
+    ]
+
+    operations = [TrigramExtension()] + [
+        migrations.RunSQL(
+            "CREATE INDEX %s ON %s USING gin (UPPER(%s) gin_trgm_ops)"
+            % (name, table, column),
+            "DROP INDEX %s" % name,
+        )
+        for name, table, column in TRIGRAM_INDEXES
+    ]
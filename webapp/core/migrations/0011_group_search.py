@@ -0,0 +1,75 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:40
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+from django.db.models import TextField, Value
+
+
+def index_groups(apps, schema_editor):
+    """
+    Fills the tag names and search vector of the existing groups, as done
+    by Group.refresh_search()
+    """
+    Group = apps.get_model("core", "Group")
+    UUIDTaggedItem = apps.get_model("core", "UUIDTaggedItem")
+
+    tag_names = {group_id: [] for group_id in Group.objects.values_list("pk", flat=True)}
+    for group_id, name in UUIDTaggedItem.objects.values_list("object_id", "tag__name"):
+        if group_id in tag_names:
+            tag_names[group_id].append(name)
+
+    for group_id, names in tag_names.items():
+        names.sort()
+        Group.objects.filter(pk=group_id).update(
+            tag_names=names,
+            search_vector=SearchVector("label", weight="A", config="simple")
+            + SearchVector(
+                Value(" ".join(names), output_field=TextField()),
+                weight="B",
+                config="simple",
+            )
+            + SearchVector("description", weight="C", config="simple"),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_node_fact_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='tag_names',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=100), default=list, editable=False, size=None),
+        ),
+        migrations.AddIndex(
+            model_name='group',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='core_group_search_vector'),
+        ),
+        migrations.AddIndex(
+            model_name='group',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tag_names'], name='core_group_tag_names'),
+        ),
+        migrations.RunPython(index_groups, migrations.RunPython.noop),
+    ] + [
+        # Trigram indexes for the icontains filters, see 0010
+        migrations.RunSQL(
+            "CREATE INDEX %s ON core_group USING gin (UPPER(%s) gin_trgm_ops)"
+            % (name, column),
+            "DROP INDEX %s" % name,
+        )
+        for name, column in (
+            ("core_group_label_trgm", "label"),
+            ("core_group_description_trgm", "description"),
+        )
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:52
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def refresh_counter(queryset, field, related_queryset, related_field):
+    """
+    Sets the counter field of the queryset rows to their number of rows in
+    related_queryset (through its related_field foreign key)
+    Frozen copy of core.models.refresh_counter
+    """
+    count = Coalesce(
+        models.Subquery(
+            related_queryset.filter(**{related_field: models.OuterRef("pk")})
+            .order_by()
+            .values(related_field)
+            .annotate(count=models.Count("pk"))
+            .values("count"),
+            output_field=models.IntegerField(),
+        ),
+        0,
+    )
+    queryset.annotate(actual_count=count).exclude(
+        **{field: models.F("actual_count")}
+    ).update(**{field: count})
+
+
+def count_nodes(apps, schema_editor):
+    """
+    Fills the counters of the existing groups, nodes and master zones, as
+    done by their refresh_counters()
+    """
+    MasterZone = apps.get_model("core", "MasterZone")
+    Node = apps.get_model("core", "Node")
+    Group = apps.get_model("core", "Group")
+    membership = Group.matching_nodes.through
+
+    refresh_counter(Group.objects.all(), "nodes_count", membership.objects, "group")
+    refresh_counter(Node.objects.all(), "groups_count", membership.objects, "node")
+    refresh_counter(MasterZone.objects.all(), "nodes_count", Node.objects, "master_zone")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_group_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='nodes_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='masterzone',
+            name='nodes_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='groups_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_nodes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,157 @@
+"""
+Classification compile shared by the migrations, frozen as it was when
+migration 0007 was written
+Not a migration itself (the loader skips the modules starting with "_"),
+and never to be changed, since the migrations depending on it must keep
+giving the same results
+"""
+from django.db import models
+
+MEMBERSHIP_FIELDS = (
+    "node_id",
+    "group_id",
+    "group__label",
+    "group__priority",
+    "group__environment__name",
+    "group__variable__data",
+)
+
+
+def load_configured_classes(apps, groups):
+    """
+    Returns the classes configured by each group, with their parameters
+    {group_id: {class_name: [(param_name, value, sensitive_param_id)]}}
+    """
+    ConfigurationClass = apps.get_model("core", "ConfigurationClass")
+    ConfigurationParameter = apps.get_model("core", "ConfigurationParameter")
+    configured = {group_id: {} for group_id in groups}
+    config_classes = (
+        ConfigurationClass.objects.filter(configuration_id__in=groups)
+        .order_by("puppet_class__name")
+        .values_list("configuration_id", "puppet_class__name")
+    )
+    for group_id, class_name in config_classes:
+        configured[group_id].setdefault(class_name, [])
+
+    config_params = (
+        ConfigurationParameter.objects.filter(
+            configuration_class__configuration_id__in=groups
+        )
+        .annotate(
+            sensitive=models.Case(
+                models.When(sensitive_value__isnull=False, then=models.Value(True)),
+                default=models.Value(False),
+                output_field=models.BooleanField(),
+            )
+        )
+        .order_by("parameter__name")
+        .values_list(
+            "configuration_class__configuration_id",
+            "configuration_class__puppet_class__name",
+            "parameter__name",
+            "pk",
+            "value",
+            "sensitive",
+        )
+    )
+    for group_id, class_name, param_name, pk, value, sensitive in config_params:
+        configured[group_id].setdefault(class_name, []).append(
+            (param_name, value, str(pk) if sensitive else None)
+        )
+    return configured
+
+
+def compile_classifications(memberships, configured):
+    """
+    Merges the settings of the groups of each node, the last group wins
+    memberships are MEMBERSHIP_FIELDS tuples, in Group.PRECEDENCE order
+    configured is the result of load_configured_classes
+    Returns {node_id: NodeClassification fields}
+    """
+    classifications = {}
+    sources = {}
+    for node_id, group_id, label, priority, environment, data in memberships:
+        if node_id not in classifications:
+            classifications[node_id] = {
+                "parameters": {},
+                "classes": {},
+                "sensitive_parameters": {},
+            }
+            sources[node_id] = {}
+        classification = classifications[node_id]
+        classification["environment"] = environment
+        if data:
+            classification["parameters"].update(data)
+
+        classes = classification["classes"]
+        sensitive = classification["sensitive_parameters"]
+        for class_name, params in configured.get(group_id, {}).items():
+            if params and classes.get(class_name) is None:
+                classes[class_name] = {}
+            else:
+                classes.setdefault(class_name, None)
+            for param_name, value, sensitive_id in params:
+                classes[class_name][param_name] = value
+                if sensitive_id:
+                    sensitive.setdefault(class_name, {})[param_name] = sensitive_id
+                else:
+                    sensitive.get(class_name, {}).pop(param_name, None)
+                sources[node_id].setdefault((class_name, param_name), []).append(
+                    {
+                        "id": str(group_id),
+                        "label": label,
+                        "priority": priority,
+                        "value": "[Sensitive]" if sensitive_id else value,
+                        "sensitive": bool(sensitive_id),
+                    }
+                )
+
+    for node_id, classification in classifications.items():
+        conflicts = []
+        for (class_name, param_name), groups in sorted(sources[node_id].items()):
+            values = {repr(group["value"]) for group in groups}
+            sensitive = any([group.pop("sensitive") for group in groups])
+            if len(groups) > 1 and (sensitive or len(values) > 1):
+                conflicts.append(
+                    {
+                        "class": class_name,
+                        "parameter": param_name,
+                        "winner": groups[-1]["label"],
+                        "groups": groups,
+                    }
+                )
+        classification["classes"] = classification["classes"] or None
+        classification["sensitive_parameters"] = {
+            name: params
+            for name, params in classification["sensitive_parameters"].items()
+            if params
+        } or None
+        classification["conflicts"] = conflicts or None
+    return classifications
+
+
+def compile_classes(apps, schema_editor):
+    """
+    Recomputes the classification of the existing nodes
+    Same as NodeClassification.refresh, against the historical models
+    """
+    Group = apps.get_model("core", "Group")
+    NodeClassification = apps.get_model("core", "NodeClassification")
+    memberships = list(
+        Group.matching_nodes.through.objects.order_by(
+            "node_id", "group__priority", "group__label", "group_id"
+        ).values_list(*MEMBERSHIP_FIELDS)
+    )
+    configured = load_configured_classes(
+        apps, {membership[1] for membership in memberships}
+    )
+    classifications = compile_classifications(memberships, configured)
+
+    NodeClassification.objects.all().delete()
+    NodeClassification.objects.bulk_create(
+        (
+            NodeClassification(node_id=node_id, **fields)
+            for node_id, fields in classifications.items()
+        ),
+        batch_size=1000,
+    )
@@ -1,20 +1,76 @@
 import ast
+import json
 import re
+import threading
 import uuid
+from contextlib import contextmanager
+from datetime import timedelta
 from distutils.util import strtobool
 
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields import HStoreField
-from django.db import models
-from django.db.models.signals import post_save
+from django.core.exceptions import ValidationError
+from django.contrib.postgres.fields import ArrayField, HStoreField, JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField,
+)
+from django.db import models, transaction
+from django.db.models import (
+    Count,
+    F,
+    IntegerField,
+    OuterRef,
+    Q,
+    Subquery,
+    TextField,
+    Value,
+)
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from django.forms.models import model_to_dict
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from fernet_fields import EncryptedTextField
+from guardian.models import GroupObjectPermission, UserObjectPermission
 from taggit.managers import TaggableManager
-from taggit.models import GenericUUIDTaggedItemBase, TaggedItemBase
+from taggit.models import GenericUUIDTaggedItemBase, Tag, TaggedItemBase
+
+from core import cache as reference_cache
+from core import http_cache
+
+from core.encryption import (
+    EncryptedToken,
+    LazyEncryptedTextField,
+    sensitive_value_cache,
+)
+
+
+def refresh_counter(queryset, field, related_queryset, related_field):
+    """
+    Sets the counter field of the queryset rows to their number of rows in
+    related_queryset (through its related_field foreign key)
+    Only the wrong counters are written, returns how many were fixed
+    """
+    count = Coalesce(
+        Subquery(
+            related_queryset.filter(**{related_field: OuterRef("pk")})
+            .order_by()
+            .values(related_field)
+            .annotate(count=Count("pk"))
+            .values("count"),
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+    return (
+        queryset.annotate(actual_count=count)
+        .exclude(**{field: F("actual_count")})
+        .update(**{field: count})
+    )
 
 
 class MasterZone(models.Model):
@@ -24,6 +80,8 @@ class MasterZone(models.Model):
     ca_cert = models.FileField(null=True)
     signed_cert = models.FileField(null=True)
     private_key = models.FileField(null=True)
+    # Counter kept by the signal receivers below, see refresh_counters()
+    nodes_count = models.IntegerField(default=0, editable=False)
 
     class Meta:
         permissions = (("has_access", "Has access to MasterZone"),)
@@ -34,6 +92,16 @@ class MasterZone(models.Model):
     def get_absolute_url(self):
         return reverse("master-zones-index")
 
+    @classmethod
+    def refresh_counters(cls, master_zone_ids=None):
+        """
+        Recounts the nodes of the given master zones (all when None)
+        """
+        queryset = cls.objects.all()
+        if master_zone_ids is not None:
+            queryset = queryset.filter(pk__in=master_zone_ids)
+        return refresh_counter(queryset, "nodes_count", Node.objects, "master_zone")
+
 
 class Environment(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -45,6 +113,9 @@ class Environment(models.Model):
         related_query_name="environment",
     )
 
+    class Meta:
+        unique_together = ("name", "master_zone")
+
     def __str__(self):
         return self.name
 
@@ -58,13 +129,29 @@ class Node(models.Model):
         related_name="nodes",
         related_query_name="node",
     )
+    # Counter kept by the signal receivers below, see refresh_counters()
+    groups_count = models.IntegerField(default=0, editable=False)
 
     class Meta:
         unique_together = ("certname", "master_zone")
+        # The icontains searches use the core_node_certname_trgm index,
+        # created on UPPER(certname) by the 0010 migration
 
     def __str__(self):
         return self.certname
 
+    @classmethod
+    def refresh_counters(cls, node_ids=None):
+        """
+        Recounts the groups of the given nodes (all when None)
+        """
+        queryset = cls.objects.all()
+        if node_ids is not None:
+            queryset = queryset.filter(pk__in=node_ids)
+        return refresh_counter(
+            queryset, "groups_count", Group.matching_nodes.through.objects, "node"
+        )
+
 
 class Fact(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -78,6 +165,8 @@ class Fact(models.Model):
 
     class Meta:
         unique_together = ("name", "master_zone")
+        # The icontains searches use the core_fact_name_trgm index,
+        # created on UPPER(name) by the 0010 migration
 
     def __str__(self):
         return self.name
@@ -93,6 +182,9 @@ class PuppetClass(models.Model):
         related_query_name="class",
     )
 
+    class Meta:
+        unique_together = ("name", "environment")
+
     def __str__(self):
         return self.name
 
@@ -163,10 +255,17 @@ class Parameter(models.Model):
         (CALLABLE, CALLABLE),
     )
 
+    class Meta:
+        unique_together = ("name", "puppet_class")
+
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
+    def parse_value_type(self):
+        """
+        Splits the value_type into type and values, e.g. Enum["a", "b"]
+        Called by save() and before the bulk inserts, which skip save()
+        """
         re_pattern = "([a-zA-Z]+)\[(.+)\]"
         match = re.search(re_pattern, self.value_type)
         if match is not None:
@@ -175,6 +274,9 @@ class Parameter(models.Model):
 
         if self.value_type == Parameter.BOOLEAN:
             self.values = "'True', 'False'"
+
+    def save(self, *args, **kwargs):
+        self.parse_value_type()
         super().save(*args, **kwargs)
 
 
@@ -206,6 +308,38 @@ class Group(models.Model):
         related_name="groups",
         related_query_name="group",
     )
+    priority = models.IntegerField(
+        default=0,
+        help_text=_(
+            "When a node is in several groups, "
+            "the settings of higher priority groups prevail"
+        ),
+    )
+    # Kept by refresh_search(), so the searches need no join with the tags
+    tag_names = ArrayField(
+        models.CharField(max_length=100), default=list, editable=False
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Counter kept by the signal receivers below, see refresh_counters()
+    nodes_count = models.IntegerField(default=0, editable=False)
+
+    # Order in which the settings of the groups are merged, the last one wins
+    PRECEDENCE = ("priority", "label", "id")
+
+    # Fields stored in the classification of the group nodes (the labels are
+    # also kept in the conflicts)
+    CLASSIFICATION_FIELDS = ("priority", "label", "environment_id")
+
+    # Labels and tags are identifiers, so the words are not stemmed
+    SEARCH_CONFIG = "simple"
+
+    class Meta:
+        # label and description also have trigram indexes on UPPER(column),
+        # created by the 0011 migration, for the icontains filters
+        indexes = [
+            GinIndex(fields=["search_vector"], name="core_group_search_vector"),
+            GinIndex(fields=["tag_names"], name="core_group_tag_names"),
+        ]
 
     def __str__(self):
         return self.label
@@ -213,9 +347,82 @@ class Group(models.Model):
     def get_absolute_url(self):
         return reverse("groups-index")
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_classification_fields = instance.classification_fields()
+        return instance
+
+    def classification_fields(self):
+        """
+        Values of the CLASSIFICATION_FIELDS, deferred fields are not loaded
+        """
+        return tuple(self.__dict__.get(field) for field in self.CLASSIFICATION_FIELDS)
+
     @property
     def tags_list(self):
-        return list(self.tags.all().values_list("name", flat=True))
+        # Iterating over tags.all() uses the prefetch_related("tags") cache
+        return sorted(tag.name for tag in self.tags.all())
+
+    @classmethod
+    def refresh_counters(cls, group_ids=None):
+        """
+        Recounts the matching nodes of the given groups (all when None)
+        """
+        queryset = cls.objects.all()
+        if group_ids is not None:
+            queryset = queryset.filter(pk__in=group_ids)
+        return refresh_counter(
+            queryset, "nodes_count", cls.matching_nodes.through.objects, "group"
+        )
+
+    @classmethod
+    def refresh_search(cls, group_ids):
+        """
+        Updates the tag names and the search vector of the given groups,
+        weighting the label over the tags and the tags over the description
+        """
+        tag_names = {group_id: [] for group_id in group_ids}
+        for group_id, name in UUIDTaggedItem.objects.filter(
+            object_id__in=tag_names
+        ).values_list("object_id", "tag__name"):
+            tag_names[group_id].append(name)
+
+        for group_id, names in tag_names.items():
+            names.sort()
+            cls.objects.filter(pk=group_id).update(
+                tag_names=names,
+                search_vector=SearchVector(
+                    "label", weight="A", config=cls.SEARCH_CONFIG
+                )
+                + SearchVector(
+                    Value(" ".join(names), output_field=TextField()),
+                    weight="B",
+                    config=cls.SEARCH_CONFIG,
+                )
+                + SearchVector("description", weight="C", config=cls.SEARCH_CONFIG),
+            )
+
+    @classmethod
+    def search(cls, queryset, text):
+        """
+        Filters the groups with every word of the text as a word prefix of
+        their label, tags or description, or with the text in their label,
+        ranked by relevance
+        """
+        words = re.findall(r"\w+", text)
+        if not words:
+            return queryset.filter(label__icontains=text)
+        query = SearchQuery(
+            " & ".join(word + ":*" for word in words),
+            config=cls.SEARCH_CONFIG,
+            search_type="raw",
+        )
+        return (
+            queryset.filter(Q(search_vector=query) | Q(label__icontains=text))
+            .annotate(search_rank=SearchRank(F("search_vector"), query))
+            .order_by("-search_rank", "label")
+        )
 
 
 class Rule(models.Model):
@@ -290,6 +497,9 @@ class ConfigurationClass(models.Model):
         related_query_name="group",
     )
 
+    class Meta:
+        unique_together = ("configuration", "puppet_class")
+
     def __str__(self):
         return self.puppet_class.name
 
@@ -301,7 +511,10 @@ class ConfigurationParameter(models.Model):
     integer_value = models.IntegerField(null=True, blank=True)
     float_value = models.FloatField(null=True, blank=True)
     boolean_value = models.NullBooleanField(null=True, blank=True)
-    sensitive_value = EncryptedTextField(null=True, blank=True)
+    # Decrypted through sensitive_value_cache when loaded, see from_db()
+    sensitive_value = LazyEncryptedTextField(null=True, blank=True)
+    # Decoded value, computed on save (always null for sensitive values)
+    value = JSONField(null=True, blank=True)
     configuration_class = models.ForeignKey(
         ConfigurationClass,
         on_delete=models.CASCADE,
@@ -315,10 +528,25 @@ class ConfigurationParameter(models.Model):
         related_query_name="classification",
     )
 
+    class Meta:
+        unique_together = ("configuration_class", "parameter")
+
     def __str__(self):
         return self.parameter.name
 
-    def cast(self, value_type, value):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        token = instance.__dict__.get("sensitive_value")
+        if isinstance(token, EncryptedToken):
+            field = cls._meta.get_field("sensitive_value")
+            instance.sensitive_value = sensitive_value_cache.get_or_decrypt(
+                instance.pk, token, field
+            )
+        return instance
+
+    @staticmethod
+    def cast(value_type, value):
         if value_type == Parameter.STRING:
             converted = str(value)
         elif value_type == Parameter.INTEGER:
@@ -336,7 +564,13 @@ class ConfigurationParameter(models.Model):
 
         return converted
 
-    def save(self, *args, **kwargs):
+    def prepare_value(self):
+        """
+        Fills the typed value fields from raw_value
+        Called by save() and before the bulk writes, which skip save()
+        Raises ValidationError when the value can not be stored unchanged as
+        JSON (e.g. sets, bytes, NaN or non string keys)
+        """
         if self.parameter.value_type == Parameter.OPTIONAL:
             value_type = self.parameter.values
         else:
@@ -354,38 +588,34 @@ class ConfigurationParameter(models.Model):
         elif value_type == Parameter.BOOLEAN:
             self.boolean_value = self.cast(value_type, self.raw_value)
 
+        if self.sensitive_value is None:
+            self.value = decode_value(self.parameter, self)
+            try:
+                encoded = json.loads(json.dumps(self.value, allow_nan=False))
+            except (TypeError, ValueError):
+                encoded = None
+            if encoded != self.value:
+                raise ValidationError(
+                    'Invalid value "%(value)s" for parameter "%(parameter)s"',
+                    params={"value": self.raw_value, "parameter": self.parameter.name},
+                )
+        else:
+            self.value = None
+
+    def save(self, *args, **kwargs):
+        self.prepare_value()
         super().save(*args, **kwargs)
 
     def get_value(self):
-        optional_values = {
-            Parameter.BOOLEAN: self.boolean_value,
-            Parameter.FLOAT: self.float_value,
-            Parameter.INTEGER: self.integer_value,
-            Parameter.STRING: self.string_value,
-        }
-
-        obj_dict = model_to_dict(self)
-        value = obj_dict.get(self.parameter.value_type.lower() + "_value", None)
-
-        if value is None:
-            if re.search("^sensitive_.*", self.parameter.name):
-                if self.parameter.values == "":
-                    param_type = self.parameter.value_type
-                else:
-                    param_type = self.parameter.values
-
-                value = self.cast(param_type, obj_dict.get("sensitive_value", None))
-
-            elif self.parameter.value_type == Parameter.HASH:
-                value = self.cast(self.parameter.value_type, self.raw_value)
-            elif self.parameter.value_type == Parameter.ARRAY:
-                value = self.cast(self.parameter.value_type, self.raw_value)
-            elif self.parameter.value_type == Parameter.OPTIONAL:
-                value = optional_values.get(self.parameter.values, self.raw_value)
+        if self.sensitive_value is not None:
+            # Sensitive values are only stored encrypted
+            if self.parameter.values == "":
+                param_type = self.parameter.value_type
             else:
-                value = self.raw_value
+                param_type = self.parameter.values
+            return self.cast(param_type, self.sensitive_value)
 
-        return value
+        return self.value
 
     def get_raw_value(self):
         if re.search("^sensitive_.*", self.parameter.name):
@@ -396,6 +626,31 @@ class ConfigurationParameter(models.Model):
         return raw_value
 
 
+def decode_value(parameter, config_param):
+    """
+    Returns the decoded value of a non sensitive ConfigurationParameter,
+    from its raw and typed values
+    """
+    typed_values = {
+        Parameter.BOOLEAN: config_param.boolean_value,
+        Parameter.FLOAT: config_param.float_value,
+        Parameter.INTEGER: config_param.integer_value,
+        Parameter.STRING: config_param.string_value,
+    }
+    value = typed_values.get(parameter.value_type)
+    if value is None:
+        if parameter.value_type in (Parameter.HASH, Parameter.ARRAY):
+            value = ConfigurationParameter.cast(
+                parameter.value_type, config_param.raw_value
+            )
+        elif parameter.value_type == Parameter.OPTIONAL:
+            value = typed_values.get(parameter.values, config_param.raw_value)
+        else:
+            value = config_param.raw_value
+
+    return value
+
+
 class Variable(models.Model):
     group = models.OneToOneField(Group, on_delete=models.CASCADE, primary_key=True)
     data = HStoreField(null=True)
@@ -404,6 +659,307 @@ class Variable(models.Model):
         return self.group.label
 
 
+class NodeClassification(models.Model):
+    """
+    Environment, variables and classes of a node, merged from its groups
+    Kept up to date by the signal receivers below, whenever the groups of the
+    node or their settings change
+    """
+
+    node = models.OneToOneField(
+        Node, on_delete=models.CASCADE, primary_key=True, related_name="classification"
+    )
+    environment = models.CharField(max_length=255, null=True)
+    parameters = HStoreField(null=True)
+    # {class_name: {param_name: value} or None}
+    classes = JSONField(null=True)
+    # {class_name: {param_name: ConfigurationParameter id}}
+    # Sensitive values are never stored decrypted, they are read on request
+    sensitive_parameters = JSONField(null=True)
+    # Parameters set with different values by more than one group
+    conflicts = JSONField(null=True)
+
+    def __str__(self):
+        return self.node.certname
+
+    @classmethod
+    def refresh(cls, node_ids):
+        """
+        Recomputes the classification of the given nodes, and purges their
+        classifier responses from the shared HTTP cache
+        The groups are merged following Group.PRECEDENCE
+        """
+        node_ids = set(node_ids)
+        if not node_ids:
+            return
+
+        pending = getattr(_deferred_refresh, "node_ids", None)
+        if pending is not None:
+            pending.update(node_ids)
+            return
+
+        with transaction.atomic():
+            # Serializes concurrent refreshes of the same nodes
+            list(
+                Node.objects.select_for_update()
+                .filter(pk__in=node_ids)
+                .values_list("pk", flat=True)
+            )
+            memberships = list(
+                Group.matching_nodes.through.objects.filter(node_id__in=node_ids)
+                .order_by(
+                    "node_id", *("group__%s" % field for field in Group.PRECEDENCE)
+                )
+                .values_list(*MEMBERSHIP_FIELDS)
+            )
+            configured = load_configured_classes(
+                ConfigurationClass,
+                ConfigurationParameter,
+                {membership[1] for membership in memberships},
+            )
+            classifications = compile_classifications(memberships, configured)
+
+            cls.objects.filter(node_id__in=node_ids).delete()
+            cls.objects.bulk_create(
+                cls(node_id=node_id, **fields)
+                for node_id, fields in classifications.items()
+            )
+        http_cache.purge(http_cache.node_key(node_id) for node_id in node_ids)
+
+    @classmethod
+    def explain(cls, node):
+        """
+        Describes which groups of the node set each part of its classification
+        and which one prevails, see explain_classification
+        Read from the memberships and configurations of the groups, in a
+        constant number of queries
+        """
+        memberships = list(
+            Group.matching_nodes.through.objects.filter(node_id=node.pk)
+            .order_by(*("group__%s" % field for field in Group.PRECEDENCE))
+            .values_list(*MEMBERSHIP_FIELDS)
+        )
+        configured = load_configured_classes(
+            ConfigurationClass,
+            ConfigurationParameter,
+            {membership[1] for membership in memberships},
+        )
+        return explain_classification(memberships, configured)
+
+    @classmethod
+    def refresh_groups(cls, groups):
+        """
+        Recomputes the classification of the nodes of the given groups
+        """
+        cls.refresh(
+            Group.matching_nodes.through.objects.filter(group__in=groups).values_list(
+                "node_id", flat=True
+            )
+        )
+
+    @classmethod
+    @contextmanager
+    def deferred_refresh(cls):
+        """
+        Collects the refreshes requested inside the block, so each affected
+        node is only refreshed once, when the block ends
+        """
+        if getattr(_deferred_refresh, "node_ids", None) is not None:
+            yield
+            return
+
+        _deferred_refresh.node_ids = set()
+        try:
+            yield
+            node_ids = _deferred_refresh.node_ids
+        finally:
+            _deferred_refresh.node_ids = None
+        cls.refresh(node_ids)
+
+
+_deferred_refresh = threading.local()
+
+MEMBERSHIP_FIELDS = (
+    "node_id",
+    "group_id",
+    "group__label",
+    "group__priority",
+    "group__environment__name",
+    "group__variable__data",
+)
+
+
+def load_configured_classes(
+    configuration_class_model, configuration_param_model, groups
+):
+    """
+    Returns the classes configured by each group, with their parameters
+    {group_id: {class_name: [(param_name, value, sensitive_param_id)]}}
+    """
+    configured = {group_id: {} for group_id in groups}
+    config_classes = (
+        configuration_class_model.objects.filter(configuration_id__in=groups)
+        .order_by("puppet_class__name")
+        .values_list("configuration_id", "puppet_class__name")
+    )
+    for group_id, class_name in config_classes:
+        configured[group_id].setdefault(class_name, [])
+
+    config_params = (
+        configuration_param_model.objects.filter(
+            configuration_class__configuration_id__in=groups
+        )
+        .annotate(
+            sensitive=models.Case(
+                models.When(sensitive_value__isnull=False, then=models.Value(True)),
+                default=models.Value(False),
+                output_field=models.BooleanField(),
+            )
+        )
+        .order_by("parameter__name")
+        .values_list(
+            "configuration_class__configuration_id",
+            "configuration_class__puppet_class__name",
+            "parameter__name",
+            "pk",
+            "value",
+            "sensitive",
+        )
+    )
+    for group_id, class_name, param_name, pk, value, sensitive in config_params:
+        configured[group_id].setdefault(class_name, []).append(
+            (param_name, value, str(pk) if sensitive else None)
+        )
+    return configured
+
+
+def compile_classifications(memberships, configured):
+    """
+    Merges the settings of the groups of each node, the last group wins
+    memberships are MEMBERSHIP_FIELDS tuples, in Group.PRECEDENCE order
+    configured is the result of load_configured_classes
+    Returns {node_id: NodeClassification fields}
+    """
+    classifications = {}
+    sources = {}
+    for node_id, group_id, label, priority, environment, data in memberships:
+        if node_id not in classifications:
+            classifications[node_id] = {
+                "parameters": {},
+                "classes": {},
+                "sensitive_parameters": {},
+            }
+            sources[node_id] = {}
+        classification = classifications[node_id]
+        classification["environment"] = environment
+        if data:
+            classification["parameters"].update(data)
+
+        classes = classification["classes"]
+        sensitive = classification["sensitive_parameters"]
+        for class_name, params in configured.get(group_id, {}).items():
+            if params and classes.get(class_name) is None:
+                classes[class_name] = {}
+            else:
+                classes.setdefault(class_name, None)
+            for param_name, value, sensitive_id in params:
+                classes[class_name][param_name] = value
+                if sensitive_id:
+                    sensitive.setdefault(class_name, {})[param_name] = sensitive_id
+                else:
+                    sensitive.get(class_name, {}).pop(param_name, None)
+                sources[node_id].setdefault((class_name, param_name), []).append(
+                    {
+                        "id": str(group_id),
+                        "label": label,
+                        "priority": priority,
+                        "value": "[Sensitive]" if sensitive_id else value,
+                        "sensitive": bool(sensitive_id),
+                    }
+                )
+
+    for node_id, classification in classifications.items():
+        conflicts = []
+        for (class_name, param_name), groups in sorted(sources[node_id].items()):
+            values = {repr(group["value"]) for group in groups}
+            sensitive = any([group.pop("sensitive") for group in groups])
+            if len(groups) > 1 and (sensitive or len(values) > 1):
+                conflicts.append(
+                    {
+                        "class": class_name,
+                        "parameter": param_name,
+                        "winner": groups[-1]["label"],
+                        "groups": groups,
+                    }
+                )
+        classification["classes"] = classification["classes"] or None
+        classification["sensitive_parameters"] = {
+            name: params
+            for name, params in classification["sensitive_parameters"].items()
+            if params
+        } or None
+        classification["conflicts"] = conflicts or None
+    return classifications
+
+
+def explain_classification(memberships, configured):
+    """
+    Describes how the settings of the groups of a single node are merged,
+    following the same rules as compile_classifications
+    memberships are the node MEMBERSHIP_FIELDS tuples, in Group.PRECEDENCE order
+    configured is the result of load_configured_classes
+    Each setting lists the groups setting it, the last one being the winner:
+    {"value": ..., "winner": {"id", "label"}, "sources": [{"id", "label", "value"}]}
+    """
+    groups = []
+    environment = None
+    variables = {}
+    classes = {}
+
+    def set_value(settings, name, group, value):
+        source = {"id": group["id"], "label": group["label"], "value": value}
+        setting = settings.setdefault(name, {"sources": []})
+        setting["sources"].append(source)
+        setting["value"] = value
+        setting["winner"] = {"id": group["id"], "label": group["label"]}
+
+    for _node_id, group_id, label, priority, environment_name, data in memberships:
+        group = {
+            "id": str(group_id),
+            "label": label,
+            "priority": priority,
+            "environment": environment_name,
+            "variables": data or {},
+            "classes": {},
+        }
+        groups.append(group)
+        environment = {
+            "value": environment_name,
+            "winner": {"id": group["id"], "label": label},
+        }
+        for name, value in sorted((data or {}).items()):
+            set_value(variables, name, group, value)
+
+        for class_name, params in configured.get(group_id, {}).items():
+            puppet_class = classes.setdefault(
+                class_name, {"groups": [], "parameters": {}}
+            )
+            puppet_class["groups"].append({"id": group["id"], "label": label})
+            group["classes"][class_name] = {}
+            for param_name, value, sensitive_id in params:
+                if sensitive_id:
+                    value = "[Sensitive]"
+                group["classes"][class_name][param_name] = value
+                set_value(puppet_class["parameters"], param_name, group, value)
+
+    return {
+        "environment": environment,
+        "groups": groups,
+        "variables": variables,
+        "classes": classes,
+    }
+
+
 class UserLog(models.Model):
     """
     Model for user action logging
@@ -421,9 +977,38 @@ class UserLog(models.Model):
     request_path = models.CharField(max_length=256)
     request_method = models.CharField(max_length=10)
     response_code = models.CharField(max_length=3)
-    datetime = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, since the logs are written in batches after the request
+    datetime = models.DateTimeField(default=timezone.now)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Matches the (datetime, id) keyset pagination and the retention purge
+            models.Index(fields=["-datetime", "-id"], name="userlog_datetime_idx"),
+            models.Index(
+                fields=["user", "-datetime"], name="userlog_user_datetime_idx"
+            ),
+        ]
+
+    @classmethod
+    def purge(cls, days, batch_size=10000):
+        """
+        Removes the logs older than the given number of days
+        Deletes in batches, to avoid holding long locks on the table
+        Returns the number of removed logs
+        """
+        limit = timezone.now() - timedelta(days=days)
+        deleted = 0
+        while True:
+            ids = list(
+                cls.objects.filter(datetime__lt=limit).values_list("id", flat=True)[
+                    :batch_size
+                ]
+            )
+            if not ids:
+                return deleted
+            deleted += cls.objects.filter(id__in=ids).delete()[0]
+
     @property
     def formatted_user(self):
         if not self.user:
@@ -455,3 +1040,313 @@ def group_create_handler(sender, **kwargs):
         Configuration.objects.create(group=kwargs["instance"])
         Rule.objects.create(group=kwargs["instance"])
         Variable.objects.create(group=kwargs["instance"])
+
+
+@receiver(post_save, sender=ConfigurationParameter)
+@receiver(post_delete, sender=ConfigurationParameter)
+def configuration_parameter_change_handler(sender, **kwargs):
+    """
+    Signal receiver for ConfigurationParameter update and deletion
+    Should drop the cached decrypted value
+    """
+    sensitive_value_cache.invalidate(kwargs["instance"].pk)
+
+
+@receiver(m2m_changed, sender=Group.matching_nodes.through)
+def group_nodes_change_handler(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal receiver for changes of the Group nodes
+    Should update the classification of the affected nodes
+    """
+    if action == "pre_clear":
+        if reverse:
+            instance._cleared_nodes = [instance.pk]
+        else:
+            instance._cleared_nodes = list(
+                instance.matching_nodes.values_list("pk", flat=True)
+            )
+    elif action == "post_clear":
+        NodeClassification.refresh(instance.__dict__.pop("_cleared_nodes", []))
+    elif action in ("post_add", "post_remove"):
+        NodeClassification.refresh([instance.pk] if reverse else pk_set)
+
+
+@receiver(post_save, sender=Group)
+def group_change_handler(sender, **kwargs):
+    """
+    Signal receiver for Group update
+    Should update the classification of the group nodes, when the fields it
+    depends on changed
+    """
+    instance = kwargs["instance"]
+    fields = instance.classification_fields()
+    saved_fields = instance.__dict__.get("_saved_classification_fields")
+    instance._saved_classification_fields = fields
+    if not kwargs["created"] and fields != saved_fields:
+        NodeClassification.refresh_groups([instance])
+
+
+@receiver(pre_delete, sender=Group)
+def group_pre_delete_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Group deletion
+    Should keep the group nodes, which are updated after the deletion
+    """
+    instance._deleted_nodes = list(instance.matching_nodes.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def group_delete_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Group deletion
+    Should update the classification and counters of the former group nodes
+    """
+    node_ids = instance.__dict__.pop("_deleted_nodes", [])
+    NodeClassification.refresh(node_ids)
+    Node.refresh_counters(node_ids)
+
+
+@receiver(post_save, sender=Variable)
+def variable_change_handler(sender, **kwargs):
+    """
+    Signal receiver for Variable update
+    Should update the classification of the group nodes
+    """
+    if not kwargs["created"]:
+        NodeClassification.refresh_groups([kwargs["instance"].group_id])
+
+
+@receiver(post_save, sender=Environment)
+def environment_change_handler(sender, **kwargs):
+    """
+    Signal receiver for Environment update
+    Should update the classification of the nodes using the environment
+    """
+    if not kwargs["created"]:
+        NodeClassification.refresh_groups(kwargs["instance"].groups.all())
+
+
+@receiver(post_save, sender=ConfigurationClass)
+@receiver(post_delete, sender=ConfigurationClass)
+def configuration_class_change_handler(sender, **kwargs):
+    """
+    Signal receiver for ConfigurationClass changes
+    Should update the classification of the group nodes
+    """
+    NodeClassification.refresh_groups([kwargs["instance"].configuration_id])
+
+
+@receiver(post_save, sender=ConfigurationParameter)
+@receiver(post_delete, sender=ConfigurationParameter)
+def configuration_parameter_classification_handler(sender, **kwargs):
+    """
+    Signal receiver for ConfigurationParameter changes
+    Should update the classification of the group nodes
+    """
+    NodeClassification.refresh_groups(
+        ConfigurationClass.objects.filter(
+            pk=kwargs["instance"].configuration_class_id
+        ).values("configuration_id")
+    )
+
+
+@receiver(post_save, sender=MasterZone)
+@receiver(post_delete, sender=MasterZone)
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+@receiver(m2m_changed, sender=User.groups.through)
+def master_zones_cache_handler(sender, **kwargs):
+    """
+    Signal receiver for changes of the MasterZones and their permissions
+    Should invalidate the cached MasterZones
+    """
+    reference_cache.invalidate_on_commit(reference_cache.MASTER_ZONES)
+
+
+@receiver(post_save, sender=Environment)
+@receiver(post_delete, sender=Environment)
+def environments_cache_handler(sender, **kwargs):
+    """
+    Signal receiver for Environment changes
+    Should invalidate the cached Environments
+    """
+    reference_cache.invalidate_on_commit(reference_cache.ENVIRONMENTS)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tags_cache_handler(sender, **kwargs):
+    """
+    Signal receiver for Tag changes
+    Should invalidate the cached Tags
+    """
+    reference_cache.invalidate_on_commit(reference_cache.TAGS)
+
+
+@receiver(post_save, sender=PuppetClass)
+@receiver(post_delete, sender=PuppetClass)
+def puppet_classes_cache_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for PuppetClass changes
+    Should invalidate the cached classes of the environment
+    """
+    reference_cache.invalidate_on_commit(
+        reference_cache.puppet_classes(instance.environment_id)
+    )
+
+
+@receiver(post_save, sender=Parameter)
+@receiver(post_delete, sender=Parameter)
+def parameters_cache_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Parameter changes
+    Should invalidate the cached classes of the environment
+    """
+    for environment_id in PuppetClass.objects.filter(
+        pk=instance.puppet_class_id
+    ).values_list("environment_id", flat=True):
+        reference_cache.invalidate_on_commit(
+            reference_cache.puppet_classes(environment_id)
+        )
+
+
+@receiver(post_save, sender=Group)
+def group_search_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Group creation and update
+    Should update the search vector of the group
+    """
+    Group.refresh_search([instance.pk])
+
+
+@receiver(m2m_changed, sender=Group.tags.through)
+def group_tags_change_handler(sender, instance, action, **kwargs):
+    """
+    Signal receiver for changes of the Group tags
+    Should update the tag names and search vector of the group
+    """
+    if action in ("post_add", "post_remove", "post_clear"):
+        Group.refresh_search([instance.pk])
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_pre_delete_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Tag deletion
+    Should keep the tagged groups, which are updated after the deletion
+    """
+    instance._tagged_groups = list(
+        UUIDTaggedItem.objects.filter(tag=instance).values_list("object_id", flat=True)
+    )
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_search_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Tag update and deletion
+    Should update the tag names and search vector of the tagged groups
+    """
+    if kwargs.get("created"):
+        return
+    if "_tagged_groups" in instance.__dict__:
+        group_ids = instance.__dict__.pop("_tagged_groups")
+    else:
+        group_ids = UUIDTaggedItem.objects.filter(tag=instance).values_list(
+            "object_id", flat=True
+        )
+    Group.refresh_search(list(group_ids))
+
+
+@receiver(m2m_changed, sender=Group.matching_nodes.through)
+def group_nodes_counters_handler(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal receiver for changes of the Group nodes
+    Should update the counters of the affected groups and nodes
+    """
+    if action == "pre_clear":
+        if reverse:
+            instance._cleared_memberships = (
+                list(instance.group_set.values_list("pk", flat=True)),
+                [instance.pk],
+            )
+        else:
+            instance._cleared_memberships = (
+                [instance.pk],
+                list(instance.matching_nodes.values_list("pk", flat=True)),
+            )
+        return
+    if action == "post_clear":
+        group_ids, node_ids = instance.__dict__.pop("_cleared_memberships", ([], []))
+    elif action in ("post_add", "post_remove"):
+        if reverse:
+            group_ids, node_ids = pk_set, [instance.pk]
+        else:
+            group_ids, node_ids = [instance.pk], pk_set
+    else:
+        return
+    Group.refresh_counters(group_ids)
+    Node.refresh_counters(node_ids)
+
+
+@receiver(post_save, sender=Node)
+def node_create_handler(sender, instance, created, **kwargs):
+    """
+    Signal receiver for Node creation
+    Should update the nodes counter of its master zone
+    """
+    if created:
+        MasterZone.refresh_counters([instance.master_zone_id])
+
+
+class DeletedNodes:
+    """
+    Nodes deleted by the current transaction, e.g. by the cascade of a master
+    zone deletion
+    Their master zones and groups are recounted, and their classifications
+    purged, only once when the transaction commits
+    """
+
+    def __init__(self):
+        self.node_ids = set()
+        self.master_zone_ids = set()
+
+    @classmethod
+    def add(cls, node):
+        connection = transaction.get_connection()
+        pending = next(
+            (
+                callback
+                for _, callback in connection.run_on_commit
+                if isinstance(callback, cls)
+            ),
+            None,
+        )
+        scheduled = pending is not None
+        if not scheduled:
+            pending = cls()
+        pending.node_ids.add(node.pk)
+        pending.master_zone_ids.add(node.master_zone_id)
+        if not scheduled:
+            # Runs at once outside of a transaction
+            transaction.on_commit(pending)
+
+    def __call__(self):
+        MasterZone.refresh_counters(self.master_zone_ids)
+        # The groups only match nodes of their own master zone
+        Group.refresh_counters(
+            Group.objects.filter(master_zone_id__in=self.master_zone_ids).values("pk")
+        )
+        http_cache.purge(http_cache.node_key(node_id) for node_id in self.node_ids)
+
+
+@receiver(post_delete, sender=Node)
+def node_delete_handler(sender, instance, **kwargs):
+    """
+    Signal receiver for Node deletion
+    Should update the counters of its former groups and its master zone, and
+    purge its cached classification, see DeletedNodes
+    """
+    DeletedNodes.add(instance)
@@ -0,0 +1,29 @@
+from guardian.shortcuts import get_objects_for_user
+
+from core import cache as reference_cache
+
+
+def master_zone_ids(user, with_superuser=True):
+    """
+    Returns the set of ids of the master zones the user has access to
+    (core.has_access, given to the user or to one of their groups), all of
+    them for superusers unless with_superuser is False
+
+    The snapshot is kept on the user for the rest of the request, and in the
+    reference cache until the master zones or the permissions change
+    """
+    superuser = with_superuser and user.is_superuser
+    snapshots = getattr(user, "_master_zone_ids", None)
+    if snapshots is None:
+        snapshots = user._master_zone_ids = {}
+    if superuser not in snapshots:
+        snapshots[superuser] = reference_cache.get_or_set(
+            reference_cache.MASTER_ZONES,
+            "user:%s:%s" % (user.pk, "superuser" if superuser else "ids"),
+            lambda: set(
+                get_objects_for_user(
+                    user, "core.has_access", with_superuser=superuser
+                ).values_list("pk", flat=True)
+            ),
+        )
+    return snapshots[superuser]
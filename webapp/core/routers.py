@@ -0,0 +1,48 @@
+import random
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+# Apps whose reads always go to the primary database, since they are read
+# right after being written (e.g. the session after the login)
+PRIMARY_APPS = ("auth", "authtoken", "sessions", "guardian", "contenttypes")
+
+
+class ReplicaState(threading.local):
+    """
+    Whether the reads of the current thread may go to the read replicas
+    Set for each request by core.middleware.ReplicaRoutingMiddleware
+    """
+
+    use_replicas = False
+
+
+replica_state = ReplicaState()
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of read-only requests to one of the REPLICA_DATABASES,
+    everything else goes to the default database
+    """
+
+    def db_for_read(self, model, **hints):
+        if not replica_state.use_replicas or not settings.REPLICA_DATABASES:
+            return None
+        if model._meta.app_label in PRIMARY_APPS:
+            return None
+        # Reads inside a transaction must see its own writes
+        if connections["default"].in_atomic_block:
+            return None
+        return random.choice(settings.REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the default database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
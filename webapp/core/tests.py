@@ -1,7 +1,43 @@
+import importlib
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from urllib.error import URLError
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group as UserGroup, User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import DatabaseError, connection
 from django.db.models import TextField
-from django.test import TestCase
-
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from guardian.shortcuts import assign_perm, remove_perm
+from taggit.models import Tag
+
+from core import cache as reference_cache
+from core import http_cache
 from core import models
+from core.encryption import decrypt_counter, sensitive_value_cache
+from core.migrations._classification import compile_classes
+from core.permissions import master_zone_ids
+from core.routers import ReplicaRouter, replica_state
+from core.middleware import (
+    DatabaseHealthCheckMiddleware,
+    ReplicaRoutingMiddleware,
+    UserLogBuffer,
+    user_log_buffer,
+)
 from model_bakery import baker
 
 
@@ -438,3 +474,1205 @@ class ConfigurationParameterTests(TestCase):
             {"test1": "OK", "test2": "OK"},
             configuration_param_sensitive_hash.get_value(),
         )
+
+    def test_get_value_no_queries(self):
+        """
+        The decoded value should be read from the value column,
+        without fetching the parameter
+        """
+        param_hash = baker.make(models.Parameter, value_type=models.Parameter.HASH)
+        configuration_param = baker.make(
+            models.ConfigurationParameter,
+            raw_value='{"test1": ["OK", 1], "test2": {"test3": True}}',
+            parameter=param_hash,
+        )
+        configuration_param = models.ConfigurationParameter.objects.get(
+            pk=configuration_param.pk
+        )
+        with self.assertNumQueries(0):
+            value = configuration_param.get_value()
+        self.assertDictEqual({"test1": ["OK", 1], "test2": {"test3": True}}, value)
+
+    def test_backfill_value(self):
+        """
+        The migration should store the decoded value of existing parameters
+        """
+        migration = importlib.import_module(
+            "core.migrations.0004_configurationparameter_value"
+        )
+        params = {
+            models.Parameter.INTEGER: ("42", 42),
+            models.Parameter.ARRAY: ("['a', 'b']", ["a", "b"]),
+            models.Parameter.OPTIONAL: ("3.5", 3.5),
+        }
+        for value_type, (raw_value, _) in params.items():
+            parameter = baker.make(
+                models.Parameter, value_type=value_type, values=models.Parameter.FLOAT
+            )
+            baker.make(
+                models.ConfigurationParameter, raw_value=raw_value, parameter=parameter
+            )
+        sensitive_param = baker.make(
+            models.ConfigurationParameter,
+            raw_value="secret",
+            parameter=baker.make(models.Parameter, name="sensitive_password"),
+        )
+        # Legacy value saved before raw_value was validated
+        malformed_param = baker.prepare(
+            models.ConfigurationParameter,
+            raw_value="{'a': ",
+            parameter=baker.make(models.Parameter, value_type=models.Parameter.HASH),
+            _save_related=True,
+        )
+        # Legacy values JSON can not store unchanged
+        unencodable_params = [
+            baker.prepare(
+                models.ConfigurationParameter,
+                raw_value=raw_value,
+                parameter=baker.make(models.Parameter, value_type=value_type),
+                _save_related=True,
+            )
+            for value_type, raw_value in (
+                (models.Parameter.HASH, "{1: 'a'}"),
+                (models.Parameter.HASH, "{'a': {1, 2}}"),
+            )
+        ]
+        models.ConfigurationParameter.objects.bulk_create(
+            [malformed_param, *unencodable_params]
+        )
+        models.ConfigurationParameter.objects.update(value=None)
+
+        with self.assertLogs(migration.logger, "WARNING"):
+            migration.backfill_value(apps, None)
+
+        for value_type, (_, value) in params.items():
+            configuration_param = models.ConfigurationParameter.objects.get(
+                parameter__value_type=value_type
+            )
+            self.assertEqual(value, configuration_param.value)
+        for config_param in (malformed_param, *unencodable_params):
+            config_param.refresh_from_db()
+            self.assertIsNone(config_param.value)
+        sensitive_param.refresh_from_db()
+        self.assertIsNone(sensitive_param.value)
+        self.assertEqual("secret", sensitive_param.get_value())
+
+
+class NodeClassificationTests(TestCase):
+    """
+    Tests for the merged classification of the nodes
+    """
+
+    def setUp(self):
+        self.master_zone = baker.make(models.MasterZone)
+        self.node = baker.make(models.Node, master_zone=self.master_zone)
+        self.group = self._make_group("group1", {"role": "web"})
+
+    def _make_group(self, label, data):
+        group = baker.make(
+            models.Group,
+            label=label,
+            master_zone=self.master_zone,
+            environment__master_zone=self.master_zone,
+        )
+        group.matching_nodes.add(self.node)
+        group.variable.data = data
+        group.variable.save()
+        return group
+
+    def _classification(self):
+        return models.NodeClassification.objects.filter(node=self.node).first()
+
+    def test_refresh_on_membership_change(self):
+        """
+        Adding and removing nodes should update their classification
+        """
+        self.assertEqual(self._classification().parameters, {"role": "web"})
+        self.group.matching_nodes.remove(self.node)
+        self.assertIsNone(self._classification())
+        self.node.group_set.add(self.group)
+        self.assertEqual(
+            self._classification().environment, self.group.environment.name
+        )
+        self.group.matching_nodes.clear()
+        self.assertIsNone(self._classification())
+
+    def test_refresh_on_variables_change(self):
+        """
+        Updating the variables of a group should update its nodes
+        """
+        self.group.variable.data = {"role": "db"}
+        self.group.variable.save()
+        self.assertEqual(self._classification().parameters, {"role": "db"})
+
+    def test_refresh_on_group_delete(self):
+        """
+        Deleting a group should update its former nodes
+        """
+        group2 = self._make_group("group2", {"role": "db", "site": "a"})
+        self.assertEqual(self._classification().parameters, {"role": "db", "site": "a"})
+        group2.delete()
+        self.assertEqual(self._classification().parameters, {"role": "web"})
+
+    def test_group_precedence(self):
+        """
+        Higher priority groups should prevail, ties broken by label
+        """
+        group0 = self._make_group("group0", {"role": "db"})
+        self.assertEqual(self._classification().parameters, {"role": "web"})
+        group0.priority = 1
+        group0.save()
+        classification = self._classification()
+        self.assertEqual(classification.parameters, {"role": "db"})
+        self.assertEqual(classification.environment, group0.environment.name)
+
+    def test_refresh_on_classification_fields(self):
+        """
+        Saving a group should only refresh its nodes when the fields of the
+        classification changed
+        """
+        group = models.Group.objects.get(pk=self.group.pk)
+        with mock.patch.object(models.NodeClassification, "refresh_groups") as refresh:
+            group.description = "Pack my box with five dozen liquor jugs"
+            group.save()
+            refresh.assert_not_called()
+            group.priority = 1
+            group.save()
+            refresh.assert_called_once_with([group])
+
+    def test_migration_compile_classes(self):
+        """
+        The frozen copy of the migrations should compile the same
+        classification
+        """
+        baker.make(
+            models.ConfigurationParameter,
+            configuration_class__configuration=self.group.configuration,
+            configuration_class__puppet_class__name="profile::base",
+            parameter__name="user",
+            parameter__value_type=models.Parameter.STRING,
+            raw_value="root",
+        )
+        classification = self._classification()
+        compile_classes(apps, None)
+        migrated = self._classification()
+        for field in ("environment", "parameters", "classes", "conflicts"):
+            self.assertEqual(getattr(classification, field), getattr(migrated, field))
+
+    def test_deferred_refresh(self):
+        """
+        The refreshes requested inside the block should run when it ends
+        """
+        config_class = baker.make(
+            models.ConfigurationClass,
+            configuration=self.group.configuration,
+            puppet_class__name="profile::base",
+        )
+        with models.NodeClassification.deferred_refresh():
+            baker.make(
+                models.ConfigurationParameter,
+                configuration_class=config_class,
+                parameter__name="user",
+                parameter__value_type=models.Parameter.STRING,
+                raw_value="root",
+            )
+            self.assertEqual(self._classification().classes, {"profile::base": None})
+        self.assertEqual(
+            self._classification().classes, {"profile::base": {"user": "root"}}
+        )
+
+    def test_explain(self):
+        """
+        The explanation should tell which group sets each value and which
+        one prevails, in a constant number of queries
+        """
+        group0 = self._make_group("group0", {"role": "db", "site": "a"})
+        for group, user in ((group0, "admin"), (self.group, "root")):
+            config_class = baker.make(
+                models.ConfigurationClass,
+                configuration=group.configuration,
+                puppet_class__name="profile::base",
+            )
+            baker.make(
+                models.ConfigurationParameter,
+                configuration_class=config_class,
+                parameter__name="user",
+                parameter__value_type=models.Parameter.STRING,
+                raw_value=user,
+            )
+
+        with self.assertNumQueries(3):
+            explanation = models.NodeClassification.explain(self.node)
+        self.assertEqual(
+            [group["label"] for group in explanation["groups"]], ["group0", "group1"]
+        )
+        self.assertEqual(
+            explanation["environment"]["value"], self.group.environment.name
+        )
+        self.assertEqual(
+            explanation["variables"]["role"],
+            {
+                "value": "web",
+                "winner": {"id": str(self.group.pk), "label": "group1"},
+                "sources": [
+                    {"id": str(group0.pk), "label": "group0", "value": "db"},
+                    {"id": str(self.group.pk), "label": "group1", "value": "web"},
+                ],
+            },
+        )
+        self.assertEqual(explanation["variables"]["site"]["winner"]["label"], "group0")
+        user = explanation["classes"]["profile::base"]["parameters"]["user"]
+        self.assertEqual(user["value"], "root")
+        self.assertEqual(
+            [source["value"] for source in user["sources"]], ["admin", "root"]
+        )
+        # Same winner as the stored classification
+        self.assertEqual(
+            self._classification().classes, {"profile::base": {"user": "root"}}
+        )
+
+        self.group.matching_nodes.clear()
+        group0.matching_nodes.clear()
+        self.assertEqual(
+            models.NodeClassification.explain(self.node),
+            {"environment": None, "groups": [], "variables": {}, "classes": {}},
+        )
+
+
+class LookupIndexTests(TestCase):
+    """
+    Tests for the indexes of the classifier and sync lookups
+    """
+
+    def setUp(self):
+        self.master_zone = baker.make(models.MasterZone)
+        self.environment = baker.make(
+            models.Environment, name="production", master_zone=self.master_zone
+        )
+        self.puppet_class = baker.make(
+            models.PuppetClass, name="profile", environment=self.environment
+        )
+
+    def assertUsesIndex(self, queryset, columns=None, name=None):
+        """
+        The query plan should use the index on the given columns (or with the
+        given name), even with many rows sharing the same foreign key
+        """
+        table = queryset.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE %s" % table)
+            # Small tables are sequentially scanned otherwise
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            constraints = connection.introspection.get_constraints(cursor, table)
+        names = [
+            index_name
+            for index_name, constraint in constraints.items()
+            if (constraint["columns"] == columns or index_name == name)
+            and (constraint["index"] or constraint["unique"])
+        ]
+        self.assertEqual(len(names), 1)
+        self.assertIn(names[0], queryset.explain())
+
+    def test_node_lookup(self):
+        models.Node.objects.bulk_create(
+            models.Node(certname="node%d" % i, master_zone=self.master_zone)
+            for i in range(500)
+        )
+        self.assertUsesIndex(
+            models.Node.objects.filter(certname="node1", master_zone=self.master_zone),
+            ["certname", "master_zone_id"],
+        )
+
+    def test_environment_lookup(self):
+        models.Environment.objects.bulk_create(
+            models.Environment(name="env%d" % i, master_zone=self.master_zone)
+            for i in range(500)
+        )
+        self.assertUsesIndex(
+            models.Environment.objects.filter(
+                name="production", master_zone=self.master_zone
+            ),
+            ["name", "master_zone_id"],
+        )
+
+    def test_puppet_class_lookup(self):
+        models.PuppetClass.objects.bulk_create(
+            models.PuppetClass(name="class%d" % i, environment=self.environment)
+            for i in range(500)
+        )
+        self.assertUsesIndex(
+            models.PuppetClass.objects.filter(
+                name="profile", environment=self.environment
+            ),
+            ["name", "environment_id"],
+        )
+
+    def test_parameter_lookup(self):
+        models.Parameter.objects.bulk_create(
+            models.Parameter(name="param%d" % i, puppet_class=self.puppet_class)
+            for i in range(500)
+        )
+        self.assertUsesIndex(
+            models.Parameter.objects.filter(
+                name="param1", puppet_class=self.puppet_class
+            ),
+            ["name", "puppet_class_id"],
+        )
+
+    def test_configuration_parameter_lookup(self):
+        parameters = models.Parameter.objects.bulk_create(
+            models.Parameter(name="param%d" % i, puppet_class=self.puppet_class)
+            for i in range(500)
+        )
+        configuration_class = baker.make(
+            models.ConfigurationClass, puppet_class=self.puppet_class
+        )
+        models.ConfigurationParameter.objects.bulk_create(
+            models.ConfigurationParameter(
+                configuration_class=configuration_class, parameter=parameter
+            )
+            for parameter in parameters
+        )
+        self.assertUsesIndex(
+            models.ConfigurationParameter.objects.filter(
+                configuration_class=configuration_class, parameter=parameters[0]
+            ),
+            ["configuration_class_id", "parameter_id"],
+        )
+
+    def test_parameter_usage_lookup(self):
+        parameter = baker.make(models.Parameter, puppet_class=self.puppet_class)
+        config_classes = models.ConfigurationClass.objects.bulk_create(
+            models.ConfigurationClass(
+                configuration=baker.make(
+                    models.Group,
+                    master_zone=self.master_zone,
+                    environment=self.environment,
+                ).configuration,
+                puppet_class=baker.make(
+                    models.PuppetClass, environment=self.environment
+                ),
+            )
+            for i in range(20)
+        )
+        models.ConfigurationParameter.objects.bulk_create(
+            models.ConfigurationParameter(
+                configuration_class=config_class,
+                parameter=baker.make(models.Parameter, puppet_class=self.puppet_class),
+            )
+            for config_class in config_classes
+        )
+        self.assertUsesIndex(
+            models.ConfigurationParameter.objects.filter(parameter=parameter),
+            ["parameter_id"],
+        )
+        self.assertUsesIndex(
+            models.ConfigurationClass.objects.filter(puppet_class=self.puppet_class),
+            ["puppet_class_id"],
+        )
+
+    def test_node_groups_lookup(self):
+        nodes = models.Node.objects.bulk_create(
+            models.Node(certname="node%d" % i, master_zone=self.master_zone)
+            for i in range(500)
+        )
+        group = baker.make(
+            models.Group, master_zone=self.master_zone, environment=self.environment
+        )
+        group.matching_nodes.set(nodes)
+        self.assertUsesIndex(
+            models.Group.matching_nodes.through.objects.filter(node=nodes[0]),
+            ["node_id"],
+        )
+
+    def test_node_search(self):
+        models.Node.objects.bulk_create(
+            models.Node(certname="node%d" % i, master_zone=self.master_zone)
+            for i in range(500)
+        )
+        self.assertUsesIndex(
+            models.Node.objects.filter(certname__icontains="ode12"),
+            name="core_node_certname_trgm",
+        )
+
+    def test_group_search(self):
+        for i in range(500):
+            group = baker.make(
+                models.Group,
+                label="group%d" % i,
+                description="Group number %d" % i,
+                master_zone=self.master_zone,
+                environment=self.environment,
+            )
+            group.tags.add("tag%d" % i)
+        groups = models.Group.objects.all()
+        self.assertUsesIndex(
+            models.Group.search(groups, "tag12"), name="core_group_search_vector"
+        )
+        self.assertUsesIndex(
+            groups.filter(tag_names__overlap=["tag12"]), name="core_group_tag_names"
+        )
+        self.assertUsesIndex(
+            groups.filter(label__icontains="oup12"), name="core_group_label_trgm"
+        )
+        self.assertUsesIndex(
+            groups.filter(description__icontains="ber 12"),
+            name="core_group_description_trgm",
+        )
+
+    def test_fact_search(self):
+        models.Fact.objects.bulk_create(
+            models.Fact(name="fact%d" % i, master_zone=self.master_zone)
+            for i in range(500)
+        )
+        self.assertUsesIndex(
+            models.Fact.objects.filter(name__icontains="act12"),
+            name="core_fact_name_trgm",
+        )
+
+
+class GroupSearchTests(TestCase):
+    """
+    Tests for the search of groups
+    """
+
+    def setUp(self):
+        self.master_zone = baker.make(models.MasterZone)
+        self.environment = baker.make(models.Environment, master_zone=self.master_zone)
+
+    def _group(self, label, description="", tags=()):
+        group = models.Group.objects.create(
+            label=label,
+            description=description,
+            master_zone=self.master_zone,
+            environment=self.environment,
+        )
+        group.tags.add(*tags)
+        return group
+
+    def _search(self, text):
+        return [
+            group.label for group in models.Group.search(models.Group.objects, text)
+        ]
+
+    def test_ranking(self):
+        """
+        Label matches should come before tag matches, which should come
+        before description matches
+        """
+        self._group("databases", "Tomcat servers")
+        self._group("tomcat", "Application servers")
+        self._group("webservers", "Frontends", tags=["tomcat"])
+        self._group("others", "Other servers")
+        self.assertEqual(self._search("tomcat"), ["tomcat", "webservers", "databases"])
+        # Substrings of the label match, but rank after the word prefixes
+        self.assertEqual(
+            self._search("Serv"), ["databases", "others", "tomcat", "webservers"]
+        )
+        self.assertEqual(self._search("tom app"), ["tomcat"])
+        self.assertEqual(self._search("bases"), ["databases"])
+        self.assertEqual(self._search("(!)"), [])
+
+    def test_tags_changes(self):
+        """
+        The tag names should follow the changes of the group tags
+        """
+        group = self._group("webservers", tags=["linux", "nginx"])
+        group.refresh_from_db()
+        self.assertEqual(group.tag_names, ["linux", "nginx"])
+
+        group.tags.remove("nginx")
+        group.tags.add("apache")
+        tag = Tag.objects.get(name="apache")
+        tag.name = "httpd"
+        tag.save()
+        group.refresh_from_db()
+        self.assertEqual(group.tag_names, ["httpd", "linux"])
+        self.assertEqual(self._search("httpd"), ["webservers"])
+
+        Tag.objects.get(name="httpd").delete()
+        group.tags.clear()
+        group.refresh_from_db()
+        self.assertEqual(group.tag_names, [])
+        self.assertEqual(self._search("httpd"), [])
+
+        group.label = "apache"
+        group.save()
+        self.assertEqual(self._search("apache"), ["apache"])
+
+
+class CountersTests(TestCase):
+    """
+    Tests for the node counters of the groups, nodes and master zones
+    """
+
+    def setUp(self):
+        self.master_zone = baker.make(models.MasterZone)
+        self.nodes = [
+            models.Node.objects.create(
+                certname="node%d" % i, master_zone=self.master_zone
+            )
+            for i in range(3)
+        ]
+        self.groups = baker.make(
+            models.Group,
+            master_zone=self.master_zone,
+            environment__master_zone=self.master_zone,
+            _quantity=2,
+        )
+
+    def assertCounters(self, groups, nodes, master_zone):
+        self.assertEqual(
+            [
+                group.nodes_count
+                for group in models.Group.objects.filter(
+                    pk__in=[group.pk for group in self.groups]
+                ).order_by("label")
+            ],
+            groups,
+        )
+        self.assertEqual(
+            list(
+                models.Node.objects.filter(master_zone=self.master_zone)
+                .order_by("certname")
+                .values_list("groups_count", flat=True)
+            ),
+            nodes,
+        )
+        self.assertEqual(
+            models.MasterZone.objects.get(pk=self.master_zone.pk).nodes_count,
+            master_zone,
+        )
+
+    def test_memberships(self):
+        """
+        Adding, removing and clearing nodes should update the counters, from
+        both sides of the relation
+        """
+        self.groups.sort(key=lambda group: group.label)
+        group0, group1 = self.groups
+        self.assertCounters([0, 0], [0, 0, 0], 3)
+        group0.matching_nodes.add(*self.nodes)
+        self.assertCounters([3, 0], [1, 1, 1], 3)
+        self.nodes[0].group_set.add(group1)
+        self.assertCounters([3, 1], [2, 1, 1], 3)
+        group0.matching_nodes.remove(self.nodes[1])
+        self.assertCounters([2, 1], [2, 0, 1], 3)
+        self.nodes[0].group_set.clear()
+        self.assertCounters([1, 0], [0, 0, 1], 3)
+        group0.matching_nodes.clear()
+        self.assertCounters([0, 0], [0, 0, 0], 3)
+
+    @mock.patch("core.models.transaction.on_commit", lambda callback: callback())
+    def test_deletions(self):
+        """
+        Deleting groups and nodes should update the counters of the other side
+        """
+        self.groups.sort(key=lambda group: group.label)
+        group0, group1 = self.groups
+        group0.matching_nodes.set(self.nodes)
+        group1.matching_nodes.set(self.nodes[:2])
+        self.nodes[0].delete()
+        self.assertCounters([2, 1], [2, 1], 2)
+        group1.delete()
+        self.groups.remove(group1)
+        self.assertCounters([2], [1, 1], 2)
+
+    def test_refresh_counters_command(self):
+        """
+        The refresh_counters command should only fix the wrong counters
+        """
+        self.groups[0].matching_nodes.set(self.nodes)
+        models.Group.objects.update(nodes_count=0)
+        models.Node.objects.filter(pk=self.nodes[0].pk).update(groups_count=5)
+        out = StringIO()
+        call_command("refresh_counters", stdout=out)
+        self.assertIn(
+            "Fixed the counters of 1 groups, 1 nodes and 0 master zones", out.getvalue()
+        )
+        self.assertEqual(models.Group.objects.get(pk=self.groups[0].pk).nodes_count, 3)
+        self.assertEqual(models.Node.objects.get(pk=self.nodes[0].pk).groups_count, 1)
+
+    def test_migration_count_nodes(self):
+        """
+        The migration should fill the counters of the existing rows
+        """
+        migration = importlib.import_module("core.migrations.0012_counters")
+        self.groups.sort(key=lambda group: group.label)
+        self.groups[0].matching_nodes.set(self.nodes)
+        self.groups[1].matching_nodes.set(self.nodes[:1])
+        models.Group.objects.update(nodes_count=0)
+        models.Node.objects.update(groups_count=0)
+        models.MasterZone.objects.update(nodes_count=0)
+        migration.count_nodes(apps, None)
+        self.assertCounters([3, 1], [2, 1, 1], 3)
+
+
+class NodeDeletionCountersTests(TransactionTestCase):
+    """
+    Tests for the counters updated by the node deletions, once they commit
+    """
+
+    def _delete_nodes(self, total):
+        master_zone = baker.make(models.MasterZone)
+        nodes = [
+            models.Node.objects.create(certname="node%d" % i, master_zone=master_zone)
+            for i in range(total + 1)
+        ]
+        group = baker.make(
+            models.Group, master_zone=master_zone, environment__master_zone=master_zone
+        )
+        group.matching_nodes.set(nodes)
+        with CaptureQueriesContext(connection) as queries:
+            models.Node.objects.filter(pk__in=[node.pk for node in nodes[1:]]).delete()
+        self.assertEqual(models.Group.objects.get(pk=group.pk).nodes_count, 1)
+        self.assertEqual(
+            models.MasterZone.objects.get(pk=master_zone.pk).nodes_count, 1
+        )
+        return len(queries)
+
+    def test_cascade(self):
+        """
+        The counters should be recounted once, whatever the number of nodes
+        """
+        self.assertEqual(self._delete_nodes(1), self._delete_nodes(5))
+
+
+@override_settings(CACHE_PURGE_URL="http://cache.local/")
+@mock.patch("core.http_cache.transaction.on_commit", lambda callback: callback())
+@mock.patch("core.http_cache.urllib.request.urlopen")
+class HTTPCachePurgeTests(TestCase):
+    """
+    Tests for the purges of the classifier responses from the shared cache
+    """
+
+    def _purged_keys(self, urlopen):
+        return [
+            call[0][0].get_header(settings.SURROGATE_KEY_HEADER.capitalize())
+            for call in urlopen.call_args_list
+        ]
+
+    def test_purge_on_refresh(self, urlopen):
+        """
+        Changing the groups of a node should purge its classification
+        """
+        master_zone = baker.make(models.MasterZone)
+        node = baker.make(models.Node, master_zone=master_zone)
+        group = baker.make(
+            models.Group, master_zone=master_zone, environment__master_zone=master_zone
+        )
+        self.assertFalse(urlopen.called)
+
+        group.matching_nodes.add(node)
+        self.assertEqual(self._purged_keys(urlopen), ["node-%s" % node.pk])
+        self.assertEqual(urlopen.call_args[0][0].get_method(), "PURGE")
+
+        urlopen.reset_mock()
+        node_id = node.pk
+        node.delete()
+        self.assertEqual(self._purged_keys(urlopen), ["node-%s" % node_id])
+
+    def test_purge_batches(self, urlopen):
+        """
+        The keys should be sent in batches of PURGE_BATCH_SIZE
+        """
+        http_cache.purge("node-%03d" % i for i in range(150))
+        keys = self._purged_keys(urlopen)
+        self.assertEqual([len(batch.split()) for batch in keys], [100, 50])
+        self.assertTrue(keys[0].startswith("node-000 node-001 "))
+
+    def test_purge_failure(self, urlopen):
+        """
+        A failed purge should only be logged
+        """
+        urlopen.side_effect = URLError("Connection refused")
+        with self.assertLogs("core.http_cache", "WARNING"):
+            http_cache.purge(["node-1"])
+
+    def test_purge_disabled(self, urlopen):
+        with override_settings(CACHE_PURGE_URL=""):
+            http_cache.purge(["node-1"])
+        self.assertFalse(urlopen.called)
+
+
+class DecryptedValueCacheTests(TestCase):
+    """
+    Tests for the decrypted sensitive values cache
+    """
+
+    def setUp(self):
+        sensitive_value_cache.clear()
+        decrypt_counter.reset()
+        self.parameter = baker.make(
+            models.Parameter,
+            name="sensitive_password",
+            value_type=models.Parameter.STRING,
+        )
+
+    def _make(self, raw_value="secret"):
+        return baker.make(
+            models.ConfigurationParameter, raw_value=raw_value, parameter=self.parameter
+        )
+
+    def _load(self, configuration_param):
+        return models.ConfigurationParameter.objects.get(pk=configuration_param.pk)
+
+    def test_cached_decryption(self):
+        """
+        A sensitive value should be decrypted only once
+        """
+        configuration_param = self._make()
+        self.assertEqual("secret", self._load(configuration_param).get_value())
+        self.assertEqual("secret", self._load(configuration_param).get_value())
+        self.assertEqual(decrypt_counter.calls, 1)
+
+    def test_invalidated_on_update(self):
+        """
+        Updating or deleting a parameter should drop its cached value
+        """
+        configuration_param = self._load(self._make())
+        self.assertEqual(len(sensitive_value_cache), 1)
+        configuration_param.raw_value = "new secret"
+        configuration_param.save()
+        self.assertEqual(len(sensitive_value_cache), 0)
+        self.assertEqual("new secret", self._load(configuration_param).get_value())
+        configuration_param.delete()
+        self.assertEqual(len(sensitive_value_cache), 0)
+
+    def test_changed_ciphertext(self):
+        """
+        A row whose ciphertext changed should miss the cache
+        """
+        configuration_param = self._load(self._make())
+        configuration_param.raw_value = "new secret"
+        configuration_param.prepare_value()
+        models.ConfigurationParameter.objects.bulk_update(
+            [configuration_param], ["sensitive_value"]
+        )
+        self.assertEqual("new secret", self._load(configuration_param).get_value())
+        self.assertEqual(decrypt_counter.calls, 2)
+
+    @override_settings(SENSITIVE_VALUE_CACHE_SIZE=2)
+    def test_size_bound(self):
+        """
+        The least recently used values should be evicted
+        """
+        configuration_params = [self._load(self._make()) for i in range(3)]
+        self.assertEqual(len(sensitive_value_cache), 2)
+        self._load(configuration_params[0])
+        self.assertEqual(decrypt_counter.calls, 4)
+
+    @override_settings(SENSITIVE_VALUE_CACHE_TTL=60)
+    def test_ttl(self):
+        """
+        Values should be decrypted again once expired
+        """
+        configuration_param = self._make()
+        self._load(configuration_param)
+        with mock.patch("core.encryption.time.monotonic", return_value=1e12):
+            self._load(configuration_param)
+        self.assertEqual(decrypt_counter.calls, 2)
+
+    @override_settings(SENSITIVE_VALUE_CACHE_TTL=0)
+    def test_cache_disabled(self):
+        """
+        A zero TTL should disable the cache
+        """
+        configuration_param = self._make()
+        self._load(configuration_param)
+        self._load(configuration_param)
+        self.assertEqual(len(sensitive_value_cache), 0)
+        self.assertEqual(decrypt_counter.calls, 2)
+
+    @override_settings(DEBUG=True)
+    def test_decrypt_calls_header(self):
+        """
+        Responses should report the decryptions done by the request in DEBUG
+        """
+        username = "admin"
+        password = "admintestpass"
+        User.objects.create_superuser(
+            username=username, email="admin@example.com", password=password
+        )
+        self.client.login(username=username, password=password)
+        configuration_param = self._make()
+        group = configuration_param.configuration_class.configuration.group
+        url = "/api/configuration/" + str(group.id) + "/"
+        response = self.client.get(url)
+        self.assertEqual(response["X-Decrypt-Calls"], "1")
+        response = self.client.get(url)
+        self.assertEqual(response["X-Decrypt-Calls"], "0")
+        with self.settings(DEBUG=False):
+            response = self.client.get(url)
+        self.assertFalse(response.has_header("X-Decrypt-Calls"))
+
+
+@override_settings(USERLOG_BATCH_SIZE=3, USERLOG_FLUSH_INTERVAL=0)
+class UserLogBufferTests(TestCase):
+    """
+    Tests for the buffered writes of the UserLogMiddleware
+    """
+
+    def _user_log(self, path="/api/nodes/sync/"):
+        return models.UserLog(
+            request_path=path, request_method="POST", response_code="200"
+        )
+
+    def test_flush_on_batch_size(self):
+        """
+        The logs should only be written when the batch size is reached
+        """
+        buffer = UserLogBuffer()
+        buffer.append(self._user_log())
+        buffer.append(self._user_log())
+        self.assertEqual(models.UserLog.objects.count(), 0)
+        self.assertEqual(len(buffer), 2)
+        buffer.append(self._user_log())
+        self.assertEqual(models.UserLog.objects.count(), 3)
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush_pending_logs(self):
+        """
+        Flushing should write the pending logs only once
+        """
+        buffer = UserLogBuffer()
+        buffer.append(self._user_log())
+        buffer.flush()
+        buffer.flush()
+        self.assertEqual(models.UserLog.objects.count(), 1)
+
+    def test_flush_failure(self):
+        """
+        Logs that could not be written should be kept for the next flush,
+        without failing the request that triggered the write
+        """
+        buffer = UserLogBuffer()
+        buffer.append(self._user_log())
+        buffer.append(self._user_log())
+        with mock.patch.object(
+            models.UserLog.objects, "bulk_create", side_effect=DatabaseError
+        ), self.assertLogs("core.middleware", "ERROR"):
+            buffer.append(self._user_log())
+        self.assertEqual(len(buffer), 3)
+        buffer.append(self._user_log())
+        self.assertEqual(models.UserLog.objects.count(), 4)
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush_failure_limit(self):
+        """
+        At most max_pending_batches batches should be kept
+        """
+        buffer = UserLogBuffer()
+        buffer.max_pending_batches = 1
+        with mock.patch.object(
+            models.UserLog.objects, "bulk_create", side_effect=DatabaseError
+        ), self.assertLogs("core.middleware", "ERROR") as logs:
+            for i in range(4):
+                buffer.append(self._user_log(path="/%d/" % i))
+        self.assertEqual(len(buffer), 3)
+        self.assertIn("Dropped 1 user logs", "\n".join(logs.output))
+        buffer.flush()
+        self.assertEqual(
+            sorted(models.UserLog.objects.values_list("request_path", flat=True)),
+            ["/1/", "/2/", "/3/"],
+        )
+
+    def test_middleware_buffered_logs(self):
+        """
+        Logged requests should be buffered, keeping the request datetime
+        """
+        username = "admin"
+        password = "admintestpass"
+        user = User.objects.create_superuser(
+            username=username, email="admin@example.com", password=password
+        )
+        self.client.login(username=username, password=password)
+        self.client.post("/api/nodes/sync/", data=[], content_type="application/json")
+        self.client.post("/api/facts/sync/", data=[], content_type="application/json")
+        self.assertEqual(models.UserLog.objects.count(), 0)
+        user_log_buffer.flush()
+        logs = models.UserLog.objects.order_by("datetime")
+        self.assertEqual(
+            [log.request_path for log in logs], ["/api/nodes/sync/", "/api/facts/sync/"]
+        )
+        self.assertEqual(logs[0].user, user)
+        self.assertLess(logs[0].datetime, logs[1].datetime)
+
+
+class UserLogPurgeTests(TestCase):
+    """
+    Tests for the user logs retention
+    """
+
+    def setUp(self):
+        now = timezone.now()
+        for days in (1, 10, 40, 100, 400):
+            models.UserLog.objects.create(
+                request_path="/api/nodes/sync/",
+                request_method="POST",
+                response_code="200",
+                datetime=now - timedelta(days=days),
+            )
+
+    def test_purge(self):
+        """
+        Only the logs older than the retention period should be removed
+        """
+        deleted = models.UserLog.purge(30, batch_size=2)
+        self.assertEqual(deleted, 3)
+        self.assertEqual(models.UserLog.objects.count(), 2)
+
+    @override_settings(USERLOG_RETENTION_DAYS=90)
+    def test_purge_command(self):
+        """
+        The purge_userlogs command should use USERLOG_RETENTION_DAYS
+        """
+        out = StringIO()
+        call_command("purge_userlogs", days=90, stdout=out)
+        self.assertIn("Removed 2 logs", out.getvalue())
+        self.assertEqual(models.UserLog.objects.count(), 3)
+
+    def test_purge_command_disabled(self):
+        """
+        A retention of 0 days should keep all the logs
+        """
+        out = StringIO()
+        call_command("purge_userlogs", days=0, stdout=out)
+        self.assertEqual(models.UserLog.objects.count(), 5)
+
+
+class DatabaseHealthCheckTests(TestCase):
+    """
+    Tests for the health checks of the persistent database connections
+    """
+
+    @override_settings(DB_CONN_HEALTH_CHECKS=False)
+    def test_disabled(self):
+        """
+        The middleware should not be used unless enabled
+        """
+        with self.assertRaises(MiddlewareNotUsed):
+            DatabaseHealthCheckMiddleware()
+
+    @override_settings(DB_CONN_HEALTH_CHECKS=True)
+    def test_close_unusable_connection(self):
+        """
+        Only unusable connections should be closed
+        """
+        middleware = DatabaseHealthCheckMiddleware()
+        with mock.patch.object(connection, "close") as close:
+            with mock.patch.object(connection, "is_usable", return_value=True):
+                middleware.process_request(None)
+            close.assert_not_called()
+            with mock.patch.object(connection, "is_usable", return_value=False):
+                middleware.process_request(None)
+            close.assert_called_once_with()
+
+
+@override_settings(
+    REPLICA_DATABASES=["replica1"], REPLICA_STICKY_SECONDS=10, CACHE_SHARED=True
+)
+class ReplicaRoutingTests(SimpleTestCase):
+    """
+    Tests for the routing of the reads to the replicas
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = ReplicaRoutingMiddleware()
+        self.router = ReplicaRouter()
+
+    def tearDown(self):
+        replica_state.use_replicas = False
+
+    def _request(self, method, credentials=None):
+        extra = {"HTTP_AUTHORIZATION": credentials} if credentials else {}
+        request = getattr(self.factory, method)("/api/nodes/", **extra)
+        request.user = AnonymousUser()
+        self.middleware.process_request(request)
+        return request, self.router.db_for_read(models.Node)
+
+    def test_read_only_requests(self):
+        """
+        Only the reads of read-only requests should go to the replicas
+        """
+        request, db = self._request("get")
+        self.assertEqual(db, "replica1")
+        self.assertIsNone(self.router.db_for_read(User))
+        self.middleware.process_response(request, HttpResponse())
+        self.assertIsNone(self.router.db_for_read(models.Node))
+        self.assertIsNone(self._request("post")[1])
+        self.assertEqual(self.router.db_for_write(models.Node), "default")
+
+    def test_sticky_after_write(self):
+        """
+        A client should read from the default database after its own writes
+        """
+        request, db = self._request("post", "Basic dXNlcjpwYXNz")
+        self.middleware.process_response(request, HttpResponse())
+        self.assertIsNone(self._request("get", "Basic dXNlcjpwYXNz")[1])
+        self.assertEqual(self._request("get", "Basic b3RoZXI6cGFzcw==")[1], "replica1")
+
+    @override_settings(REPLICA_DATABASES=[])
+    def test_without_replicas(self):
+        """
+        Everything should go to the default database without replicas
+        """
+        self.assertIsNone(self._request("get")[1])
+
+    @override_settings(CACHE_SHARED=False)
+    def test_local_cache(self):
+        """
+        The replicas should not be used when the writes of a client are
+        tracked in a cache local to each process
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            ReplicaRoutingMiddleware()
+        with override_settings(REPLICA_DATABASES=[]):
+            ReplicaRoutingMiddleware()
+
+
+@override_settings(REFERENCE_CACHE_ENABLED=True)
+class ReferenceCacheTests(TestCase):
+    """
+    Tests for the cache of the reference data
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def _tags(self):
+        return reference_cache.get_or_set(
+            reference_cache.TAGS,
+            "names",
+            lambda: list(Tag.objects.values_list("name", flat=True)),
+        )
+
+    def test_cached_until_invalidated(self):
+        """
+        Values should be computed once per version of the namespace
+        """
+        Tag.objects.create(name="web")
+        self.assertEqual(self._tags(), ["web"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self._tags(), ["web"])
+
+        reference_cache.invalidate(reference_cache.TAGS)
+        Tag.objects.filter(name="web").update(name="db")
+        with self.assertNumQueries(1):
+            self.assertEqual(self._tags(), ["db"])
+
+    @override_settings(REFERENCE_CACHE_ENABLED=False)
+    def test_disabled(self):
+        """
+        Without a shared cache backend the values should always be computed
+        """
+        Tag.objects.create(name="web")
+        reference_cache.invalidate(reference_cache.TAGS)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._tags(), ["web"])
+        with self.assertNumQueries(1):
+            self.assertEqual(self._tags(), ["web"])
+
+    def test_lost_version(self):
+        """
+        Invalidating a namespace whose version was evicted should not fail
+        """
+        self.assertEqual(self._tags(), [])
+        cache.clear()
+        reference_cache.invalidate(reference_cache.TAGS)
+        Tag.objects.create(name="web")
+        self.assertEqual(self._tags(), ["web"])
+
+    def test_signals(self):
+        """
+        Changes of the reference data should invalidate the cached values
+        """
+        self.assertEqual(self._tags(), [])
+        tag = Tag.objects.create(name="web")
+        self.assertEqual(self._tags(), ["web"])
+        tag.delete()
+        self.assertEqual(self._tags(), [])
+
+        user = User.objects.create_user("user")
+        master_zone = baker.make(models.MasterZone)
+
+        def user_master_zones():
+            return reference_cache.get_or_set(
+                reference_cache.MASTER_ZONES,
+                "user:%s" % user.pk,
+                lambda: list(user.get_all_permissions(master_zone)),
+            )
+
+        self.assertEqual(user_master_zones(), [])
+        assign_perm("core.has_access", user, master_zone)
+        self.assertEqual(user_master_zones(), ["has_access"])
+
+
+@override_settings(REFERENCE_CACHE_ENABLED=True)
+class MasterZonePermissionsTests(TestCase):
+    """
+    Tests for the snapshot of the master zones each user has access to
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.master_zone = baker.make(models.MasterZone)
+        self.other_master_zone = baker.make(models.MasterZone)
+
+    def _fresh(self, user):
+        # A new instance, as loaded by the next request
+        return User.objects.get(pk=user.pk)
+
+    def test_snapshot(self):
+        """
+        The master zones should be read once and reused by the next requests
+        """
+        user = User.objects.create_user("user")
+        assign_perm("core.has_access", user, self.master_zone)
+
+        self.assertEqual(master_zone_ids(user), {self.master_zone.pk})
+        user = self._fresh(user)
+        with self.assertNumQueries(0):
+            self.assertEqual(master_zone_ids(user), {self.master_zone.pk})
+
+    def test_invalidation(self):
+        """
+        Granting or revoking a permission should be seen by the next request
+        """
+        user = User.objects.create_user("user")
+        user_group = UserGroup.objects.create(name="operators")
+        self.assertEqual(master_zone_ids(user), set())
+        user = self._fresh(user)
+        with self.assertNumQueries(0):
+            self.assertEqual(master_zone_ids(user), set())
+
+        assign_perm("core.has_access", user, self.master_zone)
+        self.assertEqual(master_zone_ids(self._fresh(user)), {self.master_zone.pk})
+
+        assign_perm("core.has_access", user_group, self.other_master_zone)
+        user.groups.add(user_group)
+        self.assertEqual(
+            master_zone_ids(self._fresh(user)),
+            {self.master_zone.pk, self.other_master_zone.pk},
+        )
+
+        remove_perm("core.has_access", user, self.master_zone)
+        self.assertEqual(
+            master_zone_ids(self._fresh(user)), {self.other_master_zone.pk}
+        )
+
+    def test_superuser(self):
+        """
+        Superusers should access every master zone, unless asked otherwise
+        """
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        assign_perm("core.has_access", user, self.master_zone)
+
+        self.assertEqual(
+            master_zone_ids(user), {self.master_zone.pk, self.other_master_zone.pk}
+        )
+        self.assertEqual(
+            master_zone_ids(user, with_superuser=False), {self.master_zone.pk}
+        )
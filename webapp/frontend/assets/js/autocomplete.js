@@ -2,8 +2,60 @@
 /* eslint no-param-reassign: 0 */
 const group = document.querySelectorAll('.autocomplete__list');
 const autocomplete = document.querySelectorAll('.autocomplete__name');
+const searchTimers = {};
+const searchRequests = {};
 let clicked = false;
 
+function escapeRegExp(text) {
+  return text.replace(/[.*+?^${}()|[\]\\]/g, '\\$&');
+}
+
+function showMatches(input, matches, total) {
+  const dataName = input.getAttribute('data-name') || 'name';
+  const regex = new RegExp(escapeRegExp(input.value), 'gi');
+  const html = matches.filter(pos => pos.active !== 'disabled').map((pos) => {
+    const resultName = input.value ? pos[dataName].replace(regex, '<span class="hl">$&</span>') : pos[dataName];
+    return `<li class="search__item" data-id="${pos.id}">${resultName}</li>`;
+  });
+
+  if (total > matches.length) {
+    html.push(`<li class="nothing-found">${total - matches.length} more, keep typing to narrow the search</li>`);
+  }
+
+  const list = input.nextElementSibling;
+  if (html.length > 0) {
+    list.innerHTML = html.join('');
+  } else {
+    list.innerHTML = '<li class="nothing-found">Nothing found</li>';
+  }
+}
+
+// Inputs with a data-search-url ask the server for the matches, instead of
+// filtering a list loaded with the page
+function fetchMatches(input) {
+  const dataKey = input.getAttribute('data-values');
+  clearTimeout(searchTimers[dataKey]);
+  searchTimers[dataKey] = setTimeout(() => {
+    const request = axios.get(input.getAttribute('data-search-url'), {
+      params: { q: input.value },
+    });
+    searchRequests[dataKey] = request;
+    request
+      .then((response) => {
+        // Drops the answers of outdated searches
+        if (searchRequests[dataKey] !== request) {
+          return;
+        }
+        search[dataKey] = response.data.results;
+        input.dispatchEvent(new CustomEvent('autocomplete:results', { detail: response.data }));
+        showMatches(input, search[dataKey], response.data.count);
+      })
+      .catch((error) => {
+        search[dataKey] = [];
+      });
+  }, 200);
+}
+
 function toggleAutocomplete(e) {
   clicked = false;
   const list = this.nextElementSibling;
@@ -16,6 +68,11 @@ function toggleAutocomplete(e) {
   list.style.zIndex = '1000';
   list.classList.add('autocomplete__list--show');
 
+  if (this.hasAttribute('data-search-url')) {
+    fetchMatches(this);
+    return;
+  }
+
   const dataKey = this.getAttribute('data-values');
   const dataName = this.getAttribute('data-name') || 'name';
   const html = search[dataKey].filter(pos => pos.active !== 'disabled')
@@ -30,7 +87,7 @@ function toggleAutocomplete(e) {
 
 function findMatches(wordToMatch, findOut, dataName) {
   return findOut.filter((word) => {
-    const regex = new RegExp(wordToMatch, 'gi');
+    const regex = new RegExp(escapeRegExp(wordToMatch), 'gi');
     return word[dataName].match(regex);
   });
 }
@@ -55,25 +112,15 @@ function getSelected(e) {
 
 function displayMatches() {
   clicked = false;
+  if (this.hasAttribute('data-search-url')) {
+    fetchMatches(this);
+    return;
+  }
+
   const dataKey = this.getAttribute('data-values');
   const dataName = this.getAttribute('data-name') || 'name';
-
   const matchArray = findMatches(this.value, search[dataKey], dataName);
-  const html = matchArray.map((pos) => {
-    const regex = new RegExp(this.value, 'gi');
-    const resultName = pos[dataName].replace(regex, `<span class="hl">${this.value}</span>`);
-    if (pos.active !== 'disabled') {
-      return `<li class="search__item" data-id="${pos.id}">${resultName}</li>`;
-    }
-    return '';
-  });
-
-  const list = this.nextElementSibling;
-  list.innerHTML = html.join('');
-
-  if (html.length === 0) {
-    list.innerHTML = '<li class="nothing-found">Nothing found</li>';
-  }
+  showMatches(this, matchArray, matchArray.length);
 }
 
 function closeAutocomplete(e) {
@@ -178,37 +178,34 @@ function generateClassBlock(blockIndex, blockId, blockName, blockValues, blockUs
     `;
 }
 
+function bindInputs() {
+  inputs = document.querySelectorAll('.value');
+  inputs.forEach((input) => {
+    input.addEventListener('keyup', validateValue);
+    input.addEventListener('blur', validateValue);
+  });
+
+  selects = document.querySelectorAll('.parameter');
+  selects.forEach((select) => {
+    select.addEventListener('change', changeInput);
+  });
+}
+
 function addClasses(e) {
   e.preventDefault();
-  axios.get(`${urlParameters}${classId.value}`)
-    .then((response) => {
-      search.classes.forEach((sitem) => {
-        if (sitem.name === className.value) {
-          sitem.active = 'disabled';
-        }
-      });
-
-      indice += 1;
-      container.insertAdjacentHTML('beforeend', generateClassBlock(indice, classId.value, className.value, response.data));
-      commitbar.classList.add('show-bar');
-      commit.removeAttribute('disabled');
-      className.value = '';
-      addClass.setAttribute('disabled', 'disabled');
-
-      inputs = document.querySelectorAll('.value');
-      inputs.forEach((input) => {
-        input.addEventListener('keyup', validateValue);
-        input.addEventListener('blur', validateValue);
-      });
+  const puppetClass = search.classes.find(sitem => sitem.id === classId.value);
+  if (!puppetClass) {
+    return;
+  }
 
-      selects = document.querySelectorAll('.parameter');
-      selects.forEach((select) => {
-        select.addEventListener('change', changeInput);
-      });
-    })
-    .catch((error) => {
-      alert('A problem ocurred, try again later');
-    });
+  puppetClass.active = 'disabled';
+  indice += 1;
+  container.insertAdjacentHTML('beforeend', generateClassBlock(indice, puppetClass.id, puppetClass.name, puppetClass.parameters));
+  commitbar.classList.add('show-bar');
+  commit.removeAttribute('disabled');
+  className.value = '';
+  addClass.setAttribute('disabled', 'disabled');
+  bindInputs();
 }
 
 function removeItem(e) {
@@ -290,86 +287,56 @@ function commitChanges() {
     });
 }
 
+// The environment classes, their parameters and the group configuration
+// come in a single request
 function loadClasses() {
-  axios.get(urlClasses)
+  axios.get(urlTree)
     .then((response) => {
-      search.classes = response.data;
+      container.innerHTML = '';
+      search.classes = response.data.classes;
       search.classes.forEach((sitem) => {
         sitem.active = 'enable';
       });
-    })
-    .then(() => {
-      axios.get(urlGroup)
-        .then((response) => {
-          container.innerHTML = '';
-
-          const classes = response.data.classes;
-          if (classes) {
-            classes.forEach((data) => {
-              search.classes.forEach((sitem) => {
-                if (sitem.name === data.puppet_class) {
-                  sitem.active = 'disabled';
-                }
-              });
-
-              const id = search.classes.filter(val => val.name === data.puppet_class);
-              if (id[0]) {
-                axios.get(`${urlParameters}${id[0].id}`)
-                  .then((params) => {
-                    const used = [];
-                    const htmlParameters = data.parameters.map((param) => {
-                      used.push(param.parameter);
-
-                      let value = param.value;
-                      if (typeof param.value === 'object') {
-                        value = `<pre>${JSON.stringify(param.value, null, 2)}</pre>`;
-                      }
-
-                      return `<tr>
-                        <td data-info="parameter">${param.parameter}</td>
-                        <td class="equal">=</td>
-                        <td data-info="value">${value}</td>
-                        <td class="align-right">
-                          <a class="link link--danger remove-item">Remove</a>
-                        </td>
-                      </tr>`;
-                    }).join('');
-
-                    indice += 1;
-                    container.insertAdjacentHTML('beforeend', generateClassBlock(indice, id.id, data.puppet_class, params.data, used, htmlParameters));
-
-                    inputs = document.querySelectorAll('.value');
-                    inputs.forEach((input) => {
-                      input.addEventListener('keyup', validateValue);
-                      input.addEventListener('blur', validateValue);
-                    });
-
-                    selects = document.querySelectorAll('.parameter');
-                    selects.forEach((select) => {
-                      select.addEventListener('change', changeInput);
-                    });
-                  })
-                  .catch((error) => {
-                    alert.classList.remove('alert--hide');
-                    alert.classList.add('alert--danger');
-                    alert.textContent = 'A problem ocurred, try again later!';
-                  });
-              }
-            });
+
+      response.data.configuration.forEach((data) => {
+        const puppetClass = search.classes.find(sitem => sitem.name === data.puppet_class);
+        if (!puppetClass) {
+          return;
+        }
+        puppetClass.active = 'disabled';
+
+        const used = [];
+        const htmlParameters = data.parameters.map((param) => {
+          used.push(param.parameter);
+
+          let value = param.value;
+          if (typeof param.value === 'object') {
+            value = `<pre>${JSON.stringify(param.value, null, 2)}</pre>`;
           }
-        })
-        .then(() => {
-          loader.classList.remove('loader--show');
-        })
-        .catch((error) => {
-          alert.classList.remove('alert--hide');
-          alert.classList.add('alert--danger');
-          alert.textContent = 'A problem ocurred, try again later!';
-          loader.classList.remove('loader--show');
-        });
+
+          return `<tr>
+            <td data-info="parameter">${param.parameter}</td>
+            <td class="equal">=</td>
+            <td data-info="value">${value}</td>
+            <td class="align-right">
+              <a class="link link--danger remove-item">Remove</a>
+            </td>
+          </tr>`;
+        }).join('');
+
+        indice += 1;
+        container.insertAdjacentHTML('beforeend', generateClassBlock(indice, puppetClass.id, puppetClass.name, puppetClass.parameters, used, htmlParameters));
+      });
+
+      bindInputs();
+      loader.classList.remove('loader--show');
     })
     .catch((error) => {
       search.classes = [];
+      alert.classList.remove('alert--hide');
+      alert.classList.add('alert--danger');
+      alert.textContent = 'A problem ocurred, try again later!';
+      loader.classList.remove('loader--show');
     });
 }
 
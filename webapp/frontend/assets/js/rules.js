@@ -60,12 +60,6 @@ function sendFormNodes(e) {
     </td>
     </tr>`;
 
-  search.certname.forEach((node) => {
-    if (node.certname === nodename.value) {
-      node.active = 'disabled';
-    }
-  });
-
   pinned.insertAdjacentHTML('beforeend', nodeLine);
   commitbar.classList.add('show-bar');
   commit.removeAttribute('disabled');
@@ -76,22 +70,18 @@ function sendFormNodes(e) {
 
 function removeItem(e) {
   if (e.target.classList.contains('remove-item')) {
-    const name = e.target.getAttribute('data-name');
-
     commitbar.classList.add('show-bar');
     commit.removeAttribute('disabled');
     e.target.closest('tr').remove();
-
-    search.certname.forEach((node) => {
-      if (node.certname === name) {
-        node.active = 'enable';
-      }
-    });
-
     totalpinned.textContent = document.querySelectorAll('#pinned_nodes tr').length;
   }
 }
 
+function pinnedCertnames() {
+  return Array.from(pinned.querySelectorAll('.remove-item'))
+    .map(link => link.getAttribute('data-name'));
+}
+
 function commitChanges() {
   this.setAttribute('disabled', 'disabled');
   loader.classList.add('loader--show');
@@ -181,21 +171,6 @@ axios.get(urlGroup)
 
     totalpinned.textContent = response.data.nodes.length;
     pinned.insertAdjacentHTML('beforeend', nodes);
-
-    axios.get(urlNodes)
-      .then((resp) => {
-        search.certname = resp.data;
-        search.certname.forEach((node) => {
-          if (response.data.nodes.includes(node.certname)) {
-            node.active = 'disabled';
-          } else {
-            node.active = 'enable';
-          }
-        });
-      })
-      .catch((error) => {
-        search.certname = [];
-      });
   })
   .catch((error) => {
     alert.classList.remove('alert--hide');
@@ -204,14 +179,6 @@ axios.get(urlGroup)
     loader.classList.remove('loader--show');
   });
 
-axios.get(urlFacts)
-  .then((response) => {
-    search.facts = response.data;
-  })
-  .catch((error) => {
-    search.facts = [];
-  });
-
 loader.classList.add('loader--show');
 
 fact.addEventListener('blur', validate);
@@ -233,6 +200,14 @@ nodesrule.forEach(radio => radio.addEventListener('change', () => {
   commit.removeAttribute('disabled');
 }));
 
+// The pinned nodes are not offered by the search
+nodename.addEventListener('autocomplete:results', (e) => {
+  const pinnedNodes = pinnedCertnames();
+  e.detail.results.forEach((node) => {
+    node.active = pinnedNodes.includes(node.certname) ? 'disabled' : 'enable';
+  });
+});
+
 autocompleteNodes.addEventListener('click', (e) => {
   if (e.target.className === 'search__item') {
     actionNodes.removeAttribute('disabled');
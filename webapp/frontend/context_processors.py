@@ -1,9 +1,16 @@
-from guardian.shortcuts import get_objects_for_user
+from django.utils.functional import SimpleLazyObject
+
+from core.models import MasterZone
+from core.permissions import master_zone_ids
 
 
 def master_zones(request):
     return {
-        "master_zones": get_objects_for_user(
-            request.user, "core.has_access", with_superuser=False
+        "master_zones": SimpleLazyObject(
+            lambda: list(
+                MasterZone.objects.filter(
+                    pk__in=master_zone_ids(request.user, with_superuser=False)
+                ).order_by("label")
+            )
         )
     }
@@ -11,12 +11,20 @@ class GroupForm(forms.ModelForm):
 
     class Meta:
         model = models.Group
-        fields = ("master_zone", "environment", "label", "description", "tags")
+        fields = (
+            "master_zone",
+            "environment",
+            "label",
+            "description",
+            "tags",
+            "priority",
+        )
         widgets = {"tags": CustomTagWidget(attrs={"placeholder": "Group tags"})}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields["environment"].queryset = models.Environment.objects.none()
+        self.fields["priority"].required = False
 
         if "master_zone" in self.data:
             try:
@@ -26,3 +34,8 @@ class GroupForm(forms.ModelForm):
                 self.fields["environment"].queryset = master_zone.environments.all()
             except (ValueError, TypeError):
                 pass
+
+    def clean_priority(self):
+        # Keeps the current priority when none is given
+        priority = self.cleaned_data["priority"]
+        return self.instance.priority if priority is None else priority
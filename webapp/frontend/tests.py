@@ -1,10 +1,16 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from datetime import datetime
+from urllib.parse import urlencode
 from core import models
 from guardian.shortcuts import assign_perm
 
 
+# The user logs are written by each request, the test transactions are not
+# visible to the background writer
+@override_settings(USERLOG_BATCH_SIZE=1, USERLOG_FLUSH_INTERVAL=0)
 class FrontendTestCase(TestCase):
     """
     Tests for the frontend app views
@@ -119,6 +125,50 @@ class FrontendTestCase(TestCase):
         # Assert objects in response in the right order
         self.assertEqual(list(response.context["page_obj"]), [log3, log2, log1])
 
+    def test_log_list_view_keyset_pagination(self):
+        """
+        Test UserLogListView pages, which are selected by the last log
+        of the previous page instead of an offset
+        """
+        self.user.is_superuser = True
+        self.user.save()
+        logs = [
+            models.UserLog(
+                user=self.user,
+                request_path="/api/nodes/sync/",
+                request_method="POST",
+                response_code="200",
+            )
+            for _ in range(120)
+        ]
+        # Some logs share the same datetime
+        models.UserLog.objects.bulk_create(logs[:60])
+        models.UserLog.objects.bulk_create(logs[60:])
+        expected = list(models.UserLog.objects.order_by("-datetime", "-id"))
+        url = "/logs/"
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page_obj = response.context["page_obj"]
+            pages.append(list(page_obj))
+            if page_obj.has_next():
+                url = "/logs/?" + urlencode({"after": page_obj.next_cursor})
+                self.assertContains(response, "next")
+            else:
+                url = None
+        self.assertEqual([len(page) for page in pages], [50, 50, 20])
+        self.assertEqual([log for page in pages for log in page], expected)
+
+    def test_log_list_view_invalid_cursor(self):
+        """
+        Test UserLogListView with an invalid page cursor
+        """
+        self.user.is_superuser = True
+        self.user.save()
+        response = self.client.get("/logs/?after=invalid")
+        self.assertEqual(response.status_code, 404)
+
     def test_group_list_view(self):
         """
         Test GroupListView
@@ -149,6 +199,47 @@ class FrontendTestCase(TestCase):
         # Assert user won't see Groups he's not permitted
         self.assertListEqual(list(response.context["page_obj"]), [])
 
+    @override_settings(REFERENCE_CACHE_ENABLED=True)
+    def test_group_list_view_num_queries(self):
+        """
+        GroupListView queries should not grow with the number of groups, and
+        the filter options should be cached
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="MasterZone1", address="0.0.0.0"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        assign_perm("core.has_access", self.user, master_zone)
+
+        def create_groups(first, total):
+            for i in range(first, first + total):
+                group = models.Group.objects.create(
+                    label="Group%d" % i,
+                    master_zone=master_zone,
+                    environment=environment,
+                )
+                group.tags.add("tag%d" % i, "linux", "web", "db")
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/groups/?clear=1")
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        create_groups(0, 2)
+        count_queries()
+        queries = count_queries()
+        create_groups(2, 5)
+        # The new tags invalidated the cached tags
+        self.assertEqual(count_queries(), queries + 1)
+        self.assertEqual(count_queries(), queries)
+
+        response = self.client.get("/groups/?clear=1")
+        self.assertEqual(len(response.context["page_obj"]), 7)
+        self.assertEqual(len(response.context["all_tags"]), 10)
+
     def test_group_list_view_tag_filter(self):
         """
         Test GroupListView filtering by tags
@@ -239,6 +330,44 @@ class FrontendTestCase(TestCase):
         # Assert only one group returned
         self.assertListEqual(list(response.context["page_obj"]), [group1])
 
+    def test_group_list_view_search(self):
+        """
+        Test GroupListView search, ranked by relevance
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="MasterZone1", address="0.0.0.0"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        assign_perm("core.has_access", self.user, master_zone)
+        group1 = models.Group.objects.create(
+            label="Group1",
+            description="Tomcat servers",
+            master_zone=master_zone,
+            environment=environment,
+        )
+        group2 = models.Group.objects.create(
+            label="Tomcat",
+            description="Group number two",
+            master_zone=master_zone,
+            environment=environment,
+        )
+        models.Group.objects.create(
+            label="Group3",
+            description="Group number three",
+            master_zone=master_zone,
+            environment=environment,
+        )
+
+        response = self.client.post("/groups/", data={"search": "tomc"}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(list(response.context["page_obj"]), [group2, group1])
+
+        # Sorting by a column replaces the ranking
+        response = self.client.get("/groups/?order_by=label")
+        self.assertListEqual(list(response.context["page_obj"]), [group1, group2])
+
     def test_group_list_view_description_filter(self):
         """
         Test GroupListView filtering by label
@@ -373,3 +502,148 @@ class FrontendTestCase(TestCase):
         self.assertTemplateUsed(response, "groups/index.html")
         # Assert group deleted
         self.assertFalse(models.Group.objects.filter(label="Group1").exists())
+
+    def test_group_rules_view(self):
+        """
+        Test group_detail_rules, whose autocompletes search the master zone
+        nodes and facts
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="MasterZone1", address="0.0.0.0"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        group = models.Group.objects.create(
+            label="Group1", master_zone=master_zone, environment=environment
+        )
+        url = "/groups/rules/%s" % group.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "groups/rules.html")
+        self.assertContains(
+            response,
+            'data-search-url="/api/nodes/search/?master_zone=%s"' % master_zone.id,
+        )
+        self.assertContains(
+            response,
+            'data-search-url="/api/facts/search/?master_zone=%s"' % master_zone.id,
+        )
+
+    def test_group_classes_view(self):
+        """
+        Test group_detail_classes, which loads the classes tree of the group
+        """
+        master_zone = models.MasterZone.objects.create(
+            label="MasterZone1", address="0.0.0.0"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        group = models.Group.objects.create(
+            label="Group1", master_zone=master_zone, environment=environment
+        )
+        url = "/groups/classes/%s" % group.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "groups/classes.html")
+        self.assertContains(response, "/api/configuration/%s/tree/" % group.id)
+
+    def _group_with_nodes(self, total):
+        master_zone = models.MasterZone.objects.create(
+            label="MasterZone1", address="0.0.0.0"
+        )
+        environment = models.Environment.objects.create(
+            name="production", master_zone=master_zone
+        )
+        group = models.Group.objects.create(
+            label="All Linux", master_zone=master_zone, environment=environment
+        )
+        group.matching_nodes.set(
+            models.Node.objects.create(
+                certname="%03d.acme" % i, master_zone=master_zone
+            )
+            for i in range(total)
+        )
+        return group
+
+    def test_group_nodes_view(self):
+        """
+        Test GroupNodesListView pagination and certname filter
+        """
+        group = self._group_with_nodes(60)
+        url = "/groups/nodes/%s" % group.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "groups/nodes.html")
+        self.assertEqual(response.context["paginator"].count, 60)
+        self.assertEqual(
+            [node.certname for node in response.context["nodes"]][:2],
+            ["000.acme", "001.acme"],
+        )
+        self.assertEqual(len(response.context["nodes"]), 50)
+
+        response = self.client.get(url, {"page": 2, "certname": "0"})
+        self.assertEqual(response.context["paginator"].count, 60)
+        self.assertEqual(len(response.context["nodes"]), 10)
+
+        response = self.client.get(url, {"certname": "05"})
+        self.assertEqual(
+            [node.certname for node in response.context["nodes"]],
+            ["005.acme"] + ["05%d.acme" % i for i in range(10)],
+        )
+        self.assertContains(response, "11 nodes match the certname filter")
+
+        # Counted from the nodes, whatever the nodes counter of the group
+        models.Group.objects.filter(pk=group.pk).update(nodes_count=0)
+        response = self.client.get(url, {"page": 2})
+        self.assertEqual(response.context["paginator"].count, 60)
+
+    def test_node_explain_view(self):
+        """
+        Test NodeExplainView, only shown to the users with access to the node
+        master zone
+        """
+        group = self._group_with_nodes(1)
+        node = group.matching_nodes.get()
+        group.variable.data = {"role": "web"}
+        group.variable.save()
+        url = "/nodes/explain/%s" % node.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        assign_perm("core.has_access", self.user, group.master_zone)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "nodes/explain.html")
+        self.assertEqual(
+            response.context["explanation"]["variables"]["role"]["winner"]["label"],
+            "All Linux",
+        )
+        self.assertContains(response, "This node is in 1 group,")
+
+    def test_group_nodes_export(self):
+        """
+        Test GroupNodesListView csv and ndjson exports
+        """
+        group = self._group_with_nodes(60)
+        url = "/groups/nodes/%s" % group.id
+        response = self.client.get(url, {"export": "csv"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="all-linux-nodes.csv"',
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[:2], ["certname", "000.acme"])
+        self.assertEqual(len(lines), 61)
+
+        response = self.client.get(url, {"export": "ndjson", "certname": "05"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], '{"certname": "005.acme"}')
+        self.assertEqual(len(lines), 11)
+
+        response = self.client.get(url, {"export": "xml"})
+        self.assertEqual(response.status_code, 404)
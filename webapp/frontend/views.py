@@ -1,30 +1,62 @@
+import csv
+import json
+
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
+from django.db.models import Count, Q
+from django.http import Http404, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse_lazy
+from core import cache as reference_cache
 from core import models
+from core.permissions import master_zone_ids
 from frontend import forms
 from taggit.models import Tag
-from guardian.shortcuts import get_objects_for_user, assign_perm
+from guardian.shortcuts import assign_perm
 
 
 class MasterZonePermissionRequiredMixin(PermissionRequiredMixin):
     permission_required = "core.has_access"
     raise_exception = True
 
+    def get_object(self, queryset=None):
+        """
+        Fetches the object once, for the permission check and the view
+        """
+        if not hasattr(self, "_permission_object"):
+            self._permission_object = super().get_object(queryset)
+        return self._permission_object
+
     def has_permission(self):
         """
         Checks user permission to Zone object
-        Treats Zones, Masters and Groups
+        Treats Zones, Masters, Groups and Nodes
         """
-        perms = self.get_permission_required()
         obj = self.get_object()
         if isinstance(obj, models.MasterZone):
-            obj = obj
-        elif isinstance(obj, models.Group):
-            obj = obj.master_zone
-        return self.request.user.has_perms(perms, obj)
+            master_zone_id = obj.pk
+        elif isinstance(obj, (models.Group, models.Node)):
+            master_zone_id = obj.master_zone_id
+        return master_zone_id in master_zone_ids(self.request.user)
+
+
+def _user_master_zones(user):
+    """
+    Master zones the user has access to, from the permissions snapshot
+    """
+    return models.MasterZone.objects.filter(pk__in=master_zone_ids(user))
+
+
+def _all_tags():
+    return reference_cache.get_or_set(
+        reference_cache.TAGS,
+        "names",
+        lambda: list(Tag.objects.all().values_list("name", flat=True)),
+    )
 
 
 def _order_by_value(value, request):
@@ -43,11 +75,14 @@ class MasterZoneListView(LoginRequiredMixin, ListView):
         Filter by user permission to MasterZone
         """
 
-        queryset = get_objects_for_user(self.request.user, "core.has_access")
+        # The nodes are counted in MasterZone.nodes_count
+        queryset = _user_master_zones(self.request.user).annotate(
+            groups_count=Count("group")
+        )
 
         if self.request.GET.get("clear", None):
             self.request.session["master_zone_list_filter"] = {}
-            return queryset.distinct().order_by("label")
+            return queryset.order_by("label")
 
         if self.request.method == "POST":
             master_zone_list_filter = {"label": self.request.POST.get("label", "")}
@@ -77,6 +112,7 @@ class MasterZoneListView(LoginRequiredMixin, ListView):
         context["order_by"] = {
             "label": _order_by_value("label", self.request),
             "address": _order_by_value("address", self.request),
+            "nodes_count": _order_by_value("nodes_count", self.request),
         }
         return context
 
@@ -108,7 +144,7 @@ class MasterZoneEdit(LoginRequiredMixin, MasterZonePermissionRequiredMixin, Upda
         Filter MasterZones field queryset
         """
         form = super().get_form(**kwargs)
-        form.queryset = get_objects_for_user(self.request.user, "core.has_access")
+        form.queryset = _user_master_zones(self.request.user)
         return form
 
 
@@ -126,6 +162,33 @@ class MasterZoneDelete(
         return context
 
 
+def _group_list_facets():
+    """
+    Options of the group list filters, cached until the tags, master zones
+    or environments change
+    """
+    return {
+        "all_tags": _all_tags(),
+        "all_master_zones": reference_cache.get_or_set(
+            reference_cache.MASTER_ZONES,
+            "labels",
+            lambda: [
+                {"id": str(master_zone["id"]), "label": master_zone["label"]}
+                for master_zone in models.MasterZone.objects.all().values("id", "label")
+            ],
+        ),
+        "all_environments_names": reference_cache.get_or_set(
+            reference_cache.ENVIRONMENTS,
+            "names",
+            lambda: list(
+                models.Environment.objects.all()
+                .values_list("name", flat=True)
+                .distinct()
+            ),
+        ),
+    }
+
+
 class GroupListView(LoginRequiredMixin, ListView):
     model = models.Group
     paginate_by = 10
@@ -136,20 +199,22 @@ class GroupListView(LoginRequiredMixin, ListView):
         """
         Filter by Master, tags and user permission to Group
         """
-        qs_filter = {
-            "master_zone__in": get_objects_for_user(
-                self.request.user, "core.has_access"
-            )
-        }
+        qs_filter = {"master_zone_id__in": master_zone_ids(self.request.user)}
+
+        # The rows show the master zone, environment and tags of each group
+        groups = models.Group.objects.select_related(
+            "master_zone", "environment"
+        ).prefetch_related("tags")
 
         if "clear" in self.request.GET:
             self.master_zone = None
             self.environment = None
             self.request.session["group_list_filter"] = {}
-            return models.Group.objects.filter(**qs_filter).distinct().order_by("label")
+            return groups.filter(**qs_filter).order_by("label")
 
         if self.request.method == "POST":
             group_list_filter = {
+                "search": self.request.POST.get("search", ""),
                 "tags": self.request.POST.get("tags", ""),
                 "label": self.request.POST.get("label", ""),
                 "environment__name": self.request.POST.get("environment__name", ""),
@@ -167,7 +232,8 @@ class GroupListView(LoginRequiredMixin, ListView):
 
         if tags:
             tags = tags.replace('"', "")
-            qs_filter["tags__name__in"] = tags.split(",")
+            # Denormalized tag names, avoiding a join and a DISTINCT
+            qs_filter["tag_names__overlap"] = tags.split(",")
 
         if group_list_filter.get("master_zone"):
             self.master_zone = get_object_or_404(
@@ -189,14 +255,21 @@ class GroupListView(LoginRequiredMixin, ListView):
         if description:
             qs_filter["description__icontains"] = description
 
+        groups = groups.filter(**qs_filter)
+        search = group_list_filter.get("search")
+        if search:
+            groups = models.Group.search(groups, search)
+            # Ranked by relevance, unless sorted by a column
+            if "order_by" not in self.request.GET:
+                return groups
+
         order_by = self.request.GET.get("order_by", "label")
 
-        return models.Group.objects.filter(**qs_filter).distinct().order_by(order_by)
+        return groups.order_by(order_by)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["master_zone"] = self.master_zone
-        context["all_tags"] = list(Tag.objects.all().values_list("name", flat=True))
         context["group_list_filter"] = self.request.session.get("group_list_filter", {})
 
         context["order_by"] = {
@@ -204,17 +277,10 @@ class GroupListView(LoginRequiredMixin, ListView):
             "master_zone__label": _order_by_value("master_zone__label", self.request),
             "environment__name": _order_by_value("environment__name", self.request),
             "description": _order_by_value("description", self.request),
+            "nodes_count": _order_by_value("nodes_count", self.request),
         }
 
-        context["all_master_zones"] = []
-        for master_zone in models.MasterZone.objects.all().values("id", "label"):
-            master_zone["id"] = str(master_zone["id"])
-            context["all_master_zones"].append(master_zone)
-
-        context["all_environments_names"] = list(
-            models.Environment.objects.all().values_list("name", flat=True).distinct()
-        )
-
+        context.update(_group_list_facets())
         return context
 
     def post(self, request, *args, **kwargs):
@@ -230,13 +296,102 @@ def group_detail_classes(request, pk):
     )
 
 
-def group_detail_nodes(request, pk):
-    group = models.Group.objects.get(id=pk)
-    return render(
-        request,
-        "groups/nodes.html",
-        {"group": group, "nodes": group.matching_nodes.all()},
-    )
+class _Echo:
+    """
+    File-like object returning what is written, for streaming csv rows
+    """
+
+    def write(self, value):
+        return value
+
+
+def _csv_lines(certnames):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(["certname"])
+    for certname in certnames:
+        yield writer.writerow([certname])
+
+
+def _ndjson_lines(certnames):
+    for certname in certnames:
+        yield json.dumps({"certname": certname}) + "\n"
+
+
+NODES_EXPORT_FORMATS = {
+    "csv": ("text/csv", _csv_lines),
+    "ndjson": ("application/x-ndjson", _ndjson_lines),
+}
+
+
+class GroupNodesListView(LoginRequiredMixin, ListView):
+    paginate_by = 50
+    template_name = "groups/nodes.html"
+    context_object_name = "nodes"
+    export_chunk_size = 2000
+
+    def get_queryset(self):
+        """
+        Nodes of the group, filtered by certname
+        """
+        self.group = get_object_or_404(
+            models.Group.objects.select_related("master_zone"), pk=self.kwargs["pk"]
+        )
+        queryset = self.group.matching_nodes.order_by("certname")
+        certname = self.request.GET.get("certname")
+        if certname:
+            queryset = queryset.filter(certname__icontains=certname)
+        return queryset
+
+    def get(self, request, *args, **kwargs):
+        """
+        Streams every node of the group (still filtered by certname) when an
+        export format is requested
+        """
+        export = request.GET.get("export")
+        if not export:
+            return super().get(request, *args, **kwargs)
+        if export not in NODES_EXPORT_FORMATS:
+            raise Http404("Invalid export format")
+
+        content_type, generator = NODES_EXPORT_FORMATS[export]
+        certnames = (
+            self.get_queryset()
+            .values_list("certname", flat=True)
+            .iterator(chunk_size=self.export_chunk_size)
+        )
+        response = StreamingHttpResponse(
+            generator(certnames), content_type=content_type
+        )
+        response["Content-Disposition"] = 'attachment; filename="%s-nodes.%s"' % (
+            slugify(self.group.label),
+            export,
+        )
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["group"] = self.group
+        context["certname"] = self.request.GET.get("certname", "")
+        return context
+
+
+class NodeExplainView(
+    LoginRequiredMixin, MasterZonePermissionRequiredMixin, DetailView
+):
+    model = models.Node
+    template_name = "nodes/explain.html"
+    context_object_name = "node"
+
+    def get_queryset(self):
+        return super().get_queryset().select_related("master_zone")
+
+    def get_context_data(self, **kwargs):
+        """
+        Adds the groups of the node and what each one sets
+        """
+        context = super().get_context_data(**kwargs)
+        context["explanation"] = models.NodeClassification.explain(self.object)
+        return context
 
 
 def group_detail_rules(request, pk):
@@ -257,7 +412,11 @@ def group_detail_variables(request, pk):
 
 def group_environments_options(request):
     master_zone = models.MasterZone.objects.get(id=request.GET.get("master_zone"))
-    environments = master_zone.environments.all()
+    environments = reference_cache.get_or_set(
+        reference_cache.ENVIRONMENTS,
+        "master_zone:%s" % master_zone.pk,
+        lambda: list(master_zone.environments.all()),
+    )
     return render(request, "groups/environments.html", {"environments": environments})
 
 
@@ -271,14 +430,12 @@ class GroupCreate(LoginRequiredMixin, CreateView):
         Filter Masters field queryset
         """
         form = super().get_form(**kwargs)
-        form.fields["master_zone"].queryset = get_objects_for_user(
-            self.request.user, "core.has_access"
-        )
+        form.fields["master_zone"].queryset = _user_master_zones(self.request.user)
         return form
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["all_tags"] = list(Tag.objects.all().values_list("name", flat=True))
+        context["all_tags"] = _all_tags()
         return context
 
 
@@ -292,15 +449,13 @@ class GroupEdit(LoginRequiredMixin, MasterZonePermissionRequiredMixin, UpdateVie
         Filter Masters field queryset
         """
         form = super().get_form(**kwargs)
-        form.fields["master_zone"].queryset = get_objects_for_user(
-            self.request.user, "core.has_access"
-        )
+        form.fields["master_zone"].queryset = _user_master_zones(self.request.user)
         form.fields.pop("environment")
         return form
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["all_tags"] = list(Tag.objects.all().values_list("name", flat=True))
+        context["all_tags"] = _all_tags()
         return context
 
 
@@ -316,10 +471,29 @@ class GroupDelete(LoginRequiredMixin, MasterZonePermissionRequiredMixin, DeleteV
         return context
 
 
+class KeysetPage:
+    """
+    Page of a keyset paginated list, which only knows the next page cursor
+    """
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
 class UserLogListView(PermissionRequiredMixin, ListView):
     model = models.UserLog
     paginate_by = 50
-    ordering = ("-datetime",)
+    ordering = ("-datetime", "-id")
     template_name = "logs.html"
 
     def has_permission(self):
@@ -328,6 +502,33 @@ class UserLogListView(PermissionRequiredMixin, ListView):
         """
         return self.request.user.is_superuser
 
+    def get_queryset(self):
+        return super().get_queryset().select_related("user")
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Keyset pagination: each page starts after the (datetime, id) of the
+        previous page last log, so page N is as fast as the first page
+        """
+        cursor = self.request.GET.get("after")
+        if cursor:
+            log_datetime, _, log_id = cursor.rpartition("_")
+            log_datetime = parse_datetime(log_datetime)
+            if log_datetime is None or not log_id.isdigit():
+                raise Http404("Invalid page")
+            queryset = queryset.filter(
+                Q(datetime__lt=log_datetime) | Q(datetime=log_datetime, id__lt=log_id)
+            )
+
+        logs = list(queryset[: page_size + 1])
+        next_cursor = None
+        if len(logs) > page_size:
+            logs = logs[:page_size]
+            last_log = logs[-1]
+            next_cursor = "%s_%s" % (last_log.datetime.isoformat(), last_log.id)
+        page = KeysetPage(logs, next_cursor)
+        return (None, page, logs, page.has_next() or bool(cursor))
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["list_headers"] = models.UserLog.list_headers()
@@ -33,6 +33,17 @@ DB_HOST = os.environ.get("POSTGRES_HOST", "db")
 DB_PORT = int(os.environ.get("POSTGRES_PORT", "5432"))
 DB_USER = os.environ.get("POSTGRES_USER", "postgres")
 DB_PASS = os.environ.get("POSTGRES_PASSWORD", None)
+# Seconds a connection is reused across requests (0 closes it after each one)
+DB_CONN_MAX_AGE = int(os.environ.get("POSTGRES_CONN_MAX_AGE", "60"))
+# Checks reused connections before each request, dropping broken ones
+DB_CONN_HEALTH_CHECKS = (
+    os.environ.get("POSTGRES_CONN_HEALTH_CHECKS", "False").lower() == "true"
+)
+# Needed behind a transaction pooling pooler (e.g. PgBouncer), where the
+# cursors of a transaction may not reach the same server connection
+DB_DISABLE_SERVER_SIDE_CURSORS = (
+    os.environ.get("POSTGRES_DISABLE_SERVER_SIDE_CURSORS", "False").lower() == "true"
+)
 
 # Application definition
 
@@ -64,14 +75,20 @@ AUTHENTICATION_BACKENDS = (
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    # Middleware for dropping broken persistent database connections
+    "core.middleware.DatabaseHealthCheckMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    # Middleware for sending the reads of read-only requests to the replicas
+    "core.middleware.ReplicaRoutingMiddleware",
     # Middleware for storing user activity logs
     "core.middleware.UserLogMiddleware",
+    # Middleware for counting the decryptions done by each request
+    "core.middleware.DecryptMetricsMiddleware",
 ]
 
 if not DEBUG:
@@ -120,12 +137,36 @@ DATABASES = {
         "USER": DB_USER,
         "HOST": DB_HOST,
         "PORT": DB_PORT,
+        "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+        "DISABLE_SERVER_SIDE_CURSORS": DB_DISABLE_SERVER_SIDE_CURSORS,
     }
 }
 
 if DB_PASS:
     DATABASES["default"]["PASSWORD"] = DB_PASS
 
+# Read replicas, as a comma separated list of host[:port]
+# The reads of read-only requests are sent to one of them
+# REPLICA_STICKY_SECONDS -> Time a client reads from the default database
+# after its own writes, tracked in the cache (it must be shared, see CACHES)
+REPLICA_DATABASES = []
+for index, replica in enumerate(
+    filter(None, os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",")), 1
+):
+    host, _, port = replica.strip().partition(":")
+    alias = "replica%d" % index
+    DATABASES[alias] = dict(
+        DATABASES["default"],
+        HOST=host,
+        PORT=int(port or DB_PORT),
+        # Tests only use the default database
+        TEST={"MIRROR": "default"},
+    )
+    REPLICA_DATABASES.append(alias)
+REPLICA_STICKY_SECONDS = int(os.environ.get("POSTGRES_REPLICA_STICKY_SECONDS", "10"))
+
+DATABASE_ROUTERS = ["core.routers.ReplicaRouter"]
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -165,4 +206,60 @@ MEDIA_ROOT = os.path.join(BASE_DIR, "uploads")
 
 # LOG Configs
 # USERLOG_METHODS -> Which methods are logged
+# USERLOG_BATCH_SIZE -> How many logs are buffered before being written
+# USERLOG_FLUSH_INTERVAL -> Max seconds a log waits in the buffer (0 disables)
+# USERLOG_RETENTION_DAYS -> Logs older than this are removed by purge_userlogs
 USERLOG_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+USERLOG_BATCH_SIZE = int(os.environ.get("USERLOG_BATCH_SIZE", "100"))
+USERLOG_FLUSH_INTERVAL = float(os.environ.get("USERLOG_FLUSH_INTERVAL", "5"))
+USERLOG_RETENTION_DAYS = int(os.environ.get("USERLOG_RETENTION_DAYS", "90"))
+
+# Decrypted sensitive values cache (in memory, per process)
+# SENSITIVE_VALUE_CACHE_SIZE -> Max number of decrypted values kept
+# SENSITIVE_VALUE_CACHE_TTL -> Seconds a decrypted value is kept (0 disables)
+SENSITIVE_VALUE_CACHE_SIZE = int(os.environ.get("SENSITIVE_VALUE_CACHE_SIZE", "10000"))
+SENSITIVE_VALUE_CACHE_TTL = float(os.environ.get("SENSITIVE_VALUE_CACHE_TTL", "300"))
+
+# Cache backend, local to each process unless it points to a shared server
+# CACHE_BACKEND -> Django cache backend, e.g.
+# django.core.cache.backends.memcached.MemcachedCache or
+# django_redis.cache.RedisCache (their client libraries must be installed)
+# CACHE_LOCATION -> Address of the cache server
+# CACHE_TIMEOUT -> Default seconds an entry is kept
+# REFERENCE_CACHE_TIMEOUT -> Seconds the reference data (master zones,
+# environments, tags...) is kept, it is also invalidated when changed
+# The reference data is only cached, and the read replicas only used, with a
+# backend shared by all the processes, a process does not see the entries
+# written by the others in a local one
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+        "TIMEOUT": int(os.environ.get("CACHE_TIMEOUT", "300")),
+        "KEY_PREFIX": "grua",
+    }
+}
+REFERENCE_CACHE_TIMEOUT = int(os.environ.get("REFERENCE_CACHE_TIMEOUT", "3600"))
+CACHE_SHARED = CACHES["default"]["BACKEND"] not in (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+REFERENCE_CACHE_ENABLED = CACHE_SHARED
+
+# Shared HTTP cache (e.g. Varnish with xkey, or a CDN) in front of the
+# node_classifier endpoint, see core.http_cache
+# CLASSIFIER_CACHE_MAX_AGE -> Seconds a classification may be kept by the
+# shared cache (0 disables)
+# CACHE_PURGE_URL -> Address the purges of the changed classifications are
+# sent to (purges are disabled when empty)
+# CACHE_PURGE_METHOD -> HTTP method of the purges
+# CACHE_PURGE_TIMEOUT -> Seconds a purge may take
+# SURROGATE_KEY_HEADER -> Header carrying the surrogate keys, in the
+# classifications and the purges
+CLASSIFIER_CACHE_MAX_AGE = int(os.environ.get("CLASSIFIER_CACHE_MAX_AGE", "0"))
+CACHE_PURGE_URL = os.environ.get("CACHE_PURGE_URL", "")
+CACHE_PURGE_METHOD = os.environ.get("CACHE_PURGE_METHOD", "PURGE")
+CACHE_PURGE_TIMEOUT = float(os.environ.get("CACHE_PURGE_TIMEOUT", "2"))
+SURROGATE_KEY_HEADER = os.environ.get("SURROGATE_KEY_HEADER", "Surrogate-Key")
@@ -86,7 +86,9 @@ urlpatterns = [
         name="groups-classes",
     ),
     path(
-        "groups/nodes/<uuid:pk>", frontend_views.group_detail_nodes, name="groups-nodes"
+        "groups/nodes/<uuid:pk>",
+        frontend_views.GroupNodesListView.as_view(),
+        name="groups-nodes",
     ),
     path(
         "groups/rules/<uuid:pk>", frontend_views.group_detail_rules, name="groups-rules"
@@ -109,6 +111,11 @@ urlpatterns = [
         frontend_views.GroupDelete.as_view(),
         name="groups-delete",
     ),
+    path(
+        "nodes/explain/<uuid:pk>",
+        frontend_views.NodeExplainView.as_view(),
+        name="nodes-explain",
+    ),
     path("logs/", frontend_views.UserLogListView.as_view(), name="logs-index"),
     path("accounts/", include("django.contrib.auth.urls")),
     path("docs/", frontend_views.docs_view, name="api-documentation"),
@@ -0,0 +1,41 @@
+"""
+Gunicorn settings for running GRUA in production
+
+    gunicorn -c gunicorn.conf.py grua.wsgi
+
+GUNICORN_BIND -> Address the server listens on
+GUNICORN_WORKERS -> Number of worker processes (default: 2 * CPUs + 1)
+GUNICORN_THREADS -> Threads per worker, more than 1 uses the gthread workers
+GUNICORN_TIMEOUT -> Seconds a request may take before its worker is restarted
+GUNICORN_KEEPALIVE -> Seconds a client connection is kept open between requests
+GUNICORN_MAX_REQUESTS -> Requests served before a worker is replaced (0 disables)
+
+Each worker thread keeps its own database connection (POSTGRES_CONN_MAX_AGE),
+so workers * threads must fit in the database (or pooler) connection limit
+
+The user logs still buffered by a worker are written when it exits, since
+gunicorn stops its workers without running their atexit handlers
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(
+    os.environ.get("GUNICORN_WORKERS", str(multiprocessing.cpu_count() * 2 + 1))
+)
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+
+
+def worker_exit(server, worker):
+    from core.middleware import user_log_buffer
+
+    user_log_buffer.try_flush()